@@ -0,0 +1,192 @@
+"""
+Micro-benchmarks of the bencoding Decoder and Encoder against their
+previous implementations, using the Ubuntu torrent from the test data.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_bencoding
+"""
+
+import os
+import timeit
+from collections import OrderedDict
+
+from yufka.bencoding import Decoder, Encoder
+
+TORRENT = os.path.join(
+    os.path.dirname(__file__),
+    "..",
+    "test",
+    "data",
+    "ubuntu-23.04-desktop-amd64.iso.torrent",
+)
+
+
+class RecursiveDecoder:
+    """The recursive decoder the iterative Decoder replaced"""
+
+    def __init__(self, data: bytes):
+        self._data = data
+        self._index = 0
+
+    def decode(self):
+        c = self._peek()
+        if c is None:
+            raise EOFError("Unexpected end-of-file")
+        elif c == b"i":
+            self._consume()
+            return self._decode_int()
+        elif c == b"l":
+            self._consume()
+            return self._decode_list()
+        elif c == b"d":
+            self._consume()
+            return self._decode_dict()
+        elif c in b"01234567899":
+            return self._decode_string()
+        elif c == b"e":
+            return None
+        else:
+            raise RuntimeError("Unknown token")
+
+    def _peek(self):
+        if self._index + 1 >= len(self._data):
+            return None
+        return self._data[self._index : self._index + 1]
+
+    def _consume(self):
+        self._index += 1
+
+    def _read(self, length: int) -> bytes:
+        res = self._data[self._index : self._index + length]
+        self._index += length
+        return res
+
+    def _read_until(self, token: bytes) -> bytes:
+        occurance = self._data.index(token, self._index)
+        result = self._data[self._index : occurance]
+        self._index = occurance + 1
+        return result
+
+    def _decode_int(self):
+        return int(self._read_until(b"e"))
+
+    def _decode_string(self):
+        return self._read(int(self._read_until(b":")))
+
+    def _decode_list(self):
+        res = []
+        while self._data[self._index : self._index + 1] != b"e":
+            res.append(self.decode())
+        self._consume()
+        return res
+
+    def _decode_dict(self):
+        res = OrderedDict()
+        while self._data[self._index : self._index + 1] != b"e":
+            key = self.decode()
+            res[key] = self.decode()
+        self._consume()
+        return res
+
+
+class LegacyEncoder:
+    """The encoder the buffer-based Encoder replaced"""
+
+    def __init__(self, data):
+        self._data = data
+
+    def encode(self):
+        return self.encode_next(self._data)
+
+    def encode_next(self, data):
+        if type(data) == str:
+            return str.encode(str(len(data)) + ":" + data)
+        elif type(data) == int:
+            return str.encode("i" + str(data) + "e")
+        elif type(data) == list:
+            res = bytearray("l", "utf-8")
+            res += b"".join([self.encode_next(item) for item in data])
+            res += b"e"
+            return res
+        elif type(data) == dict or type(data) == OrderedDict:
+            result = bytearray("d", "utf-8")
+            for key, value in data.items():
+                key = self.encode_next(key)
+                value = self.encode_next(value)
+                if key and value:
+                    result += key
+                    result += value
+                else:
+                    raise RuntimeError("Invalid key or value")
+            result += b"e"
+            return result
+        elif type(data) == bytes:
+            res = bytearray()
+            res += str.encode(str(len(data)))
+            res += b":"
+            res += data
+            return res
+        else:
+            return None
+
+
+def _many_small_values(count: int) -> bytes:
+    """A scrape-like response with many small nested dicts"""
+    files = b"".join(
+        b"20:" + index.to_bytes(20, "big") + b"d8:completei5e10:downloadedi50e"
+        b"10:incompletei10ee"
+        for index in range(count)
+    )
+    return b"d5:filesd" + files + b"ee"
+
+
+def bench(name: str, data: bytes, number: int):
+    decoded = Decoder(data).decode()
+    report(
+        "decode " + name,
+        data,
+        number,
+        [
+            ("recursive", lambda: RecursiveDecoder(data).decode()),
+            ("iterative", lambda: Decoder(data).decode()),
+            ("iterative (views)", lambda: Decoder(data, views=True).decode()),
+        ],
+    )
+    report(
+        "encode " + name,
+        data,
+        number,
+        [
+            ("legacy", lambda: LegacyEncoder(decoded).encode()),
+            ("buffer", lambda: Encoder(decoded).encode()),
+            ("copy of the output", lambda: bytearray(data)),
+        ],
+    )
+
+
+def report(name: str, data: bytes, number: int, candidates):
+    results = []
+    for label, function in candidates:
+        best = min(timeit.repeat(function, number=number, repeat=5)) / number
+        results.append((label, best))
+
+    print("{name} ({size} bytes)".format(name=name, size=len(data)))
+    baseline = results[0][1]
+    for label, seconds in results:
+        print(
+            "  {label:<20} {us:10.1f} us  {speedup:5.2f}x".format(
+                label=label, us=seconds * 1e6, speedup=baseline / seconds
+            )
+        )
+
+
+def main():
+    with open(TORRENT, "rb") as f:
+        torrent = f.read()
+    bench("ubuntu-23.04-desktop-amd64.iso.torrent", torrent, 2000)
+    bench("scrape response, 5000 torrents", _many_small_values(5000), 20)
+
+
+if __name__ == "__main__":
+    main()
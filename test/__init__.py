@@ -1,4 +1,7 @@
 import logging
+from hashlib import sha1
+
+from yufka.torrent import TorrentFile
 
 
 class NoLogging:
@@ -20,6 +23,39 @@ class NoLogging:
 
 no_logging = NoLogging()
 
+
+class FakeTorrent:
+    """
+    The subset of `Torrent` used by the tests, a single file torrent
+    describing the given data.
+    """
+
+    def __init__(
+        self,
+        output_file: str = "output",
+        data: bytes = b"",
+        piece_length: int = 16,
+        info_hash: bytes = b"i" * 20,
+        announce_list: list = None,
+    ):
+        self.output_file = output_file
+        self.piece_length = piece_length
+        self.total_size = len(data)
+        self.info_hash = info_hash
+        self.announce_list = announce_list if announce_list is not None else []
+        self.multi_file = False
+        self.files = [TorrentFile(output_file, len(data))]
+        self.pieces = [
+            sha1(data[i : i + piece_length]).digest()
+            for i in range(0, len(data), piece_length)
+        ]
+
+    def piece_size(self, index: int) -> int:
+        if index == len(self.pieces) - 1:
+            return self.total_size - index * self.piece_length
+        return self.piece_length
+
+
 if __name__ == "__main__":
     import unittest
 
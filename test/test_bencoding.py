@@ -1,7 +1,9 @@
+import io
+import os
 import unittest
 from collections import OrderedDict
 
-from yufka.bencoding import Decoder, Encoder
+from yufka.bencoding import Decoder, Encoder, EventDecoder, StreamDecoder
 
 print("Imported")
 
@@ -69,11 +71,100 @@ class DecodingTests(unittest.TestCase):
         self.assertEqual(res[b"cow"], b"moo")
         self.assertEqual(res[b"spam"], b"eggs")
 
+    def test_top_level_spans(self):
+        data = b"d1:ai42e4:infod1:b2:xyee"
+        decoder = Decoder(data)
+        decoder.decode()
+        start, end = decoder.spans[b"info"]
+        self.assertEqual(data[start:end], b"d1:b2:xye")
+        start, end = decoder.spans[b"a"]
+        self.assertEqual(data[start:end], b"i42e")
+        self.assertNotIn(b"b", decoder.spans)
+
     def test_malformed_key_in_dict_should_failed(self):
         with self.assertRaises(EOFError):
             res = Decoder(b"d3:moo4:spam4:eggse").decode()
             print(res)
 
+    def test_non_string_key_in_dict(self):
+        with self.assertRaises(RuntimeError):
+            Decoder(b"di1e3:mooe").decode()
+
+    def test_deeply_nested_list(self):
+        depth = 100000
+        res = Decoder(b"l" * depth + b"e" * depth).decode()
+        for _ in range(depth - 1):
+            res = res[0]
+        self.assertEqual(res, [])
+
+    def test_views(self):
+        res = Decoder(b"d3:cowl3:mooi1ee4:spam4:eggse", views=True).decode()
+        self.assertIsInstance(res[b"spam"], memoryview)
+        self.assertEqual(res[b"spam"], b"eggs")
+        self.assertEqual(res[b"cow"][0], b"moo")
+        self.assertEqual(res[b"cow"][1], 1)
+        self.assertEqual([type(key) for key in res], [bytes, bytes])
+
+
+class StreamDecodingTests(unittest.TestCase):
+    def feed(self, data: bytes, size: int):
+        decoder = StreamDecoder()
+        for i in range(0, len(data), size):
+            decoder.feed(data[i : i + size])
+        return decoder.close()
+
+    def test_single_chunk(self):
+        res = self.feed(b"d3:cowl3:mooi-1ee4:spamdee", 100)
+        self.assertEqual(res, {b"cow": [b"moo", -1], b"spam": {}})
+
+    def test_byte_by_byte(self):
+        data = b"d3:cowl3:mooi42ee4:spam10:eggs, eggse"
+        self.assertEqual(self.feed(data, 1), Decoder(data).decode())
+
+    def test_torrent_in_chunks(self):
+        with open("test/data/ubuntu-23.04-desktop-amd64.iso.torrent", "rb") as f:
+            data = f.read()
+        self.assertEqual(self.feed(data, 1000), Decoder(data).decode())
+
+    def test_done_once_complete(self):
+        decoder = StreamDecoder()
+        self.assertFalse(decoder.feed(b"l4:sp"))
+        self.assertTrue(decoder.feed(b"ame"))
+        self.assertEqual(decoder.close(), [b"spam"])
+
+    def test_incomplete(self):
+        decoder = StreamDecoder()
+        decoder.feed(b"l4:sp")
+        with self.assertRaises(EOFError):
+            decoder.close()
+
+    def test_data_after_end(self):
+        decoder = StreamDecoder()
+        with self.assertRaises(RuntimeError):
+            decoder.feed(b"i1ei2e")
+
+
+class EventDecodingTests(unittest.TestCase):
+    def test_events(self):
+        decoder = EventDecoder()
+        events = decoder.feed(b"d5:filesl3:abci1eee")
+        decoder.close()
+        self.assertEqual(events, [((b"files", 0), b"abc"), ((b"files", 1), 1)])
+
+    def test_events_per_chunk(self):
+        decoder = EventDecoder()
+        self.assertEqual(decoder.feed(b"d1:ai1e1:b3:x"), [((b"a",), 1)])
+        self.assertEqual(decoder.feed(b"yze"), [((b"b",), b"xyz")])
+        decoder.close()
+
+    def test_empty_containers(self):
+        decoder = EventDecoder()
+        events = decoder.feed(b"d1:aldelee1:bdee")
+        self.assertEqual(events, [((b"a", 0), {}), ((b"a", 1), []), ((b"b",), {})])
+
+    def test_top_level_value(self):
+        self.assertEqual(EventDecoder().feed(b"i42e"), [((), 42)])
+
 
 class EncodingTests(unittest.TestCase):
     def test_empty_encoding(self):
@@ -110,3 +201,37 @@ class EncodingTests(unittest.TestCase):
         res = Encoder(outer).encode()
 
         self.assertEqual(res, b"d1:ai123e1:bd2:ba3:foo2:bb3:bare1:cll1:a1:be1:zee")
+
+    def test_dict_keys_are_sorted(self):
+        res = Encoder({b"spam": 1, "cow": 2, b"a": [], b"B": {}}).encode()
+        self.assertEqual(res, b"d1:Bde1:ale3:cowi2e4:spami1ee")
+
+    def test_invalid_dict_key(self):
+        with self.assertRaises(RuntimeError):
+            Encoder({1: 2}).encode()
+
+    def test_invalid_nested_value(self):
+        with self.assertRaises(RuntimeError):
+            Encoder([1, None]).encode()
+
+    def test_unicode_string(self):
+        res = Encoder("şpam").encode()
+        self.assertEqual(res, b"5:\xc5\x9fpam")
+
+    def test_byte_string_types(self):
+        data = [b"spam", bytearray(b"eggs"), memoryview(b"xspamx")[1:5]]
+        res = Encoder(data).encode()
+        self.assertEqual(res, b"l4:spam4:eggs4:spame")
+
+    def test_round_trip(self):
+        with open("test/data/ubuntu-23.04-desktop-amd64.iso.torrent", "rb") as f:
+            data = f.read()
+        self.assertEqual(Encoder(Decoder(data).decode()).encode(), data)
+
+    def test_encode_to_file(self):
+        large = os.urandom(Encoder.SINK_BUFFER_SIZE + 1)
+        data = {b"large": memoryview(large), b"small": [1, b"x" * 10]}
+        with io.BytesIO() as f:
+            self.assertTrue(Encoder(data).encode_to(f))
+            self.assertEqual(f.getvalue(), Encoder(data).encode())
+            self.assertEqual(Decoder(f.getvalue()).decode()[b"large"], large)
@@ -0,0 +1,93 @@
+import unittest
+
+from yufka.choker import Choker
+
+
+class FakePieceManager:
+    def __init__(self):
+        self.complete = False
+
+
+class FakeConnection:
+    """The subset of `PeerConnection` used by the `Choker`"""
+
+    def __init__(self, remote_id, interested: bool = True):
+        self.remote_id = remote_id
+        self.peer_state = ["choked"] + (["interested"] if interested else [])
+        self.downloaded = 0
+        self.uploaded = 0
+
+    @property
+    def choked(self) -> bool:
+        return "choked" in self.peer_state
+
+    def unchoke_peer(self):
+        if self.choked:
+            self.peer_state.remove("choked")
+
+    def choke_peer(self):
+        if not self.choked:
+            self.peer_state.append("choked")
+
+
+class ChokerTests(unittest.TestCase):
+    def setUp(self):
+        self.piece_manager = FakePieceManager()
+        self.choker = Choker(self.piece_manager, slots=2, optimistic_rounds=3)
+        self.connections = [FakeConnection(bytes([i]) * 20) for i in range(5)]
+        self.choker.connections = self.connections
+
+    def unchoked(self) -> list:
+        return [c for c in self.connections if not c.choked]
+
+    def test_unchokes_best_downloads_and_an_optimistic_peer(self):
+        for rate, connection in zip([10, 50, 0, 40, 0], self.connections):
+            connection.downloaded = rate
+        self.choker.choke_round()
+        unchoked = self.unchoked()
+        self.assertEqual(len(unchoked), 3)
+        self.assertIn(self.connections[1], unchoked)
+        self.assertIn(self.connections[3], unchoked)
+        self.assertIn(self.choker.optimistic, [self.connections[i] for i in (0, 2, 4)])
+
+    def test_ranks_by_recent_rate(self):
+        self.connections[0].downloaded = 1000
+        self.choker.choke_round()
+        self.connections[0].downloaded += 1
+        self.connections[1].downloaded += 10
+        self.connections[2].downloaded += 20
+        self.choker.choke_round()
+        regular = set(self.unchoked()) - {self.choker.optimistic}
+        self.assertEqual(regular, {self.connections[1], self.connections[2]})
+
+    def test_ranks_by_upload_when_seeding(self):
+        self.piece_manager.complete = True
+        self.connections[0].downloaded = 1000
+        self.connections[3].uploaded = 10
+        self.connections[4].uploaded = 20
+        self.choker.choke_round()
+        regular = set(self.unchoked()) - {self.choker.optimistic}
+        self.assertEqual(regular, {self.connections[3], self.connections[4]})
+
+    def test_optimistic_peer_is_rotated(self):
+        self.choker.choke_round()
+        optimistic = self.choker.optimistic
+        for _ in range(2):
+            self.choker.choke_round()
+            self.assertIs(self.choker.optimistic, optimistic)
+        self.assertFalse(optimistic.choked)
+
+    def test_uninterested_and_disconnected_peers_are_choked(self):
+        self.connections[0].peer_state = []
+        self.connections[1].remote_id = None
+        self.choker.choke_round()
+        self.assertTrue(self.connections[0].choked)
+        self.assertNotIn(self.connections[1], self.unchoked())
+        self.assertEqual(len(self.unchoked()), 3)
+
+    def test_interested_peer_takes_free_slot(self):
+        for connection in self.connections[:3]:
+            self.choker.peer_interested(connection)
+        self.assertEqual(self.unchoked(), self.connections[:3])
+        self.choker.peer_interested(self.connections[3])
+        self.assertTrue(self.connections[3].choked)
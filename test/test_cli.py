@@ -0,0 +1,107 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from yufka.bencoding import Encoder
+from yufka.cli import first_positional, main, torrent_paths
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+UBUNTU = os.path.join(DATA, "ubuntu-23.04-desktop-amd64.iso.torrent")
+
+
+class InfoCommandTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        os.mkdir(os.path.join(self.directory.name, "sub"))
+        for name in ["b.torrent", os.path.join("sub", "a.torrent")]:
+            shutil.copy(UBUNTU, os.path.join(self.directory.name, name))
+        with open(os.path.join(self.directory.name, "notes.txt"), "w") as f:
+            f.write("not a torrent")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def info(self, *argv, options=()):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            status = main([*options, "info", "-j", "2", *argv])
+        return status, [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_torrent_paths(self):
+        paths = list(torrent_paths([self.directory.name, UBUNTU]))
+        self.assertEqual(
+            paths,
+            [
+                os.path.join(self.directory.name, "b.torrent"),
+                os.path.join(self.directory.name, "sub", "a.torrent"),
+                UBUNTU,
+            ],
+        )
+
+    def test_info(self):
+        status, results = self.info(self.directory.name)
+        self.assertEqual(status, 0)
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertEqual(
+                result["info_hash"], "443c7602b4fde83d1154d6d9da48808418b181b6"
+            )
+            self.assertEqual(result["pieces"], 18816)
+            self.assertEqual(
+                result["files"],
+                [{"path": "ubuntu-23.04-desktop-amd64.iso", "length": 4932407296}],
+            )
+
+    def test_invalid_torrent(self):
+        path = os.path.join(self.directory.name, "notes.txt")
+        status, results = self.info(UBUNTU, path)
+        self.assertEqual(status, 1)
+        self.assertEqual(results[0]["size"], 4932407296)
+        self.assertEqual(results[1]["path"], path)
+        self.assertIn("error", results[1])
+
+    def test_malformed_metadata(self):
+        path = os.path.join(self.directory.name, "bad.torrent")
+        info = {b"length": 1, b"name": 5, b"piece length": 1, b"pieces": b"x" * 20}
+        with open(path, "wb") as f:
+            Encoder({b"announce": b"http://x/announce", b"info": info}).encode_to(f)
+        status, results = self.info(path, UBUNTU)
+        self.assertEqual(status, 1)
+        self.assertIn("error", results[0])
+        self.assertEqual(results[1]["size"], 4932407296)
+
+    def test_option_before_command(self):
+        cache = os.path.join(self.directory.name, "cache")
+        status, results = self.info(UBUNTU, options=["--metadata-cache", cache])
+        self.assertEqual(status, 0)
+        self.assertEqual(results[0]["pieces"], 18816)
+        self.assertTrue(os.listdir(cache))
+
+
+class CommandLineTests(unittest.TestCase):
+    def test_first_positional(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument("-v", action="store_true")
+        parser.add_argument("--metadata-cache")
+        self.assertEqual(first_positional(["-v", "x.torrent"], parser), "x.torrent")
+        self.assertEqual(
+            first_positional(["--metadata-cache", "/tmp/c", "info"], parser), "info"
+        )
+        self.assertEqual(
+            first_positional(["--metadata-cache=/tmp/c", "info"], parser), "info"
+        )
+        self.assertEqual(first_positional(["--", "-x.torrent"], parser), "-x.torrent")
+        self.assertIsNone(first_positional(["-v"], parser))
+
+    def test_check_missing_path(self):
+        with tempfile.TemporaryDirectory() as directory:
+            error = io.StringIO()
+            with contextlib.redirect_stderr(error):
+                status = main(["check", UBUNTU, os.path.join(directory, "missing")])
+        self.assertEqual(status, 1)
+        self.assertIn("Unable to check", error.getvalue())
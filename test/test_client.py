@@ -1,8 +1,263 @@
+import os
+import tempfile
 import unittest
+from hashlib import sha1
 
-from . import no_logging
-from yufka.client import Piece, Block
+import bitstring
+
+from . import FakeTorrent, no_logging
+from yufka.client import Piece, Block, PieceManager
+from yufka.protocol import REQUEST_SIZE
 
 
 class PieceTests(unittest.TestCase):
-    pass
+    def setUp(self):
+        self.piece = Piece(
+            0,
+            [Block(0, 0, REQUEST_SIZE), Block(0, REQUEST_SIZE, 10)],
+            sha1(b"a" * REQUEST_SIZE + b"b" * 10).digest(),
+        )
+
+    def test_next_request(self):
+        self.assertEqual(self.piece.next_request().offset, 0)
+        self.assertEqual(self.piece.next_request().offset, REQUEST_SIZE)
+        self.assertIsNone(self.piece.next_request())
+
+    def test_complete_piece(self):
+        self.assertTrue(self.piece.block_received(0, REQUEST_SIZE))
+        self.assertFalse(self.piece.is_complete())
+        self.assertTrue(self.piece.block_received(REQUEST_SIZE, 10))
+        self.assertTrue(self.piece.is_complete())
+
+    def test_unknown_block(self):
+        with no_logging:
+            self.assertFalse(self.piece.block_received(5, 1))
+            self.assertFalse(self.piece.block_received(REQUEST_SIZE, 11))
+        self.assertFalse(self.piece.is_complete())
+
+    def test_duplicate_block(self):
+        self.assertTrue(self.piece.block_received(0, REQUEST_SIZE))
+        self.assertFalse(self.piece.block_received(0, REQUEST_SIZE))
+        self.assertFalse(self.piece.is_complete())
+
+    def test_cancelled_request_is_requested_again(self):
+        first = self.piece.next_request()
+        self.piece.next_request()
+        self.assertTrue(self.piece.fully_requested)
+        self.assertTrue(self.piece.cancel_request(first))
+        self.assertFalse(self.piece.cancel_request(first))
+        self.assertFalse(self.piece.fully_requested)
+        self.assertIs(self.piece.next_request(), first)
+        self.assertIsNone(self.piece.next_request())
+
+    def test_cancelled_request_received_late(self):
+        first = self.piece.next_request()
+        self.piece.cancel_request(first)
+        self.assertTrue(self.piece.block_received(0, REQUEST_SIZE))
+        self.assertEqual(self.piece.next_request().offset, REQUEST_SIZE)
+        self.assertIsNone(self.piece.next_request())
+
+    def test_reset(self):
+        self.piece.next_request()
+        self.piece.block_received(0, REQUEST_SIZE)
+        self.piece.reset()
+        self.assertEqual(self.piece.next_request().offset, 0)
+        self.assertFalse(self.piece.is_complete())
+
+
+class PieceManagerTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.data = os.urandom(3 * REQUEST_SIZE + 100)
+        self.torrent = FakeTorrent(
+            os.path.join(self.directory.name, "output"), self.data, 2 * REQUEST_SIZE
+        )
+        self.manager = PieceManager(self.torrent)
+
+    def tearDown(self):
+        self.manager.close()
+        self.directory.cleanup()
+
+    def test_blocks_per_piece(self):
+        lengths = [[b.length for b in p.blocks] for p in self.manager.pieces]
+        self.assertEqual(lengths, [[REQUEST_SIZE, REQUEST_SIZE], [REQUEST_SIZE, 100]])
+
+    def test_unknown_peer_gets_no_request(self):
+        self.assertIsNone(self.manager.next_request(b"peer"))
+
+    def test_only_requests_pieces_the_peer_has(self):
+        self.manager.add_peer(b"peer", bitstring.BitArray(bin="01000000"))
+        block = self.manager.next_request(b"peer")
+        self.assertEqual((block.piece, block.offset), (1, 0))
+
+    def test_cancelled_requests_go_to_other_peers(self):
+        self.manager.add_peer(b"a", bitstring.BitArray(bin="10000000"))
+        self.manager.add_peer(b"b", bitstring.BitArray(bin="10000000"))
+        blocks = [self.manager.next_request(b"a") for _ in range(2)]
+        self.assertIsNone(self.manager.next_request(b"b"))
+
+        # Only the peer the blocks were requested from gives them back
+        self.manager.cancel_requests(b"b", [(0, 0)])
+        self.assertIsNone(self.manager.next_request(b"b"))
+        self.manager.cancel_requests(b"a", [(b.piece, b.offset) for b in blocks])
+        again = [self.manager.next_request(b"b") for _ in range(2)]
+        self.assertEqual(sorted(b.offset for b in again), [0, REQUEST_SIZE])
+        self.assertIsNone(self.manager.next_request(b"b"))
+        self.assertEqual(self.manager.pending_blocks[(0, 0)].peer_id, b"b")
+
+    async def test_download_all_pieces(self):
+        self.manager.add_peer(b"peer", bitstring.BitArray(bin="11000000"))
+        while True:
+            block = self.manager.next_request(b"peer")
+            if not block:
+                break
+            start = block.piece * self.torrent.piece_length + block.offset
+            data = self.data[start : start + block.length]
+            with no_logging:
+                self.manager.block_received(b"peer", block.piece, block.offset, data)
+
+        self.assertFalse(self.manager.complete)
+        verified = []
+        self.manager.on_piece_cb = verified.append
+        await self.manager.verifier.drain()
+        self.assertTrue(self.manager.complete)
+        self.assertEqual(sorted(verified), [0, 1])
+        # The last piece is shorter than the piece length
+        self.assertEqual(self.manager.bytes_downloaded, len(self.data))
+        self.manager.close()
+        with open(self.torrent.output_file, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    async def test_corrupt_piece_is_requested_again(self):
+        self.manager.add_peer(b"peer", bitstring.BitArray(bin="10000000"))
+        for _ in range(2):
+            block = self.manager.next_request(b"peer")
+            with no_logging:
+                self.manager.block_received(
+                    b"peer", block.piece, block.offset, b"x" * block.length
+                )
+        with no_logging:
+            await self.manager.verifier.drain()
+        self.assertFalse(self.manager.complete)
+        self.assertEqual(self.manager.next_request(b"peer").offset, 0)
+
+    async def test_no_new_pieces_while_verifier_is_saturated(self):
+        self.manager.verifier.max_pending = 1
+        self.manager.add_peer(b"peer", bitstring.BitArray(bin="11000000"))
+        for _ in range(2):
+            block = self.manager.next_request(b"peer")
+            start = block.offset
+            self.manager.block_received(
+                b"peer", 0, block.offset, self.data[start : start + block.length]
+            )
+        self.assertTrue(self.manager.verifier.saturated)
+        self.assertIsNone(self.manager.next_request(b"peer"))
+        await self.manager.verifier.drain()
+        self.assertEqual(self.manager.next_request(b"peer").piece, 1)
+
+
+class RestoreTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.data = os.urandom(4 * REQUEST_SIZE)
+        self.torrent = FakeTorrent(
+            os.path.join(self.directory.name, "output"), self.data, REQUEST_SIZE
+        )
+        with open(self.torrent.output_file, "wb") as f:
+            f.write(self.data[: 2 * REQUEST_SIZE] + b"x" * 2 * REQUEST_SIZE)
+        self.manager = PieceManager(self.torrent)
+        self.manager.add_peer(b"peer", bitstring.BitArray(bin="11110000"))
+
+    def tearDown(self):
+        self.manager.close()
+        self.directory.cleanup()
+
+    def test_restore(self):
+        self.manager.restore([0, 3])
+        self.assertEqual(len(self.manager.have_pieces), 2)
+        pieces = [self.manager.next_request(b"peer").piece for _ in range(2)]
+        self.assertEqual(sorted(pieces), [1, 2])
+        self.assertIsNone(self.manager.next_request(b"peer"))
+
+    def test_read_block_of_piece_we_have(self):
+        self.manager.restore([0, 3])
+        self.assertTrue(self.manager.has_piece(3))
+        self.assertFalse(self.manager.has_piece(1))
+        self.assertFalse(self.manager.has_piece(4))
+        self.assertEqual(self.manager.bitfield(), b"\x90")
+        with self.manager.read_block(0, 10, 20) as block:
+            self.assertEqual(block, self.data[10:30])
+        self.assertIsNone(self.manager.read_block(1, 0, 20))
+        self.assertIsNone(self.manager.read_block(0, REQUEST_SIZE - 10, 20))
+
+    def test_bytes_uploaded(self):
+        self.manager.block_uploaded(REQUEST_SIZE)
+        self.manager.block_uploaded(10)
+        self.assertEqual(self.manager.bytes_uploaded, REQUEST_SIZE + 10)
+
+    async def test_recheck(self):
+        restored = await self.manager.recheck([0, 1, 2])
+        self.assertEqual(restored, [0, 1])
+        self.assertEqual([p.index for p in self.manager.have_pieces], [0, 1])
+
+
+class RarestFirstTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        data = os.urandom(4 * REQUEST_SIZE)
+        self.manager = PieceManager(
+            FakeTorrent(os.path.join(self.directory.name, "output"), data, REQUEST_SIZE)
+        )
+
+    def tearDown(self):
+        self.manager.close()
+        self.directory.cleanup()
+
+    def test_availability_counts(self):
+        self.manager.add_peer(b"a", bitstring.BitArray(bin="11110000"))
+        self.manager.add_peer(b"b", bitstring.BitArray(bin="01100000"))
+        self.manager.update_peer(b"c", 2)
+        self.assertEqual(self.manager.availability, [1, 2, 3, 1])
+
+        self.manager.remove_peer(b"b")
+        self.assertEqual(self.manager.availability, [1, 1, 2, 1])
+
+    def test_duplicate_have_is_ignored(self):
+        self.manager.add_peer(b"a", bitstring.BitArray(bin="00010000"))
+        self.manager.update_peer(b"a", 3)
+        self.assertEqual(self.manager.availability, [0, 0, 0, 1])
+
+    def test_picks_rarest_piece(self):
+        self.manager.add_peer(b"a", bitstring.BitArray(bin="11110000"))
+        self.manager.add_peer(b"b", bitstring.BitArray(bin="11010000"))
+        self.manager.add_peer(b"c", bitstring.BitArray(bin="10010000"))
+        pieces = [self.manager.next_request(b"a").piece for _ in range(4)]
+        self.assertEqual(pieces, [2, 1, 0, 3])
+        self.assertIsNone(self.manager.next_request(b"a"))
+
+    def test_rarest_piece_the_peer_has(self):
+        self.manager.add_peer(b"a", bitstring.BitArray(bin="11110000"))
+        self.manager.add_peer(b"b", bitstring.BitArray(bin="11000000"))
+        self.assertEqual(self.manager.next_request(b"b").piece, 0)
+
+    def test_rarest_piece_the_peer_has_among_many_it_lacks(self):
+        # Bucket 1 holds more pieces than peer b has, so its pieces are
+        # walked instead
+        self.manager.add_peer(b"a", bitstring.BitArray(bin="11000000"))
+        self.manager.add_peer(b"b", bitstring.BitArray(bin="00110000"))
+        self.manager.add_peer(b"c", bitstring.BitArray(bin="00110000"))
+        self.manager.add_peer(b"d", bitstring.BitArray(bin="00100000"))
+        pieces = [self.manager.next_request(b"b").piece for _ in range(2)]
+        self.assertEqual(pieces, [3, 2])
+        self.assertIsNone(self.manager.next_request(b"b"))
+
+    def test_completes_ongoing_piece_first(self):
+        manager = self.manager
+        manager.add_peer(b"a", bitstring.BitArray(bin="11110000"))
+        manager.add_peer(b"b", bitstring.BitArray(bin="00100000"))
+        self.assertEqual(manager.next_request(b"b").piece, 2)
+        # The piece's only block is pending, so peer a gets a new piece
+        self.assertNotEqual(manager.next_request(b"a").piece, 2)
+        # Re-requested once the pending request expired
+        manager.max_pending_time = -1
+        self.assertEqual(manager.next_request(b"b").piece, 2)
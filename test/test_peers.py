@@ -0,0 +1,58 @@
+import unittest
+from asyncio import Queue
+
+from yufka import peers
+from yufka.peers import PeerStore
+
+
+class PeerStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.queue = Queue()
+        self.store = PeerStore(self.queue)
+
+    def queued(self):
+        result = []
+        while not self.queue.empty():
+            result.append(self.queue.get_nowait())
+        return result
+
+    def test_duplicates_are_queued_once(self):
+        a, b = ("10.0.0.1", 6881), ("10.0.0.2", 6881)
+        self.assertEqual(self.store.add([a, b, a]), 2)
+        self.assertEqual(self.store.add([b]), 0)
+        self.assertEqual(self.queued(), [a, b])
+        self.assertEqual(len(self.store), 2)
+
+    def test_connected_peer_is_not_queued(self):
+        peer = ("10.0.0.1", 6881)
+        self.store.add([peer])
+        self.queued()
+        self.store.connected(peer)
+        self.assertEqual(self.store.add([peer]), 0)
+        self.store.released(peer)
+        self.assertEqual(self.store.add([peer]), 1)
+
+    def test_failed_peer_backs_off(self):
+        peer = ("10.0.0.1", 6881)
+        self.store.add([peer])
+        self.queued()
+        self.store.failed(peer)
+        self.store.released(peer)
+        self.assertEqual(self.store.add([peer]), 0)
+        self.store.peers[peer].retry_at = 0
+        self.assertEqual(self.store.add([peer]), 1)
+
+    def test_failing_peer_is_given_up(self):
+        peer = ("10.0.0.1", 6881)
+        for _ in range(peers.MAX_PEER_FAILURES):
+            self.store.failed(peer)
+        self.store.released(peer)
+        self.store.peers[peer].retry_at = 0
+        self.assertEqual(self.store.add([peer]), 0)
+
+    def test_connection_resets_failures(self):
+        peer = ("10.0.0.1", 6881)
+        self.store.failed(peer)
+        self.store.connected(peer)
+        self.store.released(peer)
+        self.assertEqual(self.store.add([peer]), 1)
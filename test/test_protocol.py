@@ -1,22 +1,377 @@
+import asyncio
+import os
+import struct
+import tempfile
 import unittest
 
+from . import FakeTorrent, no_logging
+from yufka.client import PieceManager
+from yufka.peers import PeerStore
 from yufka.protocol import (
+    BitField,
+    open_peer,
+    PeerConnection,
+    PeerDialer,
     PeerStreamIterator,
     Handshake,
+    KeepAlive,
+    PeerMessage,
     Have,
     Request,
     Piece,
     Interested,
     Cancel,
+    Unchoke,
+    ProtocolError,
+    RequestPipeline,
+    REQUEST_SIZE,
 )
 
 
+class ChunkedReader:
+    """Stand-in for a `StreamReader` returning the given chunks in order"""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    async def read(self, n=-1):
+        if not self.chunks:
+            return b""
+        chunk = self.chunks.pop(0)
+        if 0 < n < len(chunk):
+            self.chunks.insert(0, chunk[n:])
+            chunk = chunk[:n]
+        return chunk
+
+
+async def _collect(iterator):
+    return [message async for message in iterator]
+
+
 class PeerStreamIteratorTests(unittest.TestCase):
     def test_parse_empty_buffer(self):
         iterator = PeerStreamIterator(None)
         iterator.buffer = ""
         self.assertIsNone(iterator.parse())
 
+    def test_message_exceeding_limit(self):
+        iterator = PeerStreamIterator(None, struct.pack(">I", 2**31) + b"\x07")
+        with self.assertRaises(ProtocolError):
+            iterator.parse()
+        self.assertLess(len(iterator._buffer), 2**20)
+
+    def test_message_limit(self):
+        message = BitField(b"\xff" * 100).encode()
+        iterator = PeerStreamIterator(None, message, max_length=101)
+        self.assertEqual(iterator.parse().bitfield.tobytes(), b"\xff" * 100)
+        iterator = PeerStreamIterator(None, message, max_length=100)
+        with self.assertRaises(ProtocolError):
+            iterator.parse()
+
+    def test_parse_partial_message(self):
+        iterator = PeerStreamIterator(None, Have(33).encode()[:6])
+        self.assertIsNone(iterator.parse())
+        self.assertEqual(iterator.buffer, Have(33).encode()[:6])
+
+    def test_parse_consumes_keep_alive(self):
+        iterator = PeerStreamIterator(None, b"\x00\x00\x00\x00" + Have(1).encode())
+        self.assertIsInstance(iterator.parse(), KeepAlive)
+        self.assertEqual(iterator.parse().index, 1)
+        self.assertEqual(iterator.buffer, b"")
+
+    def test_parse_piece_is_view_of_buffer(self):
+        iterator = PeerStreamIterator(None, Piece(1, 16, b"data").encode())
+        piece = iterator.parse()
+        self.assertIsInstance(piece.block, memoryview)
+        self.assertEqual(piece.block, b"data")
+        self.assertEqual(piece.index, 1)
+        self.assertEqual(piece.begin, 16)
+
+    def test_skips_unsupported_message(self):
+        port = b"\x00\x00\x00\x03\x09\x1a\xe1"
+        iterator = PeerStreamIterator(None, port + Interested().encode())
+        self.assertIsInstance(iterator.parse(), Interested)
+
+    def test_iterates_messages_split_across_reads(self):
+        block = bytes(range(256)) * 64
+        stream = Have(7).encode() + Piece(3, 0, block).encode()
+        reader = ChunkedReader(
+            stream[i : i + 1000] for i in range(0, len(stream), 1000)
+        )
+        iterator = PeerStreamIterator(reader)
+
+        async def first_two():
+            have = await iterator.__anext__()
+            piece = await iterator.__anext__()
+            return have, piece
+
+        have, piece = asyncio.run(first_two())
+        self.assertEqual([m.index for m in have], [7])
+        self.assertEqual(bytes(piece[0].block), block)
+
+    def test_batches_all_complete_messages(self):
+        stream = b"".join(Have(i).encode() for i in range(20))
+        reader = ChunkedReader([stream + b"\x00\x00\x00\x00" + Interested().encode()])
+        batches = asyncio.run(_collect(PeerStreamIterator(reader)))
+        self.assertEqual(len(batches), 1)
+        self.assertEqual([m.index for m in batches[0][:20]], list(range(20)))
+        self.assertIsInstance(batches[0][20], KeepAlive)
+        self.assertIsInstance(batches[0][21], Interested)
+
+    def test_batches_initial_buffer_before_reading(self):
+        reader = ChunkedReader([Have(2).encode()])
+        iterator = PeerStreamIterator(reader, Have(1).encode())
+        batches = asyncio.run(_collect(iterator))
+        self.assertEqual([[m.index for m in batch] for batch in batches], [[1], [2]])
+
+    def test_parse_batch_leaves_partial_message(self):
+        iterator = PeerStreamIterator(None, Have(1).encode() + Have(2).encode()[:5])
+        self.assertEqual(len(iterator.parse_batch()), 1)
+        self.assertEqual(iterator.buffer, Have(2).encode()[:5])
+
+    def test_empty_batch_while_idle(self):
+        async def collect():
+            reader = asyncio.StreamReader()
+            iterator = PeerStreamIterator(reader, idle_timeout=0.01)
+            batches = [await iterator.__anext__()]
+            reader.feed_data(Have(1).encode())
+            batches.append(await iterator.__anext__())
+            return batches
+
+        batches = asyncio.run(collect())
+        self.assertEqual(batches[0], [])
+        self.assertEqual([message.index for message in batches[1]], [1])
+
+    def test_grows_buffer_for_large_message(self):
+        block = b"x" * (PeerStreamIterator.BUFFER_SIZE + 10)
+        reader = ChunkedReader([Piece(0, 0, block).encode()])
+        iterator = PeerStreamIterator(reader, max_length=len(block) + 9)
+        batches = asyncio.run(_collect(iterator))
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(bytes(batches[0][0].block), block)
+
+
+class StandInPeers:
+    """
+    Local peers answering the handshake, or never answering it when silent.
+    """
+
+    def __init__(self):
+        self.servers = []
+
+    async def start(self, silent: bool = False, info_hash: bytes = b"i" * 20):
+        async def serve(reader, writer):
+            await reader.readexactly(Handshake.length)
+            if not silent:
+                writer.write(Handshake(info_hash, b"r" * 20).encode())
+                writer.write(Have(7).encode())
+            await reader.read()
+            writer.close()
+
+        server = await asyncio.start_server(serve, "127.0.0.1", 0)
+        self.servers.append(server)
+        return ("127.0.0.1", server.sockets[0].getsockname()[1])
+
+    def close(self):
+        for server in self.servers:
+            server.close()
+
+
+class DialTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.peers = StandInPeers()
+
+    async def asyncTearDown(self):
+        self.peers.close()
+
+    async def test_open_peer(self):
+        peer = await self.peers.start()
+        reader, writer, remote_id = await open_peer(peer, b"i" * 20, b"p" * 20)
+        self.assertEqual(remote_id, b"r" * 20)
+        # The messages after the handshake are left to the reader
+        self.assertEqual(await reader.readexactly(9), Have(7).encode())
+        writer.close()
+
+    async def test_handshake_timeout(self):
+        peer = await self.peers.start(silent=True)
+        with self.assertRaises(asyncio.TimeoutError):
+            await open_peer(peer, b"i" * 20, b"p" * 20, handshake_timeout=0.05)
+
+    async def test_handshake_with_other_torrent(self):
+        peer = await self.peers.start(info_hash=b"x" * 20)
+        with self.assertRaises(ProtocolError):
+            await open_peer(peer, b"i" * 20, b"p" * 20)
+
+    async def test_dialer_hands_out_responding_peers(self):
+        silent = [await self.peers.start(silent=True) for _ in range(3)]
+        live = await self.peers.start()
+        queue = asyncio.Queue()
+        store = PeerStore(queue)
+        store.add(silent + [live])
+        dialer = PeerDialer(
+            queue, b"i" * 20, b"p" * 20, peer_store=store, handshake_timeout=0.2
+        )
+        try:
+            peer, reader, writer, remote_id = await asyncio.wait_for(dialer.get(), 0.1)
+            self.assertEqual(peer, live)
+            self.assertEqual(remote_id, b"r" * 20)
+            writer.close()
+            await queue.join()
+            self.assertEqual([store.peers[p].failures for p in silent], [1, 1, 1])
+        finally:
+            dialer.stop()
+
+    async def test_dialer_survives_invalid_peers(self):
+        invalid = [("127.0.0.1", 70000), ("x" * 300, 6881)]
+        live = await self.peers.start()
+        queue = asyncio.Queue()
+        store = PeerStore(queue)
+        store.add(invalid + [live])
+        dialer = PeerDialer(queue, b"i" * 20, b"p" * 20, max_dials=1, peer_store=store)
+        try:
+            with no_logging:
+                peer, _, writer, _ = await asyncio.wait_for(dialer.get(), 1)
+            self.assertEqual(peer, live)
+            writer.close()
+            self.assertEqual([store.peers[p].failures for p in invalid], [1, 1])
+            self.assertEqual([store.peers[p].state for p in invalid], ["idle"] * 2)
+        finally:
+            dialer.stop()
+
+    async def test_dialer_only_dials_when_wanted(self):
+        queue = asyncio.Queue()
+        queue.put_nowait(await self.peers.start())
+        dialer = PeerDialer(queue, b"i" * 20, b"p" * 20)
+        await asyncio.sleep(0.05)
+        self.assertEqual(queue.qsize(), 1)
+        dialer.stop()
+
+
+class UploadTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.data = os.urandom(3 * REQUEST_SIZE + 100)
+        self.torrent = FakeTorrent(
+            os.path.join(self.directory.name, "output"), self.data, 2 * REQUEST_SIZE
+        )
+        with open(self.torrent.output_file, "wb") as f:
+            f.write(self.data)
+        self.manager = PieceManager(self.torrent)
+        self.manager.restore([1])
+        self.received = asyncio.Queue()
+        self.server = await asyncio.start_server(self.leech, "127.0.0.1", 0)
+        queue = asyncio.Queue()
+        queue.put_nowait(("127.0.0.1", self.server.sockets[0].getsockname()[1]))
+        self.connection = PeerConnection(
+            queue, b"i" * 20, b"p" * 20, self.manager, None
+        )
+
+    async def asyncTearDown(self):
+        self.connection.stop()
+        self.server.close()
+        await asyncio.sleep(0)
+        self.manager.close()
+        self.directory.cleanup()
+
+    async def leech(self, reader, writer):
+        """
+        A remote peer requesting blocks of the piece we have, and cancelling
+        one of them.
+        """
+        await reader.readexactly(Handshake.length)
+        writer.write(Handshake(b"i" * 20, b"r" * 20).encode())
+        writer.write(Interested().encode())
+        try:
+            while True:
+                length, message_id = struct.unpack(">Ib", await reader.readexactly(5))
+                payload = await reader.readexactly(length - 1)
+                self.received.put_nowait((message_id, payload))
+                if message_id == PeerMessage.Unchoke:
+                    writer.write(
+                        Request(1, 0).encode()
+                        + Request(1, REQUEST_SIZE, 100).encode()
+                        + Request(2, 0, 100).encode()
+                        + Cancel(1, REQUEST_SIZE, 100).encode()
+                        + Request(1, 1000, 50).encode()
+                    )
+        except asyncio.IncompleteReadError:
+            pass
+
+    async def next_message(self):
+        return await asyncio.wait_for(self.received.get(), 1)
+
+    async def test_serves_requested_blocks(self):
+        message_id, payload = await self.next_message()
+        self.assertEqual(message_id, PeerMessage.BitField)
+        self.assertEqual(payload, b"\x40")
+        self.assertEqual((await self.next_message())[0], PeerMessage.Interested)
+        self.assertEqual((await self.next_message())[0], PeerMessage.Unchoke)
+
+        blocks = []
+        for _ in range(2):
+            message_id, payload = await self.next_message()
+            self.assertEqual(message_id, PeerMessage.Piece)
+            blocks.append(struct.unpack_from(">II", payload) + (payload[8:],))
+        start = 2 * REQUEST_SIZE
+        self.assertEqual(blocks[0], (1, 0, self.data[start : start + REQUEST_SIZE]))
+        self.assertEqual(blocks[1], (1, 1000, self.data[start + 1000 :][:50]))
+        self.assertEqual(self.manager.bytes_uploaded, REQUEST_SIZE + 50)
+
+        self.connection.send_have(0)
+        self.assertEqual(await self.next_message(), (PeerMessage.Have, b"\0" * 4))
+        # Neither the cancelled block nor the missing piece are served
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(self.received.get(), 0.1)
+
+
+class RequestPipelineTests(unittest.TestCase):
+    def test_starts_at_min_depth(self):
+        pipeline = RequestPipeline(5, 250)
+        self.assertEqual(pipeline.free, 5)
+        pipeline.sent(0, 0, now=0.0)
+        self.assertEqual(pipeline.free, 4)
+        self.assertEqual(len(pipeline), 1)
+
+    def test_expired_requests(self):
+        pipeline = RequestPipeline(5, 250, timeout=10)
+        pipeline.sent(0, 0, now=0.0)
+        pipeline.sent(0, REQUEST_SIZE, now=5.0)
+        self.assertEqual(pipeline.expired(now=9.0), [])
+        self.assertEqual(pipeline.expired(now=12.0), [(0, 0)])
+        self.assertEqual(pipeline.free, 4)
+        self.assertEqual(pipeline.expired(now=15.0), [(0, REQUEST_SIZE)])
+
+    def test_invalid_bounds(self):
+        with self.assertRaises(ValueError):
+            RequestPipeline(10, 5)
+
+    def test_unrequested_block(self):
+        pipeline = RequestPipeline()
+        self.assertFalse(pipeline.received(0, 0, REQUEST_SIZE, now=1.0))
+
+    def test_depth_follows_bandwidth_delay_product(self):
+        pipeline = RequestPipeline(5, 250)
+        # 100 blocks per second with a round-trip time of 200 ms
+        for i in range(1000):
+            pipeline.sent(0, i * REQUEST_SIZE, now=i * 0.01)
+            pipeline.received(0, i * REQUEST_SIZE, REQUEST_SIZE, now=i * 0.01 + 0.2)
+        # Twice the bandwidth-delay product of 20 blocks
+        self.assertAlmostEqual(pipeline.rtt, 0.2)
+        self.assertEqual(pipeline.depth, 40)
+
+    def test_depth_is_bounded(self):
+        pipeline = RequestPipeline(5, 10)
+        for i in range(101):
+            pipeline.sent(0, i * REQUEST_SIZE, now=i * 0.01)
+            pipeline.received(0, i * REQUEST_SIZE, REQUEST_SIZE, now=i * 0.01 + 0.2)
+        self.assertEqual(pipeline.depth, 10)
+
+    def test_clear(self):
+        pipeline = RequestPipeline(5, 250)
+        pipeline.sent(0, 0, now=0.0)
+        pipeline.clear()
+        self.assertEqual(pipeline.free, 5)
+
 
 class HandshakeTests(unittest.TestCase):
     def test_construction(self):
@@ -44,6 +399,16 @@ class HandshakeTests(unittest.TestCase):
         self.assertEqual(b"-qB3200-iTiX3rvfzMpr", handshake.peer_id)
 
 
+class BitFieldTests(unittest.TestCase):
+    def test_round_trip(self):
+        message = BitField(b"\xa0\x01").encode()
+        self.assertEqual(message, b"\x00\x00\x00\x03\x05\xa0\x01")
+        self.assertEqual(BitField.decode(message).bitfield.tobytes(), b"\xa0\x01")
+
+    def test_choke_messages(self):
+        self.assertEqual(Unchoke().encode(), b"\x00\x00\x00\x01\x01")
+
+
 class HaveMessageTests(unittest.TestCase):
     def test_can_construct_have(self):
         have = Have(33)
@@ -0,0 +1,79 @@
+import os
+import tempfile
+import unittest
+
+from . import FakeTorrent, no_logging
+from yufka.bencoding import Encoder
+from yufka.resume import FastResume
+
+
+class FastResumeTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.torrent = FakeTorrent(
+            os.path.join(self.directory.name, "output"), bytes(10), piece_length=1
+        )
+        with open(self.torrent.output_file, "wb") as f:
+            f.write(b"data")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_no_resume_file(self):
+        self.assertIsNone(FastResume(self.torrent).load())
+
+    def test_no_output_file(self):
+        FastResume(self.torrent).save([1])
+        os.remove(self.torrent.output_file)
+        self.assertIsNone(FastResume(self.torrent).load())
+
+    def test_round_trip(self):
+        FastResume(self.torrent).save([0, 3, 9])
+        state = FastResume(self.torrent).load()
+        self.assertEqual(state.pieces, [0, 3, 9])
+        self.assertTrue(state.verified)
+
+    def test_modified_output_file(self):
+        FastResume(self.torrent).save([2])
+        stat = os.stat(self.torrent.output_file)
+        os.utime(self.torrent.output_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        state = FastResume(self.torrent).load()
+        self.assertEqual(state.pieces, [2])
+        self.assertFalse(state.verified)
+
+    def test_other_torrent(self):
+        FastResume(self.torrent).save([2])
+        other = FakeTorrent(
+            self.torrent.output_file, bytes(10), piece_length=1, info_hash=b"\x02" * 20
+        )
+        with no_logging:
+            self.assertIsNone(FastResume(other).load())
+
+    def test_invalid_resume_file(self):
+        resume = FastResume(self.torrent)
+        with open(resume.path, "wb") as f:
+            f.write(b"d4:spami1ee")
+        with no_logging:
+            self.assertIsNone(resume.load())
+
+    def test_truncated_resume_file(self):
+        resume = FastResume(self.torrent)
+        for data in [b"d4:info", b"", b"d4:info5:x", b"di1e"]:
+            with open(resume.path, "wb") as f:
+                f.write(data)
+            with no_logging:
+                self.assertIsNone(resume.load())
+
+    def test_invalid_field_types(self):
+        resume = FastResume(self.torrent)
+        fields = {
+            b"info hash": self.torrent.info_hash,
+            b"mtime": 0,
+            b"pieces": b"\xff",
+            b"size": 4,
+        }
+        for key, value in [(b"pieces", 5), (b"pieces", [1]), (b"size", b"4")]:
+            with open(resume.path, "wb") as f:
+                Encoder({**fields, key: value}).encode_to(f)
+            with no_logging:
+                self.assertIsNone(resume.load())
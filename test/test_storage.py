@@ -0,0 +1,98 @@
+import os
+import tempfile
+import unittest
+
+from . import FakeTorrent
+from yufka.storage import Storage
+from yufka.torrent import TorrentFile
+
+
+class StorageTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "output")
+        self.storage = Storage(FakeTorrent(self.path, bytes(100), 32))
+
+    def tearDown(self):
+        self.storage.close()
+        self.directory.cleanup()
+
+    def test_preallocates_file(self):
+        self.assertEqual(os.path.getsize(self.path), 100)
+
+    def test_write_block_at_piece_offset(self):
+        self.storage.write(1, 4, memoryview(b"spam"))
+        self.storage.close()
+        with open(self.path, "rb") as f:
+            data = f.read()
+        self.assertEqual(data[36:40], b"spam")
+        self.assertEqual(data.count(0), 96)
+
+    def test_write_beyond_size(self):
+        with self.assertRaises(ValueError):
+            self.storage.write(3, 2, b"spam")
+
+    def test_read_piece(self):
+        self.storage.write(3, 0, b"x" * 4)
+        with self.storage.piece(3) as data:
+            self.assertEqual(data, b"x" * 4)
+        with self.storage.read(0, 30, 4) as data:
+            self.assertEqual(data, b"\x00" * 4)
+
+    def test_keeps_existing_data(self):
+        self.storage.write(0, 0, b"eggs")
+        self.storage.close()
+        self.storage = Storage(FakeTorrent(self.path, bytes(100), 32))
+        with self.storage.read(0, 0, 4) as data:
+            self.assertEqual(data, b"eggs")
+
+    def test_empty_torrent(self):
+        storage = Storage(FakeTorrent(self.path + "-empty", b"", 32))
+        storage.close()
+        self.assertEqual(os.path.getsize(self.path + "-empty"), 0)
+
+
+class MultiFileTorrent(FakeTorrent):
+    def __init__(self, output_file, piece_length):
+        self.output_file = output_file
+        self.piece_length = piece_length
+        self.multi_file = True
+        self.files = [
+            TorrentFile("a", 10),
+            TorrentFile("empty", 0),
+            TorrentFile(os.path.join("sub", "b"), 15),
+        ]
+        self.total_size = 25
+
+
+class MultiFileStorageTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "output")
+        self.storage = Storage(MultiFileTorrent(self.path, 8))
+
+    def tearDown(self):
+        self.storage.close()
+        self.directory.cleanup()
+
+    def test_creates_files(self):
+        self.assertEqual(os.path.getsize(os.path.join(self.path, "a")), 10)
+        self.assertEqual(os.path.getsize(os.path.join(self.path, "empty")), 0)
+        self.assertEqual(os.path.getsize(os.path.join(self.path, "sub", "b")), 15)
+
+    def test_write_across_files(self):
+        self.storage.write(1, 0, b"abcdefgh")
+        self.storage.close()
+        with open(os.path.join(self.path, "a"), "rb") as f:
+            self.assertEqual(f.read()[8:], b"ab")
+        with open(os.path.join(self.path, "sub", "b"), "rb") as f:
+            self.assertEqual(f.read()[:6], b"cdefgh")
+
+    def test_read_across_files(self):
+        self.storage.write(1, 0, b"abcdefgh")
+        with self.storage.piece(1) as data:
+            self.assertEqual(data, b"abcdefgh")
+        with self.storage.read(1, 2, 3) as data:
+            self.assertEqual(data, b"cde")
+        with self.storage.piece(3) as data:
+            self.assertEqual(data, b"\x00")
@@ -0,0 +1,212 @@
+import copy
+import os
+import tempfile
+import unittest
+from hashlib import sha1
+
+from . import no_logging
+from yufka.bencoding import Encoder
+from yufka.cache import MetadataCache
+from yufka.torrent import FileIndex, Torrent, TorrentFile
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+UBUNTU = os.path.join(DATA, "ubuntu-23.04-desktop-amd64.iso.torrent")
+
+MULTI_FILE_INFO = {
+    b"name": b"season",
+    b"piece length": 16,
+    b"pieces": b"a" * 40,
+    b"files": [
+        {b"length": 10, b"path": [b"e01.mkv"]},
+        {b"length": 0, b"path": [b"empty"]},
+        {b"length": 15, b"path": [b"extras", b"e01.srt"]},
+    ],
+}
+
+
+class TorrentTests(unittest.TestCase):
+    def setUp(self):
+        self.torrent = Torrent(UBUNTU)
+
+    def test_info_hash(self):
+        self.assertEqual(
+            self.torrent.info_hash.hex(), "443c7602b4fde83d1154d6d9da48808418b181b6"
+        )
+
+    def test_single_file(self):
+        self.assertFalse(self.torrent.multi_file)
+        self.assertEqual(self.torrent.output_file, "ubuntu-23.04-desktop-amd64.iso")
+        self.assertEqual(len(self.torrent.files), 1)
+
+    def test_pieces(self):
+        pieces = self.torrent.pieces
+        self.assertEqual(
+            len(pieces), -(-self.torrent.total_size // self.torrent.piece_length)
+        )
+        self.assertTrue(all(len(piece) == 20 for piece in pieces))
+
+    def test_announce_list(self):
+        self.assertEqual(
+            self.torrent.announce_list,
+            [
+                ["https://torrent.ubuntu.com/announce"],
+                ["https://ipv6.torrent.ubuntu.com/announce"],
+            ],
+        )
+
+    def test_pieces_are_cached(self):
+        self.assertIs(self.torrent.pieces, self.torrent.pieces)
+
+    def test_hash_for(self):
+        pieces = self.torrent.pieces
+        self.assertEqual(
+            pieces.hash_for(0).hex(), "f6c253a1250cb0b84e77a7fb14fe86d09e110eb9"
+        )
+        self.assertEqual(pieces[18815], list(pieces)[-1])
+        self.assertEqual(pieces.view[20:40], pieces.hash_for(1))
+        with self.assertRaises(IndexError):
+            pieces.hash_for(18816)
+
+    def test_piece_sizes(self):
+        self.assertEqual(self.torrent.piece_count, 18816)
+        self.assertEqual(self.torrent.last_piece_length, 167936)
+        self.assertEqual(self.torrent.piece_size(0), 262144)
+        self.assertEqual(self.torrent.piece_size(18815), 167936)
+
+    def test_info_hash_of_non_canonical_info(self):
+        # Keys out of order must still hash the info dict as it is stored
+        info = b"d12:piece lengthi16384e6:lengthi3e4:name1:x6:pieces20:" + b"a" * 20
+        info += b"e"
+        with tempfile.NamedTemporaryFile(suffix=".torrent", delete=False) as f:
+            f.write(b"d8:announce9:http://x/4:info" + info + b"e")
+        try:
+            torrent = Torrent(f.name)
+        finally:
+            os.remove(f.name)
+        self.assertEqual(torrent.info_hash, sha1(info).digest())
+
+
+class CachedTorrentTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = MetadataCache(os.path.join(self.directory.name, "cache"))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def assertSameMetadata(self, torrent, expected):
+        self.assertEqual(torrent.info_hash, expected.info_hash)
+        self.assertEqual(torrent.files, expected.files)
+        self.assertEqual(torrent.multi_file, expected.multi_file)
+        self.assertEqual(torrent.announce, expected.announce)
+        self.assertEqual(torrent.piece_length, expected.piece_length)
+        self.assertEqual(list(torrent.pieces), list(expected.pieces))
+
+    def test_restored_from_cache(self):
+        parsed = Torrent(UBUNTU, self.cache)
+        self.assertTrue(os.path.exists(self.cache.path(UBUNTU)))
+        cached = Torrent(UBUNTU, self.cache)
+        self.assertSameMetadata(cached, parsed)
+        self.assertNotIn(b"files", cached.meta_info[b"info"])
+
+    def test_multi_file_restored_from_cache(self):
+        path = os.path.join(self.directory.name, "multi.torrent")
+        with open(path, "wb") as f:
+            Encoder({b"announce": b"http://x/", b"info": MULTI_FILE_INFO}).encode_to(f)
+        parsed = Torrent(path, self.cache)
+        self.assertSameMetadata(Torrent(path, self.cache), parsed)
+
+    def test_changed_torrent_file_is_parsed(self):
+        path = os.path.join(self.directory.name, "x.torrent")
+        with open(path, "wb") as f:
+            Encoder({b"announce": b"http://x/", b"info": MULTI_FILE_INFO}).encode_to(f)
+        first = Torrent(path, self.cache)
+        info = {**MULTI_FILE_INFO, b"name": b"other"}
+        with open(path, "wb") as f:
+            Encoder({b"announce": b"http://x/", b"info": info}).encode_to(f)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        torrent = Torrent(path, self.cache)
+        self.assertNotEqual(torrent.info_hash, first.info_hash)
+        self.assertEqual(torrent.output_file, "other")
+
+    def test_invalid_cache_entry(self):
+        os.makedirs(self.cache.directory)
+        with open(self.cache.path(UBUNTU), "wb") as f:
+            f.write(b"d5:spam")
+        with no_logging:
+            torrent = Torrent(UBUNTU, self.cache)
+        self.assertEqual(torrent.info_hash.hex()[:8], "443c7602")
+
+
+def _write_torrent(info: dict) -> Torrent:
+    with tempfile.NamedTemporaryFile(suffix=".torrent", delete=False) as f:
+        Encoder({b"announce": b"http://x/", b"info": info}).encode_to(f)
+    try:
+        return Torrent(f.name)
+    finally:
+        os.remove(f.name)
+
+
+class MultiFileTorrentTests(unittest.TestCase):
+    def setUp(self):
+        self.info = copy.deepcopy(MULTI_FILE_INFO)
+
+    def test_files(self):
+        torrent = _write_torrent(self.info)
+        self.assertTrue(torrent.multi_file)
+        self.assertEqual(torrent.output_file, "season")
+        self.assertEqual(
+            torrent.files,
+            [
+                TorrentFile("e01.mkv", 10),
+                TorrentFile("empty", 0),
+                TorrentFile(os.path.join("extras", "e01.srt"), 15),
+            ],
+        )
+        self.assertEqual(torrent.total_size, 25)
+        self.assertEqual(torrent.last_piece_length, 9)
+        self.assertEqual(torrent.announce_list, [["http://x/"]])
+
+    def test_path_outside_directory(self):
+        self.info[b"files"][0][b"path"] = [b"..", b"passwd"]
+        with self.assertRaises(RuntimeError):
+            _write_torrent(self.info)
+
+    def test_name_outside_working_directory(self):
+        self.info[b"name"] = os.path.abspath("abs").encode()
+        with self.assertRaises(RuntimeError):
+            _write_torrent(self.info)
+
+    def test_single_file_name_outside_working_directory(self):
+        info = {
+            b"name": os.path.join("..", "..", "tmp", "pwned").encode(),
+            b"piece length": 16,
+            b"pieces": b"a" * 20,
+            b"length": 10,
+        }
+        with self.assertRaises(RuntimeError):
+            _write_torrent(info)
+        info[b"name"] = b".."
+        with self.assertRaises(RuntimeError):
+            _write_torrent(info)
+
+
+class FileIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.index = FileIndex(
+            [TorrentFile("a", 10), TorrentFile("b", 0), TorrentFile("c", 15)]
+        )
+
+    def test_within_file(self):
+        self.assertEqual(self.index.spans(12, 3), [(2, 2, 3)])
+
+    def test_across_files(self):
+        self.assertEqual(self.index.spans(8, 10), [(0, 8, 2), (2, 0, 8)])
+
+    def test_at_file_boundary(self):
+        self.assertEqual(self.index.spans(10, 2), [(2, 0, 2)])
+
+    def test_past_end(self):
+        self.assertEqual(self.index.spans(20, 10), [(2, 10, 5)])
+        self.assertEqual(self.index.spans(25, 10), [])
@@ -1,7 +1,26 @@
+import asyncio
+import time
 import unittest
 from collections import OrderedDict
 
-from yufka.tracker import _calculate_peer_id, TrackerResponse
+from aiohttp import web
+
+from . import FakeTorrent, no_logging
+from .test_udp_tracker import StandInTracker
+from yufka.tracker import (
+    _calculate_peer_id,
+    HTTPSessionPool,
+    Scraper,
+    ScrapeResult,
+    scrape_url,
+    shared_pool,
+    Tracker,
+    TrackerResponse,
+    TrackerState,
+)
+from yufka import tracker
+from yufka.bencoding import Encoder
+from yufka.udp_tracker import UDPTrackerClient
 
 
 class TrackerTests(unittest.TestCase):
@@ -47,3 +66,274 @@ class TrackerResponseTest(unittest.TestCase):
     def test_successful_response_peer_string(self):
         response = TrackerResponse(self.ok_response)
         self.assertEqual(50, len(response.peers))
+
+    def test_compact_peers(self):
+        response = TrackerResponse(
+            {b"peers": b"\x7f\x00\x00\x01\x1a\xe1\x0a\x00\x00\x02\x1a\xe2\x00"}
+        )
+        self.assertEqual(response.peers, [("127.0.0.1", 6881), ("10.0.0.2", 6882)])
+
+    def test_ipv6_peers(self):
+        response = TrackerResponse(
+            {b"peers": b"", b"peers6": b"\x00" * 15 + b"\x01\x1a\xe1"}
+        )
+        self.assertEqual(response.peers, [("::1", 6881)])
+
+    def test_dictionary_model_peers(self):
+        response = TrackerResponse(
+            {
+                b"peers": [
+                    {b"ip": b"10.0.0.1", b"peer id": b"x" * 20, b"port": 6881},
+                    {b"ip": b"tracker.example", b"port": 6882},
+                    {b"port": 6883},
+                    {b"ip": b"10.0.0.3", b"port": 70000},
+                    {b"ip": b"10.0.0.4", b"port": 0},
+                    {b"ip": b"10.0.0.5", b"port": b"6881"},
+                ]
+            }
+        )
+        with no_logging:
+            peers = response.peers
+        self.assertEqual(peers, [("10.0.0.1", 6881), ("tracker.example", 6882)])
+
+
+class AnnounceListTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.transports = []
+        self.trackers = []
+        self.live = await self.start_tracker()
+        self.dead = await self.start_tracker(drop=100)
+        self.dead_tracker = self.trackers[-1]
+
+    async def asyncTearDown(self):
+        for transport in self.transports:
+            transport.close()
+
+    async def start_tracker(self, drop: int = 0) -> str:
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: StandInTracker(drop), local_addr=("127.0.0.1", 0)
+        )
+        self.transports.append(transport)
+        self.trackers.append(protocol)
+        return "udp://127.0.0.1:{}".format(transport.get_extra_info("sockname")[1])
+
+    async def connect(self, announce_list):
+        tracker = Tracker(FakeTorrent(data=bytes(100), announce_list=announce_list))
+        tracker.udp_client = UDPTrackerClient(timeout=0.05, max_retries=1)
+        try:
+            return tracker, await tracker.connect(first=True)
+        finally:
+            await tracker.close()
+
+    async def test_first_responder_wins_and_is_promoted(self):
+        tracker, response = await self.connect([[self.dead, self.live]])
+        self.assertEqual(response.interval, 1800)
+        self.assertEqual(tracker.tiers[0][0].url, self.live)
+
+    async def test_next_tier_after_failing_tier(self):
+        with no_logging:
+            tracker, response = await self.connect(
+                [["wss://127.0.0.1/announce", self.dead], [self.live]]
+            )
+        self.assertEqual(response.interval, 1800)
+        self.assertEqual([state.failures for state in tracker.tiers[0]], [1, 1])
+
+    async def test_backed_off_tracker_is_skipped(self):
+        announcer = Tracker(
+            FakeTorrent(data=bytes(100), announce_list=[[self.dead], [self.live]])
+        )
+        announcer.udp_client = UDPTrackerClient(timeout=10, max_retries=1)
+        announcer.tiers[0][0].failed()
+        try:
+            response = await asyncio.wait_for(announcer.connect(), 1)
+        finally:
+            await announcer.close()
+        self.assertEqual(response.interval, 1800)
+        self.assertEqual(self.dead_tracker.requests, [])
+
+    async def test_next_tier_while_tier_stalls(self):
+        announcer = Tracker(
+            FakeTorrent(data=bytes(100), announce_list=[[self.dead], [self.live]])
+        )
+        announcer.udp_client = UDPTrackerClient(timeout=10, max_retries=1)
+        delay = tracker.TIER_DELAY
+        tracker.TIER_DELAY = 0.05
+        try:
+            response = await asyncio.wait_for(announcer.connect(), 1)
+        finally:
+            tracker.TIER_DELAY = delay
+            await announcer.close()
+        self.assertEqual(response.interval, 1800)
+        self.assertNotEqual(self.dead_tracker.requests, [])
+
+    async def test_announce_from_completed_client(self):
+        announcer = Tracker(FakeTorrent(data=bytes(100), announce_list=[[self.live]]))
+        announcer.udp_client = UDPTrackerClient(timeout=0.05, max_retries=1)
+        try:
+            response = await announcer.connect(uploaded=10, downloaded=128)
+        finally:
+            await announcer.close()
+        self.assertEqual(response.interval, 1800)
+        # The downloaded, left and uploaded bytes
+        self.assertEqual(self.trackers[0].announces[0][2:5], (128, 0, 10))
+
+    async def test_all_trackers_fail(self):
+        with no_logging:
+            with self.assertRaises(ConnectionError):
+                await self.connect([[self.dead]])
+
+    def test_failed_tracker_is_tried_last(self):
+        healthy = TrackerState("udp://a:1")
+        failed = TrackerState("udp://b:1")
+        failed.failed()
+        now = time.monotonic()
+        tier = sorted([failed, healthy], key=lambda state: state.score(now))
+        self.assertEqual(tier, [healthy, failed])
+        self.assertGreater(failed.retry_at, now)
+
+
+class HTTPSessionPoolTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.clients = []
+
+        async def announce(request):
+            # Reports the client's address to tell connections apart
+            host, port = request.transport.get_extra_info("peername")[:2]
+            self.clients.append(port)
+            return web.Response(body=b"d8:intervali900e5:peers0:e")
+
+        async def malformed(request):
+            return web.Response(body=b"d8:intervali900e5:peersi1ee")
+
+        app = web.Application()
+        app.router.add_get("/announce", announce)
+        app.router.add_get("/malformed", malformed)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = "http://127.0.0.1:{}/announce".format(port)
+        self.pool = HTTPSessionPool()
+
+    async def asyncTearDown(self):
+        await self.pool.close()
+        await self.runner.cleanup()
+
+    async def test_connection_is_reused_across_trackers(self):
+        for _ in range(2):
+            tracker = Tracker(
+                FakeTorrent(data=bytes(100), announce_list=[[self.url]]), self.pool
+            )
+            response = await tracker.connect()
+            await tracker.close()
+            self.assertEqual(response.interval, 900)
+        self.assertEqual(len(self.clients), 2)
+        self.assertEqual(self.clients[0], self.clients[1])
+
+    async def test_malformed_response_fails_the_tracker(self):
+        url = self.url.replace("/announce", "/malformed")
+        tracker = Tracker(
+            FakeTorrent(data=bytes(100), announce_list=[[url]]), self.pool
+        )
+        try:
+            with no_logging:
+                with self.assertRaises(ConnectionError):
+                    await tracker.connect()
+        finally:
+            await tracker.close()
+        self.assertEqual(tracker.tiers[0][0].failures, 1)
+
+    async def test_session_is_reused(self):
+        session = self.pool.session()
+        self.assertIs(self.pool.session(), session)
+        self.assertFalse(session.closed)
+        self.assertEqual(session.connector.limit_per_host, self.pool.limit_per_host)
+
+    def test_shared_pool(self):
+        self.assertIs(shared_pool(), shared_pool())
+        self.assertIs(
+            Tracker(FakeTorrent(data=bytes(100), announce_list=[])).http_pool,
+            shared_pool(),
+        )
+
+
+class ScrapeTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.requests = []
+
+        async def scrape(request):
+            info_hashes = [
+                value.encode("latin-1") for value in request.query.getall("info_hash")
+            ]
+            self.requests.append(info_hashes)
+            files = {
+                info_hash: {b"complete": 1, b"downloaded": 2, b"incomplete": 3}
+                for info_hash in info_hashes
+                if info_hash != b"u" * 20
+            }
+            return web.Response(body=bytes(Encoder({b"files": files}).encode()))
+
+        app = web.Application()
+        app.router.add_get("/tracker/scrape", scrape)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = "http://127.0.0.1:{}/tracker/announce".format(port)
+
+        loop = asyncio.get_running_loop()
+        self.transport, self.udp_tracker = await loop.create_datagram_endpoint(
+            StandInTracker, local_addr=("127.0.0.1", 0)
+        )
+        self.udp_url = "udp://127.0.0.1:{}".format(
+            self.transport.get_extra_info("sockname")[1]
+        )
+
+        self.pool = HTTPSessionPool()
+        self.scraper = Scraper(self.pool, UDPTrackerClient(timeout=0.05, max_retries=1))
+
+    async def asyncTearDown(self):
+        await self.scraper.close()
+        await self.pool.close()
+        await self.runner.cleanup()
+        self.transport.close()
+
+    def test_scrape_url(self):
+        self.assertEqual(
+            scrape_url("http://example.com/announce"), "http://example.com/scrape"
+        )
+        self.assertEqual(
+            scrape_url("http://example.com/x/announce.php?key=1"),
+            "http://example.com/x/scrape.php?key=1",
+        )
+        self.assertIsNone(scrape_url("http://example.com/a"))
+        self.assertIsNone(scrape_url("http://example.com/announce/x"))
+
+    async def test_http_scrape_in_batches(self):
+        info_hashes = [i.to_bytes(20, "big") for i in range(120)]
+        results = await self.scraper.scrape(self.url, info_hashes + info_hashes[:1])
+        self.assertEqual(
+            [len(batch) for batch in self.requests],
+            [tracker.MAX_HTTP_SCRAPE_HASHES] * 2 + [20],
+        )
+        self.assertEqual(len(results), 120)
+        self.assertEqual(results[info_hashes[-1]], ScrapeResult(1, 2, 3))
+
+    async def test_http_scrape_leaves_out_unknown_torrents(self):
+        results = await self.scraper.scrape(self.url, [b"a" * 20, b"u" * 20])
+        self.assertEqual(list(results), [b"a" * 20])
+
+    async def test_http_tracker_without_scrape(self):
+        with self.assertRaises(ConnectionError):
+            await self.scraper.scrape(self.url.replace("announce", "a"), [b"a" * 20])
+
+    async def test_udp_scrape(self):
+        info_hashes = [i.to_bytes(20, "big") for i in range(100)]
+        results = await self.scraper.scrape(self.udp_url, info_hashes)
+        self.assertEqual(self.udp_tracker.requests.count(2), 2)
+        self.assertEqual(results[info_hashes[0]], ScrapeResult(0, 1, 2))
+        self.assertEqual(results[info_hashes[99]], ScrapeResult(25, 26, 27))
+        self.assertEqual(results[info_hashes[99]].leechers, 27)
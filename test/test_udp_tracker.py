@@ -0,0 +1,160 @@
+import asyncio
+import struct
+import unittest
+
+from . import FakeTorrent
+from yufka import udp_tracker
+from yufka.tracker import Tracker
+from yufka.udp_tracker import UDPTrackerClient
+
+PEERS = bytes([127, 0, 0, 1, 0x1A, 0xE1, 10, 0, 0, 2, 0x1A, 0xE2])
+
+
+class StandInTracker(asyncio.DatagramProtocol):
+    """
+    A local UDP tracker answering connect, announce and scrape requests.
+    The first `drop` requests are ignored to test retransmission.
+    """
+
+    def __init__(self, drop: int = 0):
+        self.drop = drop
+        self.requests = []
+        # The fields of the announce requests received
+        self.announces = []
+        self.connection_ids = set()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        connection_id, action, transaction_id = struct.unpack_from(">QII", data)
+        self.requests.append(action)
+        if self.drop:
+            self.drop -= 1
+            return
+
+        header = struct.pack(">II", action, transaction_id)
+        if action == udp_tracker.ACTION_CONNECT:
+            assert connection_id == udp_tracker.PROTOCOL_ID
+            new_id = len(self.connection_ids) + 1000
+            self.connection_ids.add(new_id)
+            response = header + struct.pack(">Q", new_id)
+        elif connection_id not in self.connection_ids:
+            response = struct.pack(">II", 3, transaction_id) + b"Invalid connection"
+        elif action == udp_tracker.ACTION_ANNOUNCE:
+            fields = udp_tracker.ANNOUNCE.unpack_from(data, 16)
+            self.announces.append(fields)
+            # Reports the event as the number of leechers
+            response = header + struct.pack(">III", 1800, fields[5], 7) + PEERS
+        elif action == udp_tracker.ACTION_SCRAPE:
+            count = (len(data) - 16) // 20
+            response = header + b"".join(
+                struct.pack(">III", i, i + 1, i + 2) for i in range(count)
+            )
+        self.transport.sendto(response, address)
+
+
+class UDPTrackerTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await self.start_tracker()
+        self.client = UDPTrackerClient(timeout=0.05, max_retries=2)
+
+    async def start_tracker(self, drop: int = 0):
+        loop = asyncio.get_running_loop()
+        self.transport, self.tracker = await loop.create_datagram_endpoint(
+            lambda: StandInTracker(drop), local_addr=("127.0.0.1", 0)
+        )
+        self.port = self.transport.get_extra_info("sockname")[1]
+
+    async def asyncTearDown(self):
+        self.client.close()
+        self.transport.close()
+
+    async def announce(self, event=None):
+        return await self.client.announce(
+            "127.0.0.1", self.port, b"i" * 20, b"p" * 20, left=10, event=event
+        )
+
+    async def test_announce(self):
+        response = await self.announce("started")
+        self.assertEqual(response[b"interval"], 1800)
+        self.assertEqual(response[b"complete"], 7)
+        self.assertEqual(response[b"incomplete"], 2)
+        self.assertEqual(response[b"peers"], PEERS)
+
+    async def test_single_socket_for_concurrent_requests(self):
+        transports = []
+        connection_made = self.client.connection_made
+
+        def count(transport):
+            transports.append(transport)
+            connection_made(transport)
+
+        self.client.connection_made = count
+        results = await asyncio.gather(self.announce(), self.announce())
+        self.assertEqual(len(transports), 1)
+        self.assertEqual([r[b"interval"] for r in results], [1800, 1800])
+
+    async def test_connection_id_is_reused(self):
+        await self.announce()
+        await self.announce()
+        self.assertEqual(
+            self.tracker.requests,
+            [
+                udp_tracker.ACTION_CONNECT,
+                udp_tracker.ACTION_ANNOUNCE,
+                udp_tracker.ACTION_ANNOUNCE,
+            ],
+        )
+
+    async def test_expired_connection_id(self):
+        await self.announce()
+        for address, (connection_id, _) in list(self.client._connections.items()):
+            self.client._connections[address] = (connection_id, 0)
+        await self.announce()
+        self.assertEqual(self.tracker.requests.count(udp_tracker.ACTION_CONNECT), 2)
+
+    async def test_retransmission(self):
+        self.transport.close()
+        await self.start_tracker(drop=2)
+        response = await self.announce()
+        self.assertEqual(response[b"interval"], 1800)
+        self.assertEqual(len(self.tracker.requests), 4)
+
+    async def test_no_response(self):
+        self.transport.close()
+        await self.start_tracker(drop=100)
+        with self.assertRaises(ConnectionError):
+            await self.announce()
+        # The initial request and two retransmissions
+        self.assertEqual(len(self.tracker.requests), 3)
+
+    async def test_tracker_error(self):
+        await self.announce()
+        self.tracker.connection_ids.clear()
+        with self.assertRaises(ConnectionError):
+            await self.announce()
+        # A new connection id is requested after the error
+        await self.announce()
+        self.assertEqual(self.tracker.requests.count(udp_tracker.ACTION_CONNECT), 2)
+
+    async def test_scrape_in_batches(self):
+        hashes = [bytes([i]) * 20 for i in range(100)]
+        results = await self.client.scrape("127.0.0.1", self.port, hashes)
+        self.assertEqual(len(results), 100)
+        self.assertEqual(results[0], (0, 1, 2))
+        self.assertEqual(results[74], (0, 1, 2))
+        self.assertEqual(results[99], (25, 26, 27))
+        self.assertEqual(self.tracker.requests.count(udp_tracker.ACTION_SCRAPE), 2)
+
+    async def test_tracker_announces_over_udp(self):
+        announce = "udp://127.0.0.1:{}/announce".format(self.port)
+        tracker = Tracker(FakeTorrent(data=bytes(100), announce_list=[[announce]]))
+        tracker.udp_client = self.client
+        try:
+            response = await tracker.connect(first=True)
+        finally:
+            await tracker.close()
+        self.assertEqual(response.peers, [("127.0.0.1", 6881), ("10.0.0.2", 6882)])
+        self.assertEqual(response.incomplete, 2)
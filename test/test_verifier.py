@@ -0,0 +1,123 @@
+import os
+import tempfile
+import unittest
+from hashlib import sha1
+
+from . import FakeTorrent
+from yufka.storage import Storage
+from yufka.torrent import TorrentFile
+from yufka.verifier import PieceVerifier, check_file, piece_hash
+
+
+class PieceVerifierTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, "output")
+        self.storage = Storage(FakeTorrent(path, bytes(100), 64))
+        self.storage.write(0, 0, b"a" * 64)
+        self.storage.write(1, 0, b"b" * 36)
+        self.verifier = PieceVerifier(self.storage, max_workers=2, max_pending=2)
+
+    def tearDown(self):
+        self.verifier.close()
+        self.storage.close()
+        self.directory.cleanup()
+
+    def test_piece_hash(self):
+        self.assertEqual(piece_hash(self.storage, 1), sha1(b"b" * 36).digest())
+
+    async def test_verify(self):
+        matching = self.verifier.verify(0, sha1(b"a" * 64).digest())
+        corrupt = self.verifier.verify(1, sha1(b"a" * 36).digest())
+        self.assertTrue(self.verifier.saturated)
+        self.assertTrue(await matching)
+        self.assertFalse(await corrupt)
+        await self.verifier.drain()
+        self.assertEqual(len(self.verifier), 0)
+
+    async def test_drain(self):
+        future = self.verifier.verify(1, sha1(b"b" * 36).digest())
+        await self.verifier.drain()
+        self.assertTrue(future.done())
+        self.assertFalse(self.verifier.saturated)
+
+
+class CheckFileTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "output")
+        self.data = os.urandom(10 * 64 + 5)
+        with open(self.path, "wb") as f:
+            f.write(self.data)
+        self.torrent = FakeTorrent(self.path, self.data, 64)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_valid_file(self):
+        checked = []
+        result = check_file(self.torrent, self.path, 2, checked.append)
+        self.assertEqual(result.pieces, 11)
+        self.assertEqual(result.bad, [])
+        self.assertEqual(result.size, len(self.data))
+        self.assertEqual(checked[-1], len(self.data))
+
+    def test_corrupt_pieces(self):
+        with open(self.path, "r+b") as f:
+            f.seek(64 * 3 + 10)
+            f.write(b"x")
+            f.seek(64 * 10)
+            f.write(b"x")
+        result = check_file(self.torrent, self.path, 2)
+        self.assertEqual(result.bad, [3, 10])
+
+    def test_truncated_file(self):
+        os.truncate(self.path, 64 * 8 + 1)
+        result = check_file(self.torrent, self.path, 2)
+        self.assertEqual(result.bad, [8, 9, 10])
+        self.assertEqual(result.size, 64 * 8)
+
+    def test_empty_file(self):
+        os.truncate(self.path, 0)
+        result = check_file(self.torrent, self.path, 2)
+        self.assertEqual(result.bad, list(range(11)))
+        self.assertEqual(result.size, 0)
+
+    def test_missing_path(self):
+        os.remove(self.path)
+        with self.assertRaises(FileNotFoundError):
+            check_file(self.torrent, self.path, 2)
+
+
+class CheckMultiFileTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "output")
+        os.mkdir(self.path)
+        self.data = os.urandom(100)
+        self.torrent = FakeTorrent(self.path, self.data, 16)
+        self.torrent.multi_file = True
+        self.torrent.files = [TorrentFile("a", 30), TorrentFile("b", 70)]
+        with open(os.path.join(self.path, "a"), "wb") as f:
+            f.write(self.data[:30])
+        with open(os.path.join(self.path, "b"), "wb") as f:
+            f.write(self.data[30:])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_valid_files(self):
+        result = check_file(self.torrent, self.path, 2)
+        self.assertEqual(result.bad, [])
+        self.assertEqual(result.size, 100)
+
+    def test_missing_file(self):
+        os.remove(os.path.join(self.path, "a"))
+        result = check_file(self.torrent, self.path, 2)
+        self.assertEqual(result.bad, [0, 1])
+        self.assertEqual(result.size, 70 - 2)
+
+    def test_truncated_file(self):
+        os.truncate(os.path.join(self.path, "a"), 20)
+        result = check_file(self.torrent, self.path, 2)
+        self.assertEqual(result.bad, [1])
@@ -1,55 +1,122 @@
 from collections import OrderedDict
 
-
 TOKEN_INTEGER = b"i"
 TOKEN_LIST = b"l"
 TOKEN_DICT = b"d"
 TOKEN_END = b"e"
 TOKEN_STRING_SEPARATOR = b":"
 
+# The token byte values compared by the decoder
+_INTEGER = TOKEN_INTEGER[0]
+_LIST = TOKEN_LIST[0]
+_DICT = TOKEN_DICT[0]
+_END = TOKEN_END[0]
+_DIGIT_0 = ord("0")
+_DIGIT_9 = ord("9")
+
+# Marks a dict being decoded that awaits its next key
+_NO_KEY = object()
+
 
 class Decoder:
-    def __init__(self, data: bytes):
+    """
+    Decodes bencoded data.
+
+    The decoder walks the data with an explicit stack instead of recursion,
+    so the nesting depth is not limited by the recursion limit. Tokens are
+    compared as integer byte values and dicts are decoded to plain `dict`.
+
+    With `views` set, byte string values are returned as `memoryview` slices
+    of the data instead of copies (dict keys are always `bytes`).
+    """
+
+    def __init__(self, data: bytes, views: bool = False):
         if not isinstance(data, bytes):
             raise TypeError("data must be bytes")
         self._data = data
         self._index = 0
+        self._views = views
+        # The byte span (start, end) of each value of the top-level dict,
+        # e.g. allowing the info hash to be calculated over the original
+        # bytes of the info dict.
+        self.spans = {}
 
     def decode(self):
-        c = self._peek()
-        if c is None:
+        if self._peek() is None:
             raise EOFError("Unexpected end-of-file")
-        elif c == TOKEN_INTEGER:
-            self._consume()
-            return self._decode_int()
-        elif c == TOKEN_LIST:
-            self._consume()
-            return self._decode_list()
-        elif c == TOKEN_DICT:
-            self._consume()
-            return self._decode_dict()
-        elif c in b"01234567899":
-            return self._decode_string()
-        elif c == TOKEN_END:
-            return None
-        else:
-            raise RuntimeError("Unknown token")
 
-    def _peek(self):
-        if self._index + 1 >= len(self._data):
-            return None
-        return self._data[self._index : self._index + 1]
+        data = self._data
+        view = memoryview(data) if self._views else data
+        length = len(data)
+        index = self._index
+        # Each entry is [container, start, key] for a list or dict being
+        # decoded, where key is _NO_KEY while a dict awaits its next key
+        stack = []
 
-    def _consume(self):
-        self._index += 1
+        while True:
+            if index >= length:
+                raise EOFError("Unexpected end-of-file")
+            start = index
+            c = data[index]
+
+            if c == _INTEGER:
+                end = data.find(TOKEN_END, index + 1)
+                if end == -1:
+                    raise RuntimeError("Token not found")
+                value = int(data[index + 1 : end])
+                index = end + 1
+            elif _DIGIT_0 <= c <= _DIGIT_9:
+                separator = data.find(TOKEN_STRING_SEPARATOR, index + 1)
+                if separator == -1:
+                    raise RuntimeError("Token not found")
+                index = separator + 1 + int(data[start:separator])
+                if index > length:
+                    raise IndexError("Not enough data")
+                if stack and stack[-1][2] is _NO_KEY:
+                    value = data[separator + 1 : index]
+                else:
+                    value = view[separator + 1 : index]
+            elif c == _LIST:
+                stack.append([[], start, None])
+                index += 1
+                continue
+            elif c == _DICT:
+                stack.append([{}, start, _NO_KEY])
+                index += 1
+                continue
+            elif c == _END:
+                if not stack:
+                    self._index = index
+                    return None
+                value, start, key = stack.pop()
+                if key is not None and key is not _NO_KEY:
+                    raise EOFError("Missing value for dict key")
+                index += 1
+            else:
+                raise RuntimeError("Unknown token")
 
-    def _read(self, length: int) -> bytes:
-        if self._index + length > len(self._data):
-            raise IndexError("Not enough data")
+            if not stack:
+                self._index = index
+                return value
 
-        res = self._data[self._index : self._index + length]
-        self._index += length
-        return res
+            frame = stack[-1]
+            key = frame[2]
+            if key is None:
+                frame[0].append(value)
+            elif key is _NO_KEY:
+                if type(value) is not bytes:
+                    raise RuntimeError("Dict keys must be strings")
+                frame[2] = value
+            else:
+                frame[0][key] = value
+                frame[2] = _NO_KEY
+                if len(stack) == 1:
+                    self.spans[key] = (start, index)
+
+    def _peek(self):
+        if self._index >= len(self._data):
+            return None
+        return self._data[self._index : self._index + 1]
 
     def _read_until(self, token: bytes) -> bytes:
         try:
@@ -60,80 +127,333 @@ class Decoder:
         except ValueError:
             raise RuntimeError("Token not found")
 
-    def _decode_int(self):
-        return int(self._read_until(TOKEN_END))
 
-    def _decode_string(self):
-        bytes_to_read = int(self._read_until(TOKEN_STRING_SEPARATOR))
-        return self._read(bytes_to_read)
+class _StreamTokenizer:
+    """
+    Splits bencoded data fed in chunks into tokens, keeping only the data
+    of the token not yet complete between chunks.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._depth = 0
+        self.done = False
+
+    def _tokens(self, data):
+        """
+        Adds the chunk to the buffered data and yields the completed tokens as
+        (token, value) pairs, where token is the byte value of the token and
+        value the decoded integer or byte string (else None).
+        """
+        if self.done:
+            if data:
+                raise RuntimeError("Unexpected data after the end of the value")
+            return
+        buffer = self._buffer
+        buffer += data
+        length = len(buffer)
+        view = memoryview(buffer)
+        index = 0
+
+        try:
+            while index < length:
+                c = buffer[index]
+                value = None
+                if c == _INTEGER:
+                    end = buffer.find(TOKEN_END, index + 1)
+                    if end == -1:
+                        break
+                    value = int(buffer[index + 1 : end])
+                    index = end + 1
+                elif _DIGIT_0 <= c <= _DIGIT_9:
+                    separator = buffer.find(TOKEN_STRING_SEPARATOR, index + 1)
+                    if separator == -1:
+                        break
+                    end = separator + 1 + int(buffer[index:separator])
+                    if end > length:
+                        break
+                    value = bytes(view[separator + 1 : end])
+                    index = end
+                elif c == _LIST or c == _DICT:
+                    self._depth += 1
+                    index += 1
+                elif c == _END:
+                    if not self._depth:
+                        raise RuntimeError("Unexpected end of a list or dict")
+                    self._depth -= 1
+                    index += 1
+                else:
+                    raise RuntimeError("Unknown token")
+
+                if not self._depth:
+                    self.done = True
+                    if index < length:
+                        raise RuntimeError("Unexpected data after the end of the value")
+                yield c, value
+        finally:
+            # The buffer cannot be resized while it is viewed
+            view.release()
+            del buffer[:index]
+
+    def _check_done(self):
+        if not self.done:
+            raise EOFError("Unexpected end-of-file")
+
+
+class StreamDecoder(_StreamTokenizer):
+    """
+    Decodes bencoded data incrementally, e.g. the body of an HTTP response
+    as its chunks are received.
+
+    decoder = StreamDecoder()
+    for chunk in chunks:
+        decoder.feed(chunk)
+    value = decoder.close()
+    """
+
+    def __init__(self):
+        super().__init__()
+        # Each entry is [container, key] like for the `Decoder`
+        self._stack = []
+        self.result = None
+
+    def feed(self, data) -> bool:
+        """
+        Decodes the next chunk of data.
+
+        :param data: The chunk, any object supporting the buffer protocol
+        :return True once the complete value has been decoded
+        """
+        stack = self._stack
+        for token, value in self._tokens(data):
+            if token == _LIST:
+                stack.append([[], None])
+                continue
+            elif token == _DICT:
+                stack.append([{}, _NO_KEY])
+                continue
+            elif token == _END:
+                value, key = stack.pop()
+                if key is not None and key is not _NO_KEY:
+                    raise EOFError("Missing value for dict key")
+
+            if not stack:
+                self.result = value
+                continue
+            frame = stack[-1]
+            key = frame[1]
+            if key is None:
+                frame[0].append(value)
+            elif key is _NO_KEY:
+                if type(value) is not bytes:
+                    raise RuntimeError("Dict keys must be strings")
+                frame[1] = value
+            else:
+                frame[0][key] = value
+                frame[1] = _NO_KEY
+        return self.done
 
-    def _decode_list(self):
-        res = []
-        while self._data[self._index : self._index + 1] != TOKEN_END:
-            res.append(self.decode())
-        self._consume()
-        return res
+    def close(self):
+        """
+        Signals the end of the data.
 
-    def _decode_dict(self):
-        res = OrderedDict()
-        while self._data[self._index : self._index + 1] != TOKEN_END:
-            key = self.decode()
-            obj = self.decode()
-            res[key] = obj
-        self._consume()
-        return res
+        :return The decoded value
+        """
+        self._check_done()
+        return self.result
+
+
+class EventDecoder(_StreamTokenizer):
+    """
+    Decodes bencoded data incrementally into events, without building the
+    decoded lists and dicts.
+
+    Each event is a (path, value) pair for an integer or byte string, or an
+    empty list or dict, where the path is the tuple of dict keys and list
+    indices leading to the value. E.g. `d5:filesl3:abceee` results in the
+    single event `((b"files", 0), b"abc")`.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # Each entry is [key, empty] for a list or dict being decoded, where
+        # key is the index of the next list item, _NO_KEY while a dict awaits
+        # its next key or the key of the dict value being decoded
+        self._stack = []
+
+    def feed(self, data) -> list:
+        """
+        Decodes the next chunk of data.
+
+        :param data: The chunk, any object supporting the buffer protocol
+        :return The list of events completed by the chunk
+        """
+        stack = self._stack
+        events = []
+        for token, value in self._tokens(data):
+            if token == _LIST or token == _DICT:
+                if stack:
+                    stack[-1][1] = False
+                stack.append([0 if token == _LIST else _NO_KEY, True])
+                continue
+            elif token == _END:
+                key, empty = stack.pop()
+                if type(key) is bytes:
+                    raise EOFError("Missing value for dict key")
+                if empty:
+                    events.append(
+                        (
+                            tuple(frame[0] for frame in stack),
+                            {} if key is _NO_KEY else [],
+                        )
+                    )
+            elif stack and stack[-1][0] is _NO_KEY:
+                if type(value) is not bytes:
+                    raise RuntimeError("Dict keys must be strings")
+                stack[-1][0] = value
+                continue
+            else:
+                events.append((tuple(frame[0] for frame in stack), value))
+
+            if stack:
+                frame = stack[-1]
+                frame[0] = frame[0] + 1 if type(frame[0]) is int else _NO_KEY
+                frame[1] = False
+        return events
+
+    def close(self):
+        """
+        Signals the end of the data.
+        """
+        self._check_done()
 
 
 class Encoder:
-    def __init__(self, data: bytes):
+    """
+    Encodes data to bencoding.
+
+    Supported are `int`, `str` (encoded as UTF-8), byte strings (`bytes`,
+    `bytearray` and `memoryview`), `list`, `tuple` and `dict`. The encoding
+    of each value is appended to a single output buffer by the encoder
+    looked up for its type, and dict keys are sorted by their raw bytes as
+    the specification requires.
+    """
+
+    # When encoding to a file, the buffered output is written once it
+    # exceeds this size, and byte strings of at least this size are written
+    # to the file directly instead of being copied to the buffer
+    SINK_BUFFER_SIZE = 2**16
+
+    def __init__(self, data):
         self._data = data
+        self._sink = None
 
-    def encode(self):
+    def encode(self) -> bytearray:
+        """
+        :return The encoded data, or None if the data cannot be encoded
+        """
         return self.encode_next(self._data)
 
-    def encode_next(self, data: bytes):
-        if type(data) == str:
-            return self._encode_string(data)
-        elif type(data) == int:
-            return self._encode_int(data)
-        elif type(data) == list:
-            return self._encode_list(data)
-        elif type(data) == dict or type(data) == OrderedDict:
-            return self._encode_dict(data)
-        elif type(data) == bytes:
-            return self._encode_bytes(data)
-        else:
+    def encode_next(self, data) -> bytearray:
+        if type(data) not in self._encoders:
             return None
+        buffer = bytearray()
+        self._encode(data, buffer)
+        return buffer
 
-    def _encode_int(self, value: int):
-        return str.encode("i" + str(value) + "e")
-
-    def _encode_string(self, value: str):
-        res = str(len(value)) + ":" + value
-        return str.encode(res)
-
-    def _encode_bytes(self, value: bytes):
-        res = bytearray()
-        res += str.encode(str(len(value)))
-        res += b":"
-        res += value
-        return res
-
-    def _encode_list(self, data: list):
-        res = bytearray("l", "utf-8")
-        res += b"".join([self.encode_next(item) for item in data])
-        res += b"e"
-        return res
-
-    def _encode_dict(self, data: dict) -> bytes:
-        result = bytearray("d", "utf-8")
-        for key, value in data.items():
-            key = self.encode_next(key)
-            value = self.encode_next(value)
-            if key and value:
-                result += key
-                result += value
-            else:
-                raise RuntimeError("Invalid key or value")
-        result += b"e"
-        return result
+    def encode_to(self, sink) -> bool:
+        """
+        Encodes the data to a binary file-like object.
+
+        :return False if the data cannot be encoded, else True
+        """
+        if type(self._data) not in self._encoders:
+            return False
+        buffer = bytearray()
+        self._sink = sink
+        try:
+            self._encode(self._data, buffer)
+        finally:
+            self._sink = None
+        sink.write(buffer)
+        return True
+
+    def _encode(self, data, buffer: bytearray):
+        try:
+            encode = self._encoders[type(data)]
+        except KeyError:
+            raise RuntimeError("Invalid key or value")
+        encode(self, data, buffer)
+
+    def _encode_int(self, value: int, buffer: bytearray):
+        buffer += b"i%de" % value
+
+    def _encode_string(self, value: str, buffer: bytearray):
+        self._encode_bytes(value.encode("utf-8"), buffer)
+
+    def _encode_bytes(self, value, buffer: bytearray):
+        buffer += b"%d:" % len(value)
+        if self._sink is not None and len(value) >= self.SINK_BUFFER_SIZE:
+            self._sink.write(buffer)
+            buffer.clear()
+            self._sink.write(value)
+        else:
+            buffer += value
+            if self._sink is not None and len(buffer) >= self.SINK_BUFFER_SIZE:
+                self._sink.write(buffer)
+                buffer.clear()
+
+    def _encode_memoryview(self, value: memoryview, buffer: bytearray):
+        if value.format != "B" or value.ndim != 1:
+            value = value.cast("B")
+        self._encode_bytes(value, buffer)
+
+    def _encode_list(self, data: list, buffer: bytearray):
+        encoders = self._encoders
+        buffer += TOKEN_LIST
+        try:
+            for item in data:
+                encoders[type(item)](self, item, buffer)
+        except KeyError:
+            raise RuntimeError("Invalid key or value")
+        buffer += TOKEN_END
+
+    def _encode_dict(self, data: dict, buffer: bytearray):
+        try:
+            # Sorting str keys matches sorting their UTF-8 encoding
+            keys = sorted(data)
+        except TypeError:
+            keys = sorted(data, key=_key_bytes)
+
+        encoders = self._encoders
+        buffer += TOKEN_DICT
+        try:
+            for key in keys:
+                value = data[key]
+                key = _key_bytes(key)
+                buffer += b"%d:" % len(key)
+                buffer += key
+                encoders[type(value)](self, value, buffer)
+        except KeyError:
+            raise RuntimeError("Invalid key or value")
+        buffer += TOKEN_END
+
+    _encoders = {
+        int: _encode_int,
+        str: _encode_string,
+        bytes: _encode_bytes,
+        bytearray: _encode_bytes,
+        memoryview: _encode_memoryview,
+        list: _encode_list,
+        tuple: _encode_list,
+        dict: _encode_dict,
+        OrderedDict: _encode_dict,
+    }
+
+
+def _key_bytes(key) -> bytes:
+    if type(key) is bytes:
+        return key
+    elif type(key) is str:
+        return key.encode("utf-8")
+    raise RuntimeError("Invalid key or value")
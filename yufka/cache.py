@@ -0,0 +1,87 @@
+import logging
+import os
+import tempfile
+from hashlib import sha1
+
+from yufka import bencoding
+
+# Entries written by another version of the cache are ignored
+CACHE_VERSION = 1
+
+# The suffix of the cache entry files
+CACHE_SUFFIX = ".cache"
+
+
+class MetadataCache:
+    """
+    An on-disk cache of the metadata parsed from torrent files.
+
+    Each torrent file has one entry in the cache directory, named after the
+    hash of the torrent file's absolute path. The entry records the size and
+    modification time of the torrent file, and is only used while the file
+    is unchanged.
+
+    The content of an entry is defined by its user (see `Torrent`), the
+    cache only requires it to be bencodable.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def path(self, filename: str) -> str:
+        """
+        Returns the path of the cache entry for the given torrent file.
+        """
+        key = sha1(os.path.abspath(filename).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, key + CACHE_SUFFIX)
+
+    def get(self, filename: str) -> dict:
+        """
+        Reads the cache entry for the given torrent file.
+
+        :return The cached entry or None if there is no usable entry
+        """
+        path = self.path(filename)
+        try:
+            stat = os.stat(filename)
+            with open(path, "rb") as f:
+                cached = bencoding.Decoder(f.read()).decode()
+        except FileNotFoundError:
+            return None
+        except (EOFError, IndexError, RuntimeError, ValueError):
+            logging.warning("Ignoring invalid cache entry {}".format(path))
+            return None
+
+        if (
+            type(cached) is not dict
+            or cached.get(b"version") != CACHE_VERSION
+            or cached.get(b"size") != stat.st_size
+            or cached.get(b"mtime") != stat.st_mtime_ns
+        ):
+            return None
+        return cached.get(b"entry")
+
+    def put(self, filename: str, entry: dict):
+        """
+        Records the entry for the given torrent file, replacing any previous
+        entry. Failing to write to the cache is not an error.
+        """
+        try:
+            stat = os.stat(filename)
+            os.makedirs(self.directory, exist_ok=True)
+            # The entry might be written by several processes at once, each
+            # replaces it atomically with its own temporary file
+            with tempfile.NamedTemporaryFile(
+                dir=self.directory, suffix=".tmp", delete=False
+            ) as f:
+                bencoding.Encoder(
+                    {
+                        b"entry": entry,
+                        b"mtime": stat.st_mtime_ns,
+                        b"size": stat.st_size,
+                        b"version": CACHE_VERSION,
+                    }
+                ).encode_to(f)
+            os.replace(f.name, self.path(filename))
+        except OSError as e:
+            logging.warning("Unable to write cache entry: {}".format(e))
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import random
+
+# The number of interested peers unchoked for their rate, besides the
+# optimistically unchoked peer
+UPLOAD_SLOTS = 4
+
+# The number of seconds between choking rounds
+CHOKE_INTERVAL = 10
+
+# The optimistically unchoked peer is rotated every OPTIMISTIC_ROUNDS rounds
+OPTIMISTIC_ROUNDS = 3
+
+
+class Choker:
+    """
+    Decides which remote peers may request blocks from us (tit-for-tat).
+
+    Every `CHOKE_INTERVAL` seconds the interested peers are ranked by the
+    number of bytes they sent us since the previous round, or the number of
+    bytes we sent them once seeding. The best `UPLOAD_SLOTS` peers are
+    unchoked, so our upload goes to the peers reciprocating the most, and
+    all other peers are choked.
+
+    One more peer is unchoked optimistically regardless of its rate, giving
+    new peers the chance to prove themselves and us the chance to find
+    better peers. The optimistic slot is rotated every `OPTIMISTIC_ROUNDS`
+    rounds.
+
+    Between rounds, interested peers are unchoked right away while there
+    are free slots.
+    """
+
+    def __init__(
+        self,
+        piece_manager,
+        slots: int = UPLOAD_SLOTS,
+        interval: float = CHOKE_INTERVAL,
+        optimistic_rounds: int = OPTIMISTIC_ROUNDS,
+    ):
+        """
+        :param piece_manager: The PieceManager telling whether we are seeding
+        :param slots: The number of peers unchoked for their rate
+        :param interval: The seconds between choking rounds
+        :param optimistic_rounds: The number of rounds the optimistically
+                                  unchoked peer keeps its slot
+        """
+        self.piece_manager = piece_manager
+        self.slots = slots
+        self.interval = interval
+        self.optimistic_rounds = optimistic_rounds
+        # The PeerConnections, not all of them connected to a remote peer
+        self.connections = []
+        # The PeerConnection holding the optimistic slot
+        self.optimistic = None
+        self.rounds = 0
+        # Maps the PeerConnection to the remote peer id and the bytes
+        # downloaded and uploaded at the previous round
+        self._previous = {}
+        self.future = None
+
+    def start(self, connections: list):
+        """
+        Starts the choking rounds for the given PeerConnections.
+        """
+        self.connections = connections
+        self.future = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.choke_round()
+
+    def _rate(self, connection, seeding: bool) -> int:
+        """
+        Returns the bytes downloaded from (or when seeding, uploaded to) the
+        connection's remote peer since the previous round.
+        """
+        current = (connection.remote_id, connection.downloaded, connection.uploaded)
+        previous = self._previous.get(connection)
+        self._previous[connection] = current
+        if previous is None or previous[0] != current[0]:
+            # A new remote peer, counted from the start of its connection
+            previous = (current[0], 0, 0)
+        if seeding:
+            return current[2] - previous[2]
+        return current[1] - previous[1]
+
+    def choke_round(self):
+        """
+        Unchokes the interested peers with the best rates and the
+        optimistically unchoked peer, chokes all other peers.
+        """
+        seeding = self.piece_manager.complete
+        connected = [c for c in self.connections if c.remote_id is not None]
+        rates = {c: self._rate(c, seeding) for c in connected}
+        for connection in list(self._previous):
+            if connection not in rates:
+                del self._previous[connection]
+
+        interested = [c for c in connected if "interested" in c.peer_state]
+        interested.sort(key=lambda c: rates[c], reverse=True)
+        unchoked = set(interested[: self.slots])
+
+        if (
+            self.optimistic not in interested
+            or self.optimistic in unchoked
+            or self.rounds % self.optimistic_rounds == 0
+        ):
+            candidates = interested[self.slots :]
+            self.optimistic = random.choice(candidates) if candidates else None
+        if self.optimistic is not None:
+            unchoked.add(self.optimistic)
+        self.rounds += 1
+
+        for connection in connected:
+            if connection in unchoked:
+                connection.unchoke_peer()
+            else:
+                connection.choke_peer()
+        logging.debug(
+            "Unchoked {unchoked} of {interested} interested peers".format(
+                unchoked=len(unchoked), interested=len(interested)
+            )
+        )
+
+    def peer_interested(self, connection):
+        """
+        Called when a remote peer becomes interested, unchoking it right
+        away if there is a free slot.
+        """
+        unchoked = sum(
+            1
+            for c in self.connections
+            if c.remote_id is not None
+            and "interested" in c.peer_state
+            and "choked" not in c.peer_state
+        )
+        if unchoked < self.slots + 1:
+            connection.unchoke_peer()
+
+    def stop(self):
+        if self.future is not None and not self.future.done():
+            self.future.cancel()
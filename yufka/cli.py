@@ -1,26 +1,30 @@
 import asyncio
 import argparse
+import json
+import os
 import signal
 import logging
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-from concurrent.futures import CancelledError
-
+from yufka.cache import MetadataCache
 from yufka.torrent import Torrent
+from yufka.tracker import shared_pool
 from yufka.client import TorrentClient
+from yufka.verifier import check_file, DEFAULT_WORKERS
 
+MEGABYTE = 2**20
+
+
+def open_torrent(path: str, args) -> Torrent:
+    cache = MetadataCache(args.metadata_cache) if args.metadata_cache else None
+    return Torrent(path, cache)
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("torrent", help="Path to torrent file")
-    parser.add_argument(
-        "-v", "--verbose", action="store_true", help="Enable verbose logging"
-    )
-    args = parser.parse_args()
-    if args.verbose:
-        logging.basicConfig(level=logging.DEBUG)
 
+def download(args):
     loop = asyncio.get_event_loop()
-    client = TorrentClient(Torrent(args.torrent))
+    client = TorrentClient(open_torrent(args.torrent, args), seed=args.seed)
     task = loop.create_task(client.start())
 
     def signal_handler(*_):
@@ -32,5 +36,218 @@ def main():
 
     try:
         loop.run_until_complete(task)
-    except CancelledError:
+    except asyncio.CancelledError:
         logging.info("Cancelled")
+    finally:
+        loop.run_until_complete(shared_pool().close())
+
+
+def check(args):
+    torrent = open_torrent(args.torrent, args)
+    total = torrent.total_size
+
+    def report(checked):
+        print(
+            "\r{percent:6.2f} % checked".format(percent=checked / total * 100),
+            end="",
+            file=sys.stderr,
+        )
+
+    try:
+        result = check_file(torrent, args.path, args.workers, report)
+    except FileNotFoundError as e:
+        print(
+            "Unable to check {path}: {error}".format(path=args.path, error=e.strerror),
+            file=sys.stderr,
+        )
+        return 1
+    print(file=sys.stderr)
+    print(
+        "Checked {pieces} pieces ({size:.1f} MB) in {elapsed:.2f} s, "
+        "{rate:.1f} MB/s".format(
+            pieces=result.pieces,
+            size=result.size / MEGABYTE,
+            elapsed=result.elapsed,
+            rate=result.size / MEGABYTE / max(result.elapsed, 1e-9),
+        )
+    )
+    if result.bad:
+        print(
+            "{count} bad pieces: {indices}".format(
+                count=len(result.bad),
+                indices=", ".join(str(index) for index in result.bad),
+            )
+        )
+        return 1
+    print("All pieces are valid")
+    return 0
+
+
+def torrent_paths(paths):
+    """
+    Yields the given paths of torrent files, and the paths of the torrent
+    files found in the given directories and their sub-directories.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for directory, directories, files in os.walk(path):
+            directories.sort()
+            for name in sorted(files):
+                if name.endswith(".torrent"):
+                    yield os.path.join(directory, name)
+
+
+def describe(path: str, cache_directory: str = None) -> dict:
+    """
+    Parses the torrent file and describes its metadata as a JSON object.
+    Runs in a worker process of the `info` command.
+    """
+    cache = MetadataCache(cache_directory) if cache_directory else None
+    try:
+        torrent = Torrent(path, cache)
+        return {
+            "path": path,
+            "info_hash": torrent.info_hash.hex(),
+            "name": torrent.output_file,
+            "size": torrent.total_size,
+            "piece_length": torrent.piece_length,
+            "pieces": torrent.piece_count,
+            "files": [{"path": f.name, "length": f.length} for f in torrent.files],
+        }
+    except Exception as e:
+        # Any malformed torrent file is reported without ending the stream
+        return {"path": path, "error": str(e) or type(e).__name__}
+
+
+def info(args):
+    paths = list(torrent_paths(args.paths))
+    # Torrents are handed to the workers in chunks, amortizing the cost of
+    # passing work and results between the processes
+    chunksize = max(1, min(64, len(paths) // (args.workers * 4)))
+    failed = 0
+    with ProcessPoolExecutor(args.workers) as executor:
+        describe_torrent = partial(describe, cache_directory=args.metadata_cache)
+        for result in executor.map(describe_torrent, paths, chunksize=chunksize):
+            if "error" in result:
+                failed += 1
+            sys.stdout.write(json.dumps(result) + "\n")
+    return 1 if failed else 0
+
+
+# The sub-commands, downloading is the default when no command is given
+COMMANDS = ["download", "check", "info"]
+
+
+def first_positional(argv: list, parser: argparse.ArgumentParser) -> str:
+    """
+    Returns the first positional argument, skipping the options of the
+    parser and their values.
+    """
+    valued = {
+        option
+        for action in parser._actions
+        if action.nargs != 0
+        for option in action.option_strings
+    }
+    arguments = iter(argv)
+    for arg in arguments:
+        if arg in valued:
+            next(arguments, None)
+        elif arg == "--":
+            return next(arguments, None)
+        elif not arg.startswith("-"):
+            return arg
+    return None
+
+
+def main(argv=None):
+    # The options accepted both before and after the sub-command
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        default=argparse.SUPPRESS,
+        help="Enable verbose logging",
+    )
+    common.add_argument(
+        "--metadata-cache",
+        metavar="DIRECTORY",
+        default=argparse.SUPPRESS,
+        help="Cache the metadata parsed from torrent files in this directory",
+    )
+
+    parser = argparse.ArgumentParser(prog="yufka", parents=[common])
+    commands = parser.add_subparsers(dest="command")
+
+    parser_download = commands.add_parser(
+        "download", parents=[common], help="Download a torrent"
+    )
+    parser_download.add_argument("torrent", help="Path to torrent file")
+    parser_download.add_argument(
+        "--seed",
+        action="store_true",
+        help="Keep uploading to the peers connected to once downloaded, "
+        "until interrupted",
+    )
+    parser_download.set_defaults(func=download)
+
+    parser_check = commands.add_parser(
+        "check",
+        parents=[common],
+        help="Verify downloaded data against the torrent's piece hashes",
+    )
+    parser_check.add_argument("torrent", help="Path to torrent file")
+    parser_check.add_argument(
+        "path", help="Path to the downloaded file, or directory of a multi-file torrent"
+    )
+    parser_check.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of threads hashing pieces",
+    )
+    parser_check.set_defaults(func=check)
+
+    parser_info = commands.add_parser(
+        "info",
+        parents=[common],
+        help="Print the metadata of torrent files as JSON lines",
+    )
+    parser_info.add_argument(
+        "paths",
+        nargs="+",
+        help="Paths to torrent files, or directories searched for them",
+    )
+    parser_info.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of processes parsing torrent files",
+    )
+    parser_info.set_defaults(func=info)
+
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # Keep `yufka <torrent>` working as a shorthand for downloading
+    command = first_positional(argv, common)
+    if command is not None and command not in COMMANDS:
+        argv.insert(0, "download")
+
+    # The defaults of the common options are not set through the parsers,
+    # which share the option's actions with each other
+    defaults = argparse.Namespace(verbose=False, metadata_cache=None)
+    args = parser.parse_args(argv, defaults)
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    if not args.command:
+        parser.print_help()
+        return 2
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,26 +1,839 @@
 import asyncio
+import functools
+import itertools
 import logging
 import math
-import os
 import time
 from asyncio import Queue
-from collections import namedtuple, defaultdict
-from hashlib import sha1
+from collections import namedtuple
 
-from yufka.protocol import Peerconnection, RUQUEST_SIZE
+from yufka.choker import Choker
+from yufka.peers import PeerStore
+from yufka.protocol import PeerConnection, PeerDialer, REQUEST_SIZE
+from yufka.resume import FastResume
+from yufka.storage import Storage
+from yufka.verifier import PieceVerifier
 from yufka.tracker import Tracker
 
+# The number of PeerConnection workers concurrently downloading from peers
 MAX_PEER_CONNECTIONS = 40
 
+# The announce interval used until the tracker tells us otherwise (or when an
+# announce failed)
+DEFAULT_ANNOUNCE_INTERVAL = 30 * 60
+RETRY_ANNOUNCE_INTERVAL = 60
+
+# The interval in seconds between saving the resume file while downloading,
+# limiting the progress lost if the client is not stopped cleanly
+RESUME_SAVE_INTERVAL = 60
+
+
 class TorrentClient:
-    def __init__(self, torrent):
+    """
+    The torrent client is the local peer that holds peer-to-peer connections
+    to download and upload pieces for a given torrent.
+
+    Once started, the client makes periodic announce calls to the tracker
+    registered in the torrent meta-data. These calls result in a list of
+    peers that should be tried in order to exchange pieces.
+
+    Each received peer is put into a queue that a pool of PeerConnection
+    objects consume. There is a fixed number of PeerConnections that can
+    be active at any given time (see `MAX_PEER_CONNECTIONS`).
+
+    When seeding, the client keeps serving the pieces to peers once the
+    torrent is fully downloaded, until stopped. Incoming connections are not
+    accepted, so pieces are only uploaded to the peers the client dials.
+    """
+
+    def __init__(self, torrent, seed: bool = False):
         self.tracker = Tracker(torrent)
+        self.seed = seed
+        # The list of potential peers is the work queue, consumed by the
+        # PeerConnections
         self.available_peers = Queue()
+        # Deduplicates the peers received from the tracker and keeps track of
+        # the peers failing to connect
+        self.peer_store = PeerStore(self.available_peers)
+        # The list of peers is the list of workers that *might* be connected
+        # to a peer. Else they are waiting to consume new remote peers from
+        # the `available_peers` queue.
         self.peers = []
-        self.piece_manager = PieceManager(torrent)
+        # Connects to the queued peers ahead of the PeerConnections, created
+        # once started
+        self.dialer = None
+        # The resume file must be read before the piece manager opens the
+        # output file, which might touch its modification time
+        self.resume = FastResume(torrent)
+        self.resume_state = self.resume.load()
+        # The piece manager implements the strategy on which pieces to
+        # request, as well as the logic to persist received blocks to disk.
+        self.piece_manager = PieceManager(torrent, self._on_piece_verified)
+        # Decides which peers may request blocks from us
+        self.choker = Choker(self.piece_manager)
+        # The flush and save of the resume file running in a worker thread
+        self._saving = None
         self.abort = False
-     
+
     async def start(self):
-        self.peers = [PeerConnection(self.available_peers, 
+        """
+        Start downloading the torrent held by this client.
+
+        This results in connecting to the tracker to retrieve the list of
+        peers to communicate with. Once the torrent is fully downloaded
+        (unless seeding) or if the download is aborted this method will
+        complete.
+        """
+        await self._restore()
+        self.dialer = PeerDialer(
+            self.available_peers,
+            self.tracker.torrent.info_hash,
+            self.tracker.peer_id,
+            peer_store=self.peer_store,
+        )
+        self.peers = [
+            PeerConnection(
+                self.available_peers,
+                self.tracker.torrent.info_hash,
+                self.tracker.peer_id,
+                self.piece_manager,
+                self._on_block_retrieved,
+                peer_store=self.peer_store,
+                dialer=self.dialer,
+                choker=self.choker,
+            )
+            for _ in range(MAX_PEER_CONNECTIONS)
+        ]
+        self.choker.start(self.peers)
+
+        # The time we last made an announce call and the interval in seconds
+        # until the next one is due
+        previous = None
+        interval = DEFAULT_ANNOUNCE_INTERVAL
+        saved = time.monotonic()
+        seeding = False
+
+        try:
+            while True:
+                if self.piece_manager.complete and not seeding:
+                    logging.info("Torrent fully downloaded!")
+                    if not self.seed:
+                        break
+                    logging.info("Seeding...")
+                    seeding = True
+                    await self._flush_and_save_resume()
+                if self.abort:
+                    logging.info("Aborting download...")
+                    break
+
+                current = time.monotonic()
+                if previous is None or previous + interval < current:
+                    interval = await self._announce(first=previous is None)
+                    previous = current
+                else:
+                    await asyncio.sleep(5)
+
+                if saved + RESUME_SAVE_INTERVAL < current:
+                    await self._flush_and_save_resume()
+                    saved = current
+        finally:
+            self.stop()
+            # The files must not be closed while being flushed
+            if self._saving is not None:
+                await asyncio.wait([self._saving])
+            self.piece_manager.close()
+            # Saved once all data is written, allowing the next start to
+            # trust the recorded pieces without verifying them
+            self._save_resume()
+            await self.tracker.close()
+
+    async def _restore(self):
+        """
+        Restores the pieces recorded in the resume file, verifying them first
+        if the output file was modified since they were recorded.
+        """
+        state = self.resume_state
+        if not state:
+            return
+        if state.verified:
+            self.piece_manager.restore(state.pieces)
+        else:
+            logging.info("Output file changed, verifying recorded pieces")
+            await self.piece_manager.recheck(state.pieces)
+        logging.info(
+            "Resuming with {have} / {total} pieces".format(
+                have=len(self.piece_manager.have_pieces),
+                total=self.piece_manager.total_pieces,
+            )
+        )
+
+    async def _flush_and_save_resume(self):
+        """
+        Writes the downloaded data back to disk and saves the resume file.
+
+        Flushing may write back a lot of data, so both run in a worker
+        thread, keeping the event loop serving the peers meanwhile.
+        """
+        # The pieces are taken before flushing, so their data is written to
+        # disk by the time they are recorded
+        pieces = [p.index for p in self.piece_manager.have_pieces]
+        loop = asyncio.get_running_loop()
+        self._saving = loop.run_in_executor(None, self._flush_and_save, pieces)
+        await self._saving
+
+    def _flush_and_save(self, pieces: list):
+        self.piece_manager.storage.flush()
+        self._save_resume(pieces)
+
+    def _save_resume(self, pieces: list = None):
+        if pieces is None:
+            pieces = [p.index for p in self.piece_manager.have_pieces]
+        try:
+            self.resume.save(pieces)
+        except OSError:
+            logging.exception("Unable to save the resume file")
+
+    async def _announce(self, first: bool) -> int:
+        """
+        Announces to the tracker and replaces the queued peers with the ones
+        received.
+
+        :return The number of seconds until the next announce is due
+        """
+        try:
+            response = await self.tracker.connect(
+                first=first,
+                uploaded=self.piece_manager.bytes_uploaded,
+                downloaded=self.piece_manager.bytes_downloaded,
+            )
+        except ConnectionError:
+            logging.exception("Announce to tracker failed")
+            return RETRY_ANNOUNCE_INTERVAL
+
+        # Only peers not already queued, connected or recently failing are
+        # queued, the peers queued earlier stay in the queue
+        self.peer_store.add(response.peers)
+        return response.interval or DEFAULT_ANNOUNCE_INTERVAL
+
     def stop(self):
-        pass
+        """
+        Stop the download or seeding process.
+        """
+        self.abort = True
+        self.choker.stop()
+        if self.dialer:
+            self.dialer.stop()
+        for peer in self.peers:
+            peer.stop()
+
+    def _on_piece_verified(self, index: int):
+        """
+        Callback function called by the `PieceManager` when a downloaded
+        piece is verified, announcing it to the connected peers.
+        """
+        for peer in self.peers:
+            peer.send_have(index)
+
+    def _on_block_retrieved(self, peer_id, piece_index, block_offset, data):
+        """
+        Callback function called by the `PeerConnection` when a block is
+        retrieved from a peer.
+
+        :param peer_id: The id of the peer the block was retrieved from
+        :param piece_index: The piece index this block is a part of
+        :param block_offset: The block offset within its piece
+        :param data: The binary data retrieved
+        """
+        self.piece_manager.block_received(
+            peer_id=peer_id,
+            piece_index=piece_index,
+            block_offset=block_offset,
+            data=data,
+        )
+
+
+class Block:
+    """
+    The block is a partial piece, this is what is requested and transferred
+    between peers.
+
+    A block is most often of the same size as the `REQUEST_SIZE`, except for
+    the final block which might (most likely) is smaller than `REQUEST_SIZE`.
+    """
+
+    Missing = 0
+    Pending = 1
+    Retrieved = 2
+
+    def __init__(self, piece: int, offset: int, length: int):
+        self.piece = piece
+        self.offset = offset
+        self.length = length
+        self.status = Block.Missing
+
+
+class Piece:
+    """
+    The piece is a part of of the torrents content. Each piece except the
+    final piece for a torrent has the same length (the final piece might be
+    shorter).
+
+    A piece is what is defined in the torrent meta-data. However, when sharing
+    data between peers a smaller unit is used - this smaller piece is refereed
+    to as `Block` by the unofficial specification (the official specification
+    uses piece for this one as well, which is slightly confusing).
+    """
+
+    def __init__(self, index: int, blocks: list, hash_value: bytes):
+        self.index = index
+        self.blocks = blocks
+        self.hash = hash_value
+        # Blocks are requested in order, all blocks before this one have
+        # already been requested
+        self._next_block = 0
+        # The requested blocks that are to be requested again
+        self._cancelled = []
+        self._retrieved = 0
+
+    def reset(self):
+        """
+        Reset all blocks to Missing regardless of current state.
+        """
+        for block in self.blocks:
+            block.status = Block.Missing
+        self._next_block = 0
+        self._cancelled = []
+        self._retrieved = 0
+
+    @property
+    def fully_requested(self) -> bool:
+        """
+        Checks if there are no Missing blocks left to request.
+        """
+        return self._next_block >= len(self.blocks) and not self._cancelled
+
+    def next_request(self) -> Block:
+        """
+        Get the next Block to be requested
+        """
+        if self._cancelled:
+            block = self._cancelled.pop()
+        elif self._next_block < len(self.blocks):
+            block = self.blocks[self._next_block]
+            self._next_block += 1
+        else:
+            return None
+        block.status = Block.Pending
+        return block
+
+    def cancel_request(self, block: Block) -> bool:
+        """
+        Marks the pending block as Missing, to be requested again.
+
+        :return True if the block was pending, else False
+        """
+        if block.status != Block.Pending:
+            return False
+        block.status = Block.Missing
+        self._cancelled.append(block)
+        return True
+
+    def block_received(self, offset: int, length: int) -> bool:
+        """
+        Update block information that the given block is now received
+
+        :param offset: The block offset (within the piece)
+        :param length: The length of the received block data
+        :return: True if the block belongs to this piece and was not already
+                 retrieved, else False
+        """
+        index = offset // REQUEST_SIZE
+        if (
+            index >= len(self.blocks)
+            or self.blocks[index].offset != offset
+            or self.blocks[index].length != length
+        ):
+            logging.warning(
+                "Trying to complete a non-existing block {offset}".format(offset=offset)
+            )
+            return False
+
+        block = self.blocks[index]
+        if block.status == Block.Retrieved:
+            return False
+        if block.status == Block.Missing and block in self._cancelled:
+            # Received after its request was given up on
+            self._cancelled.remove(block)
+        block.status = Block.Retrieved
+        self._retrieved += 1
+        return True
+
+    def is_complete(self) -> bool:
+        """
+        Checks if all blocks for this piece is retrieved (regardless of SHA1)
+
+        :return: True or False
+        """
+        return self._retrieved == len(self.blocks)
+
+
+# The type used for keeping track of pending request that can be re-issued
+PendingRequest = namedtuple("PendingRequest", ["block", "added", "peer_id"])
+
+
+class PieceManager:
+    """
+    The PieceManager is responsible for keeping track of all the available
+    pieces for the connected peers as well as the pieces we have available for
+    other peers.
+
+    Pieces already being downloaded are completed first. New pieces are
+    picked rarest first: the availability of each piece (the number of
+    connected peers having it) is updated incrementally from BitField and
+    Have messages, and the missing pieces are grouped in buckets by
+    availability. Finding the rarest piece a peer has visits the buckets in
+    order, or the pieces of the peer when the buckets hold more pieces than
+    the peer has, never all peers or all pieces of the torrent.
+    """
+
+    def __init__(self, torrent, on_piece_cb=None):
+        """
+        :param torrent: The torrent to download
+        :param on_piece_cb: The optional callback function called with the
+                            index of each downloaded and verified piece
+        """
+        self.torrent = torrent
+        self.on_piece_cb = on_piece_cb
+        # Maps the peer id to one byte per piece, set if the peer has it
+        self.peers = {}
+        # Maps the peer id to the number of pieces the peer has
+        self._peer_pieces = {}
+        # Maps (piece index, block offset) to the PendingRequest, in the
+        # order the requests were made
+        self.pending_blocks = {}
+        self.pieces = self._initiate_pieces()
+        self.ongoing_pieces = {}
+        # The ongoing pieces with blocks left to request
+        self._requestable = {}
+        self.have_pieces = []
+        # One byte per piece, set once the piece is verified
+        self._have = bytearray(len(self.pieces))
+        # The number of bytes of block data sent to peers
+        self._uploaded = 0
+        self.max_pending_time = 300  # 5 minutes
+        self.total_pieces = len(self.pieces)
+        self.availability = [0] * self.total_pieces
+        # The missing pieces where bucket n holds the pieces n peers have.
+        # The dicts are used as insertion ordered sets.
+        self._buckets = [dict.fromkeys(range(self.total_pieces))]
+        self.storage = Storage(torrent)
+        self.verifier = PieceVerifier(self.storage)
+
+    def _initiate_pieces(self) -> list:
+        """
+        Pre-construct the list of pieces and blocks based on the number of
+        pieces and request size for this torrent.
+        """
+        torrent = self.torrent
+        pieces = []
+        total_pieces = len(torrent.pieces)
+
+        for index, hash_value in enumerate(torrent.pieces):
+            if index < (total_pieces - 1):
+                length = torrent.piece_length
+            else:
+                length = torrent.total_size - index * torrent.piece_length
+            blocks = [
+                Block(index, offset * REQUEST_SIZE, REQUEST_SIZE)
+                for offset in range(math.ceil(length / REQUEST_SIZE))
+            ]
+            if length % REQUEST_SIZE > 0:
+                blocks[-1].length = length % REQUEST_SIZE
+            pieces.append(Piece(index, blocks, hash_value))
+        return pieces
+
+    def close(self):
+        """
+        Close any resources used by the PieceManager (such as open files)
+        """
+        self.verifier.close()
+        self.storage.close()
+
+    @property
+    def complete(self):
+        """
+        Checks whether or not the all pieces are downloaded for this torrent.
+
+        :return: True if all pieces are fully downloaded else False
+        """
+        return len(self.have_pieces) == self.total_pieces
+
+    @property
+    def bytes_downloaded(self) -> int:
+        """
+        Get the number of bytes downloaded.
+
+        This method Only counts full, verified, pieces, not single blocks.
+        """
+        return sum(self.torrent.piece_size(piece.index) for piece in self.have_pieces)
+
+    @property
+    def bytes_uploaded(self) -> int:
+        """
+        Get the number of bytes of block data sent to peers.
+        """
+        return self._uploaded
+
+    def has_piece(self, index: int) -> bool:
+        """
+        Checks whether the piece with the given index is downloaded and
+        verified, and thus available to peers.
+        """
+        return 0 <= index < self.total_pieces and self._have[index] == 1
+
+    def bitfield(self) -> bytes:
+        """
+        Returns the pieces we have as the payload of a BitField message, one
+        bit per piece.
+        """
+        data = bytearray((self.total_pieces + 7) // 8)
+        for piece in self.have_pieces:
+            data[piece.index >> 3] |= 0x80 >> (piece.index & 7)
+        return bytes(data)
+
+    def read_block(self, piece_index: int, block_offset: int, length: int):
+        """
+        Reads a block of a piece we have, to be sent to a peer.
+
+        :return A view of the block data (see `Storage.read`), or None if we
+                do not have the piece or the block is not within the piece
+        """
+        if not self.has_piece(piece_index) or length <= 0 or block_offset < 0:
+            return None
+        last = self.pieces[piece_index].blocks[-1]
+        if block_offset + length > last.offset + last.length:
+            return None
+        data = self.storage.read(piece_index, block_offset, length)
+        if len(data) < length:
+            data.release()
+            return None
+        return data
+
+    def block_uploaded(self, length: int):
+        """
+        Counts a block of the given length sent to a peer.
+        """
+        self._uploaded += length
+
+    def add_peer(self, peer_id, bitfield):
+        """
+        Adds a peer and the bitfield representing the pieces the peer has.
+        """
+        if peer_id in self.peers:
+            self.remove_peer(peer_id)
+
+        data = bitfield.tobytes()
+        have = bytearray(self.total_pieces)
+        count = 0
+        for index in range(min(self.total_pieces, len(data) * 8)):
+            if data[index >> 3] & (0x80 >> (index & 7)):
+                have[index] = 1
+                count += 1
+                self._change_availability(index, 1)
+        self.peers[peer_id] = have
+        self._peer_pieces[peer_id] = count
+
+    def update_peer(self, peer_id, index: int):
+        """
+        Updates the information about which pieces a peer has (reflects a Have
+        message).
+        """
+        if not 0 <= index < self.total_pieces:
+            return
+        # Peers without any pieces may skip the BitField message
+        if peer_id not in self.peers:
+            self.peers[peer_id] = bytearray(self.total_pieces)
+            self._peer_pieces[peer_id] = 0
+        have = self.peers[peer_id]
+        if not have[index]:
+            have[index] = 1
+            self._peer_pieces[peer_id] += 1
+            self._change_availability(index, 1)
+
+    def restore(self, indices):
+        """
+        Marks the given pieces as Have without downloading them, e.g. when
+        resuming a download.
+        """
+        for index in indices:
+            bucket = self._buckets[self.availability[index]]
+            if index in bucket:
+                del bucket[index]
+                self.have_pieces.append(self.pieces[index])
+                self._have[index] = 1
+
+    async def recheck(self, indices) -> list:
+        """
+        Verifies the stored data of the given pieces and restores the pieces
+        matching their hash.
+
+        :return The indices of the restored pieces
+        """
+        indices = list(indices)
+        restored = []
+        # Submitted in batches to keep the verifier's queue bounded
+        batch_size = self.verifier.max_pending
+        for start in range(0, len(indices), batch_size):
+            batch = indices[start : start + batch_size]
+            results = await asyncio.gather(
+                *(self.verifier.verify(i, self.pieces[i].hash) for i in batch)
+            )
+            restored.extend(i for i, matching in zip(batch, results) if matching)
+        self.restore(restored)
+        return restored
+
+    def remove_peer(self, peer_id):
+        """
+        Tries to remove a previously added peer (e.g. used if a peer connection
+        is dropped)
+        """
+        have = self.peers.pop(peer_id, None)
+        if have is None:
+            return
+        del self._peer_pieces[peer_id]
+        index = have.find(1)
+        while index != -1:
+            self._change_availability(index, -1)
+            index = have.find(1, index + 1)
+
+    def next_request(self, peer_id) -> Block:
+        """
+        Get the next Block that should be requested from the given peer.
+
+        If there are no more blocks left to retrieve or if this peer does not
+        have any of the missing pieces None is returned
+        """
+        if peer_id not in self.peers:
+            return None
+
+        block = self._expired_requests(peer_id)
+        if not block:
+            block = self._next_ongoing(peer_id)
+            if not block:
+                block = self._next_rarest(peer_id)
+        return block
+
+    def cancel_requests(self, peer_id, requests):
+        """
+        Makes the blocks requested from the peer available to be requested
+        again, e.g. when the peer choked us or the connection dropped before
+        the blocks were received.
+
+        :param requests: The (piece index, block offset) of the requests
+        """
+        for key in requests:
+            request = self.pending_blocks.get(key)
+            if request is None or request.peer_id != peer_id:
+                # Already received, or requested again from another peer
+                continue
+            del self.pending_blocks[key]
+            piece = self.ongoing_pieces.get(request.block.piece)
+            if piece is not None and piece.cancel_request(request.block):
+                self._requestable[piece.index] = piece
+
+    def block_received(self, peer_id, piece_index, block_offset, data):
+        """
+        This method must be called when a block has successfully been retrieved
+        by a peer.
+
+        Once a full piece have been retrieved, a SHA1 hash control is
+        scheduled with the verifier. If the check fails all the pieces blocks
+        are put back in missing state to be fetched again. If the hash
+        succeeds the piece is indicated as Have.
+
+        The block is written to the storage as soon as it is received, the
+        given data is not referenced after this call.
+        """
+        logging.debug(
+            "Received block {block_offset} for piece {piece_index} "
+            "from peer {peer_id}: ".format(
+                block_offset=block_offset, piece_index=piece_index, peer_id=peer_id
+            )
+        )
+
+        # Remove from pending requests
+        self.pending_blocks.pop((piece_index, block_offset), None)
+
+        piece = self.ongoing_pieces.get(piece_index)
+        if not piece:
+            logging.warning("Trying to update piece that is not ongoing!")
+        elif piece.block_received(block_offset, len(data)):
+            if piece.fully_requested:
+                self._requestable.pop(piece_index, None)
+            self.storage.write(piece_index, block_offset, data)
+            if piece.is_complete():
+                future = self.verifier.verify(piece_index, piece.hash)
+                future.add_done_callback(functools.partial(self._piece_verified, piece))
+
+    def _piece_verified(self, piece: Piece, future):
+        """
+        Called on the event loop when the verification of a piece completed.
+        """
+        if future.cancelled():
+            return
+        if future.exception():
+            logging.error(
+                "Unable to verify piece {index}".format(index=piece.index),
+                exc_info=future.exception(),
+            )
+        if future.exception() is None and future.result():
+            del self.ongoing_pieces[piece.index]
+            self.have_pieces.append(piece)
+            self._have[piece.index] = 1
+            if self.on_piece_cb:
+                self.on_piece_cb(piece.index)
+            complete = len(self.have_pieces)
+            logging.info(
+                "{complete} / {total} pieces downloaded {per:.3f} %".format(
+                    complete=complete,
+                    total=self.total_pieces,
+                    per=(complete / self.total_pieces) * 100,
+                )
+            )
+        else:
+            logging.info("Discarding corrupt piece {index}".format(index=piece.index))
+            piece.reset()
+            self._requestable[piece.index] = piece
+
+    def _change_availability(self, index: int, delta: int):
+        """
+        Updates the number of peers having the given piece, moving the piece
+        to its new bucket if it is still missing.
+        """
+        count = self.availability[index]
+        self.availability[index] = count + delta
+        bucket = self._buckets[count]
+        if index in bucket:
+            del bucket[index]
+            if count + delta == len(self._buckets):
+                self._buckets.append({})
+            self._buckets[count + delta][index] = None
+
+    def _add_pending(self, block: Block, peer_id):
+        key = (block.piece, block.offset)
+        # Re-inserting moves the request last, keeping the requests ordered
+        # by the time they were made
+        self.pending_blocks.pop(key, None)
+        self.pending_blocks[key] = PendingRequest(block, time.monotonic(), peer_id)
+
+    def _expired_requests(self, peer_id) -> Block:
+        """
+        Go through previously requested blocks, if any one have been in the
+        requested state for longer than `max_pending_time` return the block to
+        be re-requested.
+
+        If no pending blocks exist, None is returned
+        """
+        current = time.monotonic()
+        have = self.peers[peer_id]
+        for request in self.pending_blocks.values():
+            if request.added + self.max_pending_time >= current:
+                # Requests are ordered by time, so no later one is expired
+                break
+            if have[request.block.piece]:
+                logging.info(
+                    "Re-requesting block {block} for "
+                    "piece {piece}".format(
+                        block=request.block.offset, piece=request.block.piece
+                    )
+                )
+                # Reset expiration timer
+                self._add_pending(request.block, peer_id)
+                return request.block
+        return None
+
+    def _next_ongoing(self, peer_id) -> Block:
+        """
+        Go through the ongoing pieces and return the next block to be
+        requested or None if no block is left to be requested.
+        """
+        have = self.peers[peer_id]
+        for piece in self._requestable.values():
+            if have[piece.index]:
+                return self._request_block(piece, peer_id)
+        return None
+
+    def _next_rarest(self, peer_id) -> Block:
+        """
+        Find the missing piece the given peer has that is available from the
+        fewest peers, and return its first block to request or None if the
+        peer has no missing piece.
+
+        This will change the state of the piece from missing to ongoing - thus
+        the next call to this function will not continue with the blocks for
+        that piece, rather get the next missing piece.
+
+        No new piece is started while the verifier is saturated, letting the
+        hashing of completed pieces catch up.
+        """
+        if self.verifier.saturated:
+            logging.debug("Waiting for pieces to be verified")
+            return None
+        index = self._rarest_missing(self.peers[peer_id], self._peer_pieces[peer_id])
+        if index is None:
+            return None
+        # Move this piece from missing to ongoing
+        del self._buckets[self.availability[index]][index]
+        piece = self.pieces[index]
+        self.ongoing_pieces[index] = piece
+        self._requestable[index] = piece
+        return self._request_block(piece, peer_id)
+
+    def _rarest_missing(self, have: bytearray, count: int) -> int:
+        """
+        Returns the index of the rarest missing piece of the pieces the peer
+        has, or None if the peer has no missing piece.
+
+        The buckets are scanned in order, but they may hold many pieces the
+        peer lacks: once as many pieces were scanned as the peer has, the
+        peer's own pieces are walked instead. Either way, no more than twice
+        the number of pieces the peer has are visited.
+
+        :param have: The bytes telling which pieces the peer has
+        :param count: The number of pieces the peer has
+        """
+        budget = count
+        buckets = self._buckets
+        # Bucket 0 holds the pieces no peer has
+        for lowest in range(1, len(buckets)):
+            bucket = buckets[lowest]
+            for index in itertools.islice(bucket, budget):
+                if have[index]:
+                    return index
+            if len(bucket) > budget:
+                break
+            budget -= len(bucket)
+        else:
+            return None
+
+        # None of the pieces of the peer is in the buckets scanned
+        availability = self.availability
+        rarest = None
+        rarest_count = len(buckets)
+        index = have.find(1)
+        while index != -1:
+            available = availability[index]
+            if available < rarest_count and index in buckets[available]:
+                rarest = index
+                rarest_count = available
+                if available == lowest:
+                    break
+            index = have.find(1, index + 1)
+        return rarest
+
+    def _request_block(self, piece: Piece, peer_id) -> Block:
+        block = piece.next_request()
+        if piece.fully_requested:
+            del self._requestable[piece.index]
+        self._add_pending(block, peer_id)
+        return block
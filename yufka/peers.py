@@ -0,0 +1,111 @@
+import logging
+import time
+from asyncio import Queue
+
+# After failing to connect, a peer is not dialed again for
+# PEER_RETRY_DELAY * 2^(failures - 1) seconds
+PEER_RETRY_DELAY = 60
+
+# The number of consecutive failures after which a peer is given up on
+MAX_PEER_FAILURES = 4
+
+# The states of a known peer
+IDLE = "idle"
+QUEUED = "queued"
+CONNECTED = "connected"
+
+
+class PeerRecord:
+    """
+    The connection history of a single peer.
+    """
+
+    __slots__ = ["state", "failures", "retry_at"]
+
+    def __init__(self):
+        self.state = IDLE
+        # The number of consecutive failed connection attempts
+        self.failures = 0
+        # The time before which the peer is not dialed again
+        self.retry_at = 0
+
+
+class PeerStore:
+    """
+    The peers learned from trackers, deduplicated and with the history of
+    connecting to them.
+
+    Peers are put into the queue consumed by the PeerConnections. A peer is
+    not queued again while it is already queued or connected, nor while
+    backing off after a failed connection attempt. Peers failing
+    `MAX_PEER_FAILURES` times in a row are not dialed again at all.
+
+    The PeerConnections report the outcome of each peer taken from the
+    queue through `connected`, `failed` and `released`.
+    """
+
+    def __init__(self, queue: Queue):
+        self.queue = queue
+        # Maps the (ip, port) of each known peer to its PeerRecord
+        self.peers = {}
+
+    def __len__(self):
+        return len(self.peers)
+
+    def add(self, peers) -> int:
+        """
+        Queues the given peers, unless already queued, connected or backing
+        off after failures.
+
+        :param peers: An iterable of (ip, port) tuples
+        :return The number of peers queued
+        """
+        now = time.monotonic()
+        queued = 0
+        count = 0
+        for peer in peers:
+            count += 1
+            record = self.peers.get(peer)
+            if record is None:
+                record = self.peers[peer] = PeerRecord()
+            elif (
+                record.state != IDLE
+                or record.failures >= MAX_PEER_FAILURES
+                or record.retry_at > now
+            ):
+                continue
+            record.state = QUEUED
+            self.queue.put_nowait(peer)
+            queued += 1
+        logging.debug(
+            "Queued {queued} of {count} peers".format(queued=queued, count=count)
+        )
+        return queued
+
+    def connected(self, peer):
+        """
+        Records a successful connection to the peer.
+        """
+        record = self.peers.setdefault(peer, PeerRecord())
+        record.state = CONNECTED
+        record.failures = 0
+        record.retry_at = 0
+
+    def failed(self, peer):
+        """
+        Records a failed attempt to connect to the peer.
+        """
+        record = self.peers.setdefault(peer, PeerRecord())
+        record.failures += 1
+        record.retry_at = time.monotonic() + PEER_RETRY_DELAY * 2 ** (
+            record.failures - 1
+        )
+
+    def released(self, peer):
+        """
+        Records that the peer taken from the queue is no longer used, it may
+        be queued again by a later `add`.
+        """
+        record = self.peers.get(peer)
+        if record is not None:
+            record.state = IDLE
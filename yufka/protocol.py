@@ -17,8 +17,11 @@
 
 import asyncio
 import logging
+import math
 import struct
+import time
 from asyncio import Queue
+from collections import OrderedDict
 from concurrent.futures import CancelledError
 
 import bitstring
@@ -33,18 +36,236 @@ import bitstring
 #
 REQUEST_SIZE = 2**14
 
+# The bounds for the number of block requests kept in flight to a single peer.
+# Within these bounds the depth follows the measured bandwidth-delay product
+# of the peer, see `RequestPipeline`.
+MIN_PIPELINE_DEPTH = 5
+MAX_PIPELINE_DEPTH = 250
+
+# The number of seconds after which a block request not answered by the peer
+# is given back to the piece manager, to be requested again
+REQUEST_TIMEOUT = 30
+
+# The number of seconds to wait for the TCP connection to a peer, and for
+# the peer's handshake once connected. Unresponsive peers are common in
+# swarms, waiting for the operating system to give up on them takes minutes.
+CONNECT_TIMEOUT = 10
+HANDSHAKE_TIMEOUT = 10
+
+# The number of peers the PeerDialer connects to at the same time
+MAX_CONCURRENT_DIALS = 20
+
+# The most number of block requests queued from a single peer, further
+# requests are dropped until the queue is served
+MAX_QUEUED_UPLOADS = 256
+
+# The largest block served to peers. Requests for larger blocks are dropped,
+# as done by most clients.
+MAX_UPLOAD_REQUEST_SIZE = 2**17
+
+# The number of queued blocks sent to a peer with a single write
+UPLOAD_BATCH_SIZE = 16
+
+# The largest message accepted from peers (excluding its length prefix): a
+# Piece message with the largest block served. A BitField message of a
+# torrent with many pieces may be larger, see `PeerStreamIterator`.
+MAX_MESSAGE_LENGTH = MAX_UPLOAD_REQUEST_SIZE + 9
+
 
 class ProtocolError(BaseException):
     pass
 
 
+# The errors of failing to connect to a peer or to exchange handshakes
+DIAL_ERRORS = (ProtocolError, OSError, asyncio.TimeoutError, EOFError)
+
+
+async def open_peer(
+    peer,
+    info_hash: bytes,
+    peer_id: bytes,
+    connect_timeout: float = CONNECT_TIMEOUT,
+    handshake_timeout: float = HANDSHAKE_TIMEOUT,
+):
+    """
+    Connects to the peer and exchanges handshakes with it.
+
+    :param peer: The (ip, port) of the peer
+    :return The (reader, writer, remote peer id) of the connection
+    """
+    ip, port = peer
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(ip, port), connect_timeout
+    )
+    logging.info("Connection open to peer: {ip}".format(ip=ip))
+    try:
+        remote_id = await asyncio.wait_for(
+            _handshake(reader, writer, info_hash, peer_id), handshake_timeout
+        )
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer, remote_id
+
+
+async def _handshake(reader, writer, info_hash: bytes, peer_id: bytes) -> bytes:
+    """
+    Send the initial handshake to the remote peer and wait for the peer
+    to respond with its handshake.
+
+    :return The peer id of the remote peer
+    """
+    writer.write(Handshake(info_hash, peer_id).encode())
+    await writer.drain()
+
+    # Only the handshake is read, the messages following it are left to the
+    # reader of the connection
+    try:
+        buf = await reader.readexactly(Handshake.length)
+    except asyncio.IncompleteReadError:
+        raise ProtocolError("Unable receive and parse a handshake")
+
+    response = Handshake.decode(buf)
+    if not response:
+        raise ProtocolError("Unable receive and parse a handshake")
+    if not response.info_hash == info_hash:
+        raise ProtocolError("Handshake with invalid info_hash")
+
+    # TODO: According to spec we should validate that the peer_id received
+    # from the peer match the peer_id received from the tracker.
+    logging.info("Handshake with peer was successful")
+    return response.peer_id
+
+
+class PeerDialer:
+    """
+    Connects to the peers from the queue ahead of the PeerConnections that
+    use them.
+
+    Many of the peers returned by trackers are gone, firewalled or never
+    respond. Instead of every PeerConnection trying one peer at a time, the
+    dialer races up to `max_dials` connection attempts for as long as
+    PeerConnections are waiting, and hands the connections completing their
+    handshake first to the waiting PeerConnections.
+    """
+
+    def __init__(
+        self,
+        queue: Queue,
+        info_hash: bytes,
+        peer_id: bytes,
+        max_dials: int = MAX_CONCURRENT_DIALS,
+        peer_store=None,
+        connect_timeout: float = CONNECT_TIMEOUT,
+        handshake_timeout: float = HANDSHAKE_TIMEOUT,
+    ):
+        """
+        Constructs a PeerDialer and adds it to the asyncio event-loop.
+
+        :param queue: The async Queue containing available peers
+        :param info_hash: The SHA1 hash for the meta-data's info
+        :param peer_id: Our peer ID used to to identify ourselves
+        :param max_dials: The most number of peers connected to at a time
+        :param peer_store: The optional PeerStore the queued peers come from,
+                           which is told the outcome of connecting to them
+        """
+        self.queue = queue
+        self.info_hash = info_hash
+        self.peer_id = peer_id
+        self.peer_store = peer_store
+        self.connect_timeout = connect_timeout
+        self.handshake_timeout = handshake_timeout
+        # The established connections not yet handed to a PeerConnection
+        self.connections = Queue()
+        # The number of PeerConnections waiting for a connection
+        self._waiting = 0
+        # Set while more PeerConnections are waiting than there are
+        # established connections
+        self._wanted = asyncio.Event()
+        self._dials = [asyncio.ensure_future(self._dial()) for _ in range(max_dials)]
+
+    async def get(self):
+        """
+        Waits for the next established connection.
+
+        :return The (peer, reader, writer, remote peer id) of the connection
+        """
+        self._waiting += 1
+        self._update()
+        try:
+            return await self.connections.get()
+        finally:
+            self._waiting -= 1
+            self._update()
+
+    def _update(self):
+        if self._waiting > self.connections.qsize():
+            self._wanted.set()
+        else:
+            self._wanted.clear()
+
+    async def _dial(self):
+        while True:
+            await self._wanted.wait()
+            peer = await self.queue.get()
+            try:
+                reader, writer, remote_id = await open_peer(
+                    peer,
+                    self.info_hash,
+                    self.peer_id,
+                    self.connect_timeout,
+                    self.handshake_timeout,
+                )
+            except DIAL_ERRORS as e:
+                logging.info(
+                    "Unable to connect to peer {ip}: {error}".format(
+                        ip=peer[0], error=repr(e)
+                    )
+                )
+                self._dial_failed(peer)
+                continue
+            except Exception:
+                # E.g. an invalid address from a tracker, which must not end
+                # the dialing
+                logging.exception("Unable to connect to peer {peer}".format(peer=peer))
+                self._dial_failed(peer)
+                continue
+            finally:
+                self.queue.task_done()
+
+            if self.peer_store:
+                self.peer_store.connected(peer)
+            self.connections.put_nowait((peer, reader, writer, remote_id))
+            self._update()
+
+    def _dial_failed(self, peer):
+        if self.peer_store:
+            self.peer_store.failed(peer)
+            self.peer_store.released(peer)
+
+    def stop(self):
+        """
+        Stops connecting to peers and closes the connections not handed to a
+        PeerConnection.
+        """
+        for dial in self._dials:
+            dial.cancel()
+        while not self.connections.empty():
+            peer, _, writer, _ = self.connections.get_nowait()
+            writer.close()
+            if self.peer_store:
+                self.peer_store.released(peer)
+
+
 class PeerConnection:
     """
     A peer connection used to download and upload pieces.
 
     The peer connection will consume one available peer from the given queue.
     Based on the peer details the PeerConnection will try to open a connection
-    and perform a BitTorrent handshake.
+    and perform a BitTorrent handshake, giving up on peers not responding
+    within the connect and handshake timeouts. When given a PeerDialer, the
+    PeerConnection instead takes the next connection the dialer established.
 
     After a successful handshake, the PeerConnection will be in a *choked*
     state, not allowed to request any data from the remote peer. After sending
@@ -54,13 +275,30 @@ class PeerConnection:
     The PeerConnection will continue to request pieces for as long as there are
     pieces left to request, or until the remote peer disconnects.
 
+    The remote peer is told the pieces we have, and is unchoked once
+    interested, or when given a Choker, as decided by the choker. Its block
+    requests are queued and served from the storage by a separate task, in
+    batches written at once. Cancelled requests are dropped from the queue.
+
     If the connection with a remote peer drops, the PeerConnection will consume
     the next available peer from off the queue and try to connect to that one
     instead.
     """
 
     def __init__(
-        self, queue: Queue, info_hash, peer_id, piece_manager, on_block_cb=None
+        self,
+        queue: Queue,
+        info_hash,
+        peer_id,
+        piece_manager,
+        on_block_cb=None,
+        min_pipeline_depth: int = MIN_PIPELINE_DEPTH,
+        max_pipeline_depth: int = MAX_PIPELINE_DEPTH,
+        peer_store=None,
+        dialer: PeerDialer = None,
+        connect_timeout: float = CONNECT_TIMEOUT,
+        handshake_timeout: float = HANDSHAKE_TIMEOUT,
+        choker=None,
     ):
         """
         Constructs a PeerConnection and add it to the asyncio event-loop.
@@ -74,7 +312,21 @@ class PeerConnection:
         :param piece_manager: The manager responsible to determine which pieces
                               to request
         :param on_block_cb: The callback function to call when a block is
-                            received from the remote peer
+                            received from the remote peer. The block data is a
+                            view only valid for the duration of the call.
+        :param min_pipeline_depth: The least number of block requests to keep
+                                   in flight to the remote peer
+        :param max_pipeline_depth: The most number of block requests to keep
+                                   in flight to the remote peer
+        :param peer_store: The optional PeerStore the queued peers come from,
+                           which is told the outcome of connecting to them
+        :param dialer: The optional PeerDialer to take established
+                       connections from, instead of connecting to the peers
+                       from the queue one at a time
+        :param connect_timeout: The seconds to wait for the TCP connection
+        :param handshake_timeout: The seconds to wait for the handshake
+        :param choker: The optional Choker deciding whether the remote peer
+                       may request blocks
         """
         self.my_state = []
         self.peer_state = []
@@ -86,100 +338,191 @@ class PeerConnection:
         self.reader = None
         self.piece_manager = piece_manager
         self.on_block_cb = on_block_cb
+        self.pipeline = RequestPipeline(min_pipeline_depth, max_pipeline_depth)
+        self.peer_store = peer_store
+        self.dialer = dialer
+        self.connect_timeout = connect_timeout
+        self.handshake_timeout = handshake_timeout
+        # The (index, begin, length) of the blocks requested by the remote
+        # peer, in the order requested
+        self.uploads = OrderedDict()
+        # Set while there are queued uploads
+        self._uploads_ready = asyncio.Event()
+        # The task serving the queued uploads of the current remote peer
+        self._uploader = None
+        self.choker = choker
+        # The bytes of block data received from and sent to the current
+        # remote peer
+        self.downloaded = 0
+        self.uploaded = 0
         self.future = asyncio.ensure_future(self._start())  # Start this worker
 
     async def _start(self):
         while "stopped" not in self.my_state:
-            ip, port = await self.queue.get()
-            logging.info("Got assigned peer with: {ip}".format(ip=ip))
+            peer = None
+            # Whether the peer was taken from the queue, rather than from the
+            # dialer
+            queued = False
+            connected = False
 
             try:
-                # TODO For some reason it does not seem to work to open a new
-                # connection if the first one drops (i.e. second loop).
-                self.reader, self.writer = await asyncio.open_connection(ip, port)
-                logging.info("Connection open to peer: {ip}".format(ip=ip))
-
-                # It's our responsibility to initiate the handshake.
-                buffer = await self._handshake()
+                if self.dialer:
+                    peer, self.reader, self.writer, self.remote_id = (
+                        await self.dialer.get()
+                    )
+                else:
+                    peer = await self.queue.get()
+                    queued = True
+                    logging.info("Got assigned peer with: {ip}".format(ip=peer[0]))
+                    # It's our responsibility to initiate the handshake.
+                    self.reader, self.writer, self.remote_id = await open_peer(
+                        peer,
+                        self.info_hash,
+                        self.peer_id,
+                        self.connect_timeout,
+                        self.handshake_timeout,
+                    )
+                    if self.peer_store:
+                        self.peer_store.connected(peer)
+                connected = True
 
-                # TODO Add support for sending data
                 # Sending BitField is optional and not needed when client does
-                # not have any pieces. Thus we do not send any bitfield message
+                # not have any pieces.
+                if self.piece_manager.have_pieces:
+                    self.writer.write(BitField(self.piece_manager.bitfield()).encode())
 
                 # The default state for a connection is that peer is not
-                # interested and we are choked
+                # interested and we are choked, and that we choke the peer
                 self.my_state.append("choked")
-
-                # Let the peer know we're interested in downloading pieces
-                await self._send_interested()
-                self.my_state.append("interested")
-
-                # Start reading responses as a stream of messages for as
-                # long as the connection is open and data is transmitted
-                async for message in PeerStreamIterator(self.reader, buffer):
+                self.peer_state.append("choked")
+                self._uploader = asyncio.ensure_future(self._upload())
+
+                # Let the peer know we're interested in downloading pieces,
+                # unless only seeding
+                if not self.piece_manager.complete:
+                    await self._send_interested()
+                    self.my_state.append("interested")
+
+                # A BitField message has one bit per piece
+                max_length = max(
+                    MAX_MESSAGE_LENGTH, 1 + (self.piece_manager.total_pieces + 7) // 8
+                )
+                # Start reading responses as a stream of message batches for
+                # as long as the connection is open and data is transmitted.
+                # An empty batch is returned while the peer is silent, to
+                # expire the requests it does not answer.
+                async for messages in PeerStreamIterator(
+                    self.reader,
+                    max_length=max_length,
+                    idle_timeout=self.pipeline.timeout,
+                ):
                     if "stopped" in self.my_state:
                         break
-                    if type(message) is BitField:
-                        self.piece_manager.add_peer(self.remote_id, message.bitfield)
-                    elif type(message) is Interested:
-                        self.peer_state.append("interested")
-                    elif type(message) is NotInterested:
-                        if "interested" in self.peer_state:
-                            self.peer_state.remove("interested")
-                    elif type(message) is Choke:
-                        self.my_state.append("choked")
-                    elif type(message) is Unchoke:
-                        if "choked" in self.my_state:
-                            self.my_state.remove("choked")
-                    elif type(message) is Have:
-                        self.piece_manager.update_peer(self.remote_id, message.index)
-                    elif type(message) is KeepAlive:
-                        pass
-                    elif type(message) is Piece:
-                        self.my_state.remove("pending_request")
-                        self.on_block_cb(
-                            peer_id=self.remote_id,
-                            piece_index=message.index,
-                            block_offset=message.begin,
-                            data=message.block,
-                        )
-                    elif type(message) is Request:
-                        # TODO Add support for sending data
-                        logging.info("Ignoring the received Request message.")
-                    elif type(message) is Cancel:
-                        # TODO Add support for sending data
-                        logging.info("Ignoring the received Cancel message.")
-
-                    # Send block request to remote peer if we're interested
+                    for message in messages:
+                        self._handle_message(message)
+                    self._expire_requests()
+
+                    # Send block requests to remote peer if we're interested
                     if "choked" not in self.my_state:
                         if "interested" in self.my_state:
-                            if "pending_request" not in self.my_state:
-                                self.my_state.append("pending_request")
-                                await self._request_piece()
+                            await self._request_pieces()
 
             except ProtocolError as e:
                 logging.exception("Protocol error")
-            except (ConnectionRefusedError, TimeoutError):
+                self._peer_failed(peer)
+            except (ConnectionRefusedError, TimeoutError, asyncio.TimeoutError):
                 logging.warning("Unable to connect to peer")
+                self._peer_failed(peer)
             except (ConnectionResetError, CancelledError):
                 logging.warning("Connection closed")
+            except OSError:
+                if connected:
+                    logging.warning("Connection closed")
+                else:
+                    logging.warning("Unable to connect to peer")
+                    self._peer_failed(peer)
             except Exception as e:
                 logging.exception("An error occurred")
-                self.cancel()
                 raise e
-            self.cancel()
+            finally:
+                if self.peer_store and peer is not None:
+                    self.peer_store.released(peer)
+                self.cancel()
+                if queued:
+                    self.queue.task_done()
+
+    def _peer_failed(self, peer):
+        if self.peer_store:
+            self.peer_store.failed(peer)
+
+    def _handle_message(self, message: "PeerMessage"):
+        """
+        Updates the connection state from a message received from the remote
+        peer.
+        """
+        if type(message) is BitField:
+            self.piece_manager.add_peer(self.remote_id, message.bitfield)
+        elif type(message) is Interested:
+            self.peer_state.append("interested")
+            if self.choker:
+                self.choker.peer_interested(self)
+            elif self.piece_manager.have_pieces:
+                self.unchoke_peer()
+        elif type(message) is NotInterested:
+            if "interested" in self.peer_state:
+                self.peer_state.remove("interested")
+        elif type(message) is Choke:
+            # A choking peer discards all requests it has not served yet
+            self.my_state.append("choked")
+            self._return_requests()
+        elif type(message) is Unchoke:
+            if "choked" in self.my_state:
+                self.my_state.remove("choked")
+        elif type(message) is Have:
+            self.piece_manager.update_peer(self.remote_id, message.index)
+        elif type(message) is KeepAlive:
+            pass
+        elif type(message) is Piece:
+            self.pipeline.received(message.index, message.begin, len(message.block))
+            self.downloaded += len(message.block)
+            self.on_block_cb(
+                peer_id=self.remote_id,
+                piece_index=message.index,
+                block_offset=message.begin,
+                data=message.block,
+            )
+        elif type(message) is Request:
+            self._queue_upload(message)
+        elif type(message) is Cancel:
+            self.uploads.pop((message.index, message.begin, message.length), None)
 
     def cancel(self):
         """
-        Sends the cancel message to the remote peer and closes the connection.
+        Closes the connection to the current remote peer and resets the
+        connection state, allowing the worker to continue with the next peer
+        from the queue.
         """
         logging.info("Closing peer {id}".format(id=self.remote_id))
-        if not self.future.done():
-            self.future.cancel()
+        if self._uploader:
+            self._uploader.cancel()
+            self._uploader = None
+        self.uploads.clear()
         if self.writer:
             self.writer.close()
+        if self.remote_id:
+            self._return_requests()
+            self.piece_manager.remove_peer(self.remote_id)
 
-        self.queue.task_done()
+        self.reader = None
+        self.writer = None
+        self.remote_id = None
+        self.my_state = [s for s in self.my_state if s == "stopped"]
+        self.peer_state = []
+        self.downloaded = 0
+        self.uploaded = 0
+        self.pipeline = RequestPipeline(
+            self.pipeline.min_depth, self.pipeline.max_depth, self.pipeline.timeout
+        )
 
     def stop(self):
         """
@@ -187,16 +530,22 @@ class PeerConnection:
         from connecting to any new peer.
         """
         # Set state to stopped and cancel our future to break out of the loop.
-        # The rest of the cleanup will eventually be managed by loop calling
-        # `cancel`.
+        # The rest of the cleanup is managed by the loop calling `cancel` on
+        # its way out.
         self.my_state.append("stopped")
         if not self.future.done():
             self.future.cancel()
 
-    async def _request_piece(self):
-        block = self.piece_manager.next_request(self.remote_id)
-        if block:
-            message = Request(block.piece, block.offset, block.length).encode()
+    async def _request_pieces(self):
+        """
+        Fills the request pipeline to its current depth, sending all new
+        requests to the remote peer with a single write.
+        """
+        messages = []
+        while self.pipeline.free > 0:
+            block = self.piece_manager.next_request(self.remote_id)
+            if not block:
+                break
 
             logging.debug(
                 "Requesting block {block} for piece {piece} "
@@ -207,39 +556,139 @@ class PeerConnection:
                     peer=self.remote_id,
                 )
             )
+            self.pipeline.sent(block.piece, block.offset)
+            messages.append(Request(block.piece, block.offset, block.length).encode())
 
-            self.writer.write(message)
+        if messages:
+            self.writer.write(b"".join(messages))
             await self.writer.drain()
 
-    async def _handshake(self):
+    def _return_requests(self):
         """
-        Send the initial handshake to the remote peer and wait for the peer
-        to respond with its handshake.
+        Gives the requests in flight back to the piece manager, to be
+        requested from other peers.
         """
-        self.writer.write(Handshake(self.info_hash, self.peer_id).encode())
-        await self.writer.drain()
+        if self.pipeline.pending:
+            self.piece_manager.cancel_requests(
+                self.remote_id, list(self.pipeline.pending)
+            )
+        self.pipeline.clear()
+
+    def _expire_requests(self):
+        expired = self.pipeline.expired()
+        if expired:
+            logging.debug(
+                "{count} requests to peer {peer} timed out".format(
+                    count=len(expired), peer=self.remote_id
+                )
+            )
+            self.piece_manager.cancel_requests(self.remote_id, expired)
+
+    def send_have(self, index: int):
+        """
+        Tells the remote peer that we have the piece with the given index.
+        """
+        if self.writer and self.remote_id:
+            self.writer.write(Have(index).encode())
 
-        buf = b""
-        tries = 1
-        while len(buf) < Handshake.length and tries < 10:
-            tries += 1
-            buf = await self.reader.read(PeerStreamIterator.CHUNK_SIZE)
+    def unchoke_peer(self):
+        """
+        Allows the remote peer to request blocks.
+        """
+        if "choked" in self.peer_state and self.writer:
+            self.peer_state.remove("choked")
+            self.writer.write(Unchoke().encode())
+
+    def choke_peer(self):
+        """
+        Stops the remote peer from requesting blocks, discarding the blocks
+        it requested and we did not send yet.
+        """
+        if "choked" not in self.peer_state and self.writer:
+            self.peer_state.append("choked")
+            self.uploads.clear()
+            self.writer.write(Choke().encode())
 
-        response = Handshake.decode(buf[: Handshake.length])
-        if not response:
-            raise ProtocolError("Unable receive and parse a handshake")
-        if not response.info_hash == self.info_hash:
-            raise ProtocolError("Handshake with invalid info_hash")
+    def _queue_upload(self, message: "Request"):
+        """
+        Queues a block requested by the remote peer, unless the request is
+        not allowed or the queue is full.
+        """
+        if "choked" in self.peer_state:
+            # Requests sent before being choked are discarded with it
+            logging.debug("Ignoring request from choked peer")
+        elif message.length > MAX_UPLOAD_REQUEST_SIZE:
+            logging.debug(
+                "Ignoring request of {length} bytes".format(length=message.length)
+            )
+        elif not self.piece_manager.has_piece(message.index):
+            logging.debug(
+                "Ignoring request for missing piece {index}".format(index=message.index)
+            )
+        elif len(self.uploads) >= MAX_QUEUED_UPLOADS:
+            logging.debug("Ignoring request exceeding the upload queue")
+        else:
+            self.uploads[(message.index, message.begin, message.length)] = None
+            self._uploads_ready.set()
 
-        # TODO: According to spec we should validate that the peer_id received
-        # from the peer match the peer_id received from the tracker.
-        self.remote_id = response.peer_id
-        logging.info("Handshake with peer was successful")
+    async def _upload(self):
+        """
+        Sends the queued blocks to the remote peer.
 
-        # We need to return the remaining buffer data, since we might have
-        # read more bytes then the size of the handshake message and we need
-        # those bytes to parse the next message.
-        return buf[Handshake.length :]
+        The blocks are copied from the storage's mapped files straight into
+        a single buffer per batch, including their message headers, and sent
+        with a single write. The next batch is prepared once the transport's
+        buffer drained, so cancelled requests are dropped before being sent.
+        """
+        try:
+            while True:
+                if not self.uploads:
+                    self._uploads_ready.clear()
+                    await self._uploads_ready.wait()
+                    continue
+
+                blocks = []
+                size = 0
+                while self.uploads and len(blocks) < UPLOAD_BATCH_SIZE:
+                    block, _ = self.uploads.popitem(last=False)
+                    blocks.append(block)
+                    size += 4 + Piece.length + block[2]
+
+                buffer = bytearray(size)
+                position = 0
+                uploaded = 0
+                for index, begin, length in blocks:
+                    data = self.piece_manager.read_block(index, begin, length)
+                    if data is None:
+                        logging.debug(
+                            "Unable to serve block {begin} of piece {index}".format(
+                                begin=begin, index=index
+                            )
+                        )
+                        continue
+                    with data:
+                        Piece.header.pack_into(
+                            buffer,
+                            position,
+                            Piece.length + length,
+                            PeerMessage.Piece,
+                            index,
+                            begin,
+                        )
+                        position += Piece.header.size
+                        buffer[position : position + length] = data
+                    position += length
+                    uploaded += length
+
+                if position:
+                    del buffer[position:]
+                    self.writer.write(buffer)
+                    self.piece_manager.block_uploaded(uploaded)
+                    self.uploaded += uploaded
+                    await self.writer.drain()
+        except (ConnectionError, OSError) as e:
+            # The connection is closed by the reading side
+            logging.debug("Upload stopped: {error}".format(error=e))
 
     async def _send_interested(self):
         message = Interested()
@@ -248,42 +697,212 @@ class PeerConnection:
         await self.writer.drain()
 
 
+class RequestPipeline:
+    """
+    Keeps track of the block requests in flight to a single remote peer and
+    how many more requests may be sent.
+
+    The depth of the pipeline adapts to the bandwidth-delay product of the
+    peer: the download rate is measured over intervals of at least
+    `RATE_INTERVAL` seconds, and the round-trip time is the shortest time
+    observed between sending a request and receiving its block (longer times
+    are caused by requests queuing up at the peer). Keeping twice the
+    bandwidth-delay product in flight lets the pipeline grow until the peer's
+    upload rate is saturated, after which the additional queuing delay stops
+    the growth.
+
+    Requests not answered within `timeout` seconds are expired, freeing
+    their place in the pipeline.
+    """
+
+    RATE_INTERVAL = 1.0
+
+    # The weight of the latest interval in the smoothed download rate
+    RATE_SMOOTHING = 0.5
+
+    def __init__(
+        self,
+        min_depth: int = MIN_PIPELINE_DEPTH,
+        max_depth: int = MAX_PIPELINE_DEPTH,
+        timeout: float = REQUEST_TIMEOUT,
+    ):
+        if not 0 < min_depth <= max_depth:
+            raise ValueError("Invalid pipeline depth bounds")
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.timeout = timeout
+        self.depth = min_depth
+        self.rate = 0.0
+        self.rtt = None
+        # Maps (piece index, block offset) to the time the request was sent
+        self.pending = {}
+        self._interval_start = None
+        self._interval_bytes = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    @property
+    def free(self) -> int:
+        """
+        The number of requests that can be sent without exceeding the depth.
+        """
+        return self.depth - len(self.pending)
+
+    def sent(self, piece: int, offset: int, now: float = None):
+        """
+        Registers a request sent to the remote peer.
+        """
+        now = time.monotonic() if now is None else now
+        self.pending[(piece, offset)] = now
+        if self._interval_start is None:
+            self._interval_start = now
+
+    def received(self, piece: int, offset: int, length: int, now: float = None):
+        """
+        Registers a block received from the remote peer and adapts the depth
+        of the pipeline to the updated measurements.
+
+        :return True if the block was requested, False otherwise
+        """
+        now = time.monotonic() if now is None else now
+        requested_at = self.pending.pop((piece, offset), None)
+        if requested_at is None:
+            return False
+
+        latency = now - requested_at
+        if self.rtt is None or latency < self.rtt:
+            self.rtt = latency
+
+        self._interval_bytes += length
+        elapsed = now - self._interval_start
+        if elapsed >= RequestPipeline.RATE_INTERVAL:
+            rate = self._interval_bytes / elapsed
+            if self.rate:
+                smoothing = RequestPipeline.RATE_SMOOTHING
+                rate = smoothing * rate + (1 - smoothing) * self.rate
+            self.rate = rate
+            self._interval_start = now
+            self._interval_bytes = 0
+            self._adapt()
+        return True
+
+    def expired(self, now: float = None) -> list:
+        """
+        Forgets the requests sent more than `timeout` seconds ago.
+
+        :return The (piece index, block offset) of the expired requests
+        """
+        now = time.monotonic() if now is None else now
+        expired = []
+        # Requests are ordered by the time they were sent
+        for key, sent in self.pending.items():
+            if sent + self.timeout > now:
+                break
+            expired.append(key)
+        for key in expired:
+            del self.pending[key]
+        return expired
+
+    def clear(self):
+        """
+        Forgets all requests in flight, e.g. when the peer choked us.
+        """
+        self.pending.clear()
+        self._interval_start = None
+        self._interval_bytes = 0
+
+    def _adapt(self):
+        bandwidth_delay = self.rate * self.rtt
+        depth = math.ceil(2 * bandwidth_delay / REQUEST_SIZE)
+        self.depth = max(self.min_depth, min(self.max_depth, depth))
+
+
 class PeerStreamIterator:
     """
     The `PeerStreamIterator` is an async iterator that continuously reads from
     the given stream reader and tries to parse valid BitTorrent messages from
-    off that stream of bytes.
+    off that stream of bytes. Each iteration yields a list with every message
+    that could be parsed from the bytes read so far.
+
+    Incoming bytes are read straight into a preallocated buffer tracked by a
+    read and a write cursor. Parsing a message only advances the read cursor,
+    and payloads (such as the block of a `Piece`) are returned as `memoryview`
+    slices of that buffer rather than copies.
+
+    NOTE: A payload view is only valid until the next batch is requested
+          from the iterator, after which the buffer may be compacted or
+          refilled. Consumers that need to keep the data must copy it (or
+          write it to disk) before advancing the iterator.
 
     If the connection is dropped, something fails the iterator will abort by
     raising the `StopAsyncIteration` error ending the calling iteration.
+
+    Messages longer than `max_length` raise a ProtocolError, before any
+    memory is reserved for them. When given an `idle_timeout`, an empty batch
+    is returned whenever no data was read for that many seconds.
     """
 
     CHUNK_SIZE = 10 * 1024
 
-    def __init__(self, reader, initial: bytes = None):
+    # The initial size of the read buffer. Large enough to hold several
+    # complete `Piece` messages, the buffer only grows if a single message
+    # does not fit.
+    BUFFER_SIZE = 2**18
+
+    def __init__(
+        self,
+        reader,
+        initial: bytes = None,
+        max_length: int = MAX_MESSAGE_LENGTH,
+        idle_timeout: float = None,
+    ):
         self.reader = reader
-        self.buffer = initial if initial else b""
+        self.max_length = max_length
+        self.idle_timeout = idle_timeout
+        self._buffer = bytearray(PeerStreamIterator.BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        self._read = 0
+        self._write = 0
+        # Number of bytes still missing to complete the message at the read
+        # cursor, used to reserve enough room before the next read.
+        self._missing = 0
+        if initial:
+            self._append(initial)
+
+    @property
+    def buffer(self) -> bytes:
+        """
+        A copy of the bytes read from the stream but not yet parsed.
+        """
+        return bytes(self._view[self._read : self._write])
 
-    async def __aiter__(self):
+    @buffer.setter
+    def buffer(self, data: bytes):
+        self._read = 0
+        self._write = 0
+        self._missing = 0
+        if data:
+            self._append(data)
+
+    def __aiter__(self):
         return self
 
     async def __anext__(self):
-        # Read data from the socket. When we have enough data to parse, parse
-        # it and return the message. Until then keep reading from stream
+        # Parse every complete message already in the buffer and return them
+        # as one batch. Only when no message is complete, read more data from
+        # the socket and try again.
         while True:
             try:
-                data = await self.reader.read(PeerStreamIterator.CHUNK_SIZE)
-                if data:
-                    self.buffer += data
-                    message = self.parse()
-                    if message:
-                        return message
-                else:
+                messages = self.parse_batch()
+                if messages:
+                    return messages
+                try:
+                    read = await asyncio.wait_for(self._read_into(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    return []
+                if not read:
                     logging.debug("No data read from stream")
-                    if self.buffer:
-                        message = self.parse()
-                        if message:
-                            return message
                     raise StopAsyncIteration()
             except ConnectionResetError:
                 logging.debug("Connection closed by peer")
@@ -298,6 +917,64 @@ class PeerStreamIterator:
                 raise StopAsyncIteration()
         raise StopAsyncIteration()
 
+    async def _read_into(self) -> int:
+        """
+        Reads the next chunk from the stream into the free space after the
+        write cursor.
+
+        :return The number of bytes read, 0 when the stream is exhausted
+        """
+        self._reserve(max(PeerStreamIterator.CHUNK_SIZE, self._missing))
+        data = await self.reader.read(len(self._buffer) - self._write)
+        self._view[self._write : self._write + len(data)] = data
+        self._write += len(data)
+        return len(data)
+
+    def _append(self, data: bytes):
+        self._reserve(len(data))
+        self._view[self._write : self._write + len(data)] = data
+        self._write += len(data)
+
+    def _reserve(self, size: int):
+        """
+        Makes sure there are at least `size` free bytes after the write
+        cursor, by moving the unparsed bytes to the front of the buffer or
+        (if they still do not fit) moving them to a larger buffer.
+        """
+        if self._read == self._write:
+            self._read = 0
+            self._write = 0
+        if len(self._buffer) - self._write >= size:
+            return
+
+        pending = self._write - self._read
+        if pending + size > len(self._buffer):
+            # Views handed out earlier keep referencing the old buffer
+            self._buffer = bytearray(max(2 * len(self._buffer), pending + size))
+            view = memoryview(self._buffer)
+            view[:pending] = self._view[self._read : self._write]
+            self._view = view
+        else:
+            self._view[:pending] = self._view[self._read : self._write]
+        self._read = 0
+        self._write = pending
+
+    def parse_batch(self) -> list:
+        """
+        Parses all complete protocol messages in the buffer.
+
+        The payload views of the returned messages stay valid until the next
+        read from the stream.
+
+        :return The list of parsed messages, empty if no message is complete
+        """
+        messages = []
+        message = self.parse()
+        while message:
+            messages.append(message)
+            message = self.parse()
+        return messages
+
     def parse(self):
         """
         Tries to parse protocol messages if there is enough bytes read in the
@@ -316,59 +993,54 @@ class PeerStreamIterator:
         # 4 bytes needs to be included when slicing the buffer.
         header_length = 4
 
-        if len(self.buffer) > 4:  # 4 bytes is needed to identify the message
-            message_length = struct.unpack(">I", self.buffer[0:4])[0]
+        while self._write - self._read >= header_length:
+            message_length = struct.unpack_from(">I", self._view, self._read)[0]
+            if message_length > self.max_length:
+                raise ProtocolError(
+                    "Message of {length} bytes exceeds the limit".format(
+                        length=message_length
+                    )
+                )
+            available = self._write - self._read
+
+            if available < header_length + message_length:
+                logging.debug("Not enough in buffer in order to parse")
+                self._missing = header_length + message_length - available
+                return None
+
+            # Consume the current message from the read buffer, the returned
+            # messages only hold views of the consumed region
+            start = self._read
+            self._read += header_length + message_length
+            self._missing = 0
 
             if message_length == 0:
                 return KeepAlive()
 
-            if len(self.buffer) >= message_length:
-                message_id = struct.unpack(">b", self.buffer[4:5])[0]
-
-                def _consume():
-                    """Consume the current message from the read buffer"""
-                    self.buffer = self.buffer[header_length + message_length :]
-
-                def _data():
-                    """ "Extract the current message from the read buffer"""
-                    return self.buffer[: header_length + message_length]
-
-                if message_id is PeerMessage.BitField:
-                    data = _data()
-                    _consume()
-                    return BitField.decode(data)
-                elif message_id is PeerMessage.Interested:
-                    _consume()
-                    return Interested()
-                elif message_id is PeerMessage.NotInterested:
-                    _consume()
-                    return NotInterested()
-                elif message_id is PeerMessage.Choke:
-                    _consume()
-                    return Choke()
-                elif message_id is PeerMessage.Unchoke:
-                    _consume()
-                    return Unchoke()
-                elif message_id is PeerMessage.Have:
-                    data = _data()
-                    _consume()
-                    return Have.decode(data)
-                elif message_id is PeerMessage.Piece:
-                    data = _data()
-                    _consume()
-                    return Piece.decode(data)
-                elif message_id is PeerMessage.Request:
-                    data = _data()
-                    _consume()
-                    return Request.decode(data)
-                elif message_id is PeerMessage.Cancel:
-                    data = _data()
-                    _consume()
-                    return Cancel.decode(data)
-                else:
-                    logging.info("Unsupported message!")
+            message_id = self._view[start + header_length]
+            data = self._view[start : self._read]
+
+            if message_id == PeerMessage.BitField:
+                return BitField.decode(data)
+            elif message_id == PeerMessage.Interested:
+                return Interested()
+            elif message_id == PeerMessage.NotInterested:
+                return NotInterested()
+            elif message_id == PeerMessage.Choke:
+                return Choke()
+            elif message_id == PeerMessage.Unchoke:
+                return Unchoke()
+            elif message_id == PeerMessage.Have:
+                return Have.decode(data)
+            elif message_id == PeerMessage.Piece:
+                return Piece.decode(data)
+            elif message_id == PeerMessage.Request:
+                return Request.decode(data)
+            elif message_id == PeerMessage.Cancel:
+                return Cancel.decode(data)
             else:
-                logging.debug("Not enough in buffer in order to parse")
+                # Skip past the message so it does not block the stream
+                logging.info("Unsupported message!")
         return None
 
 
@@ -517,13 +1189,8 @@ class BitField(PeerMessage):
         Encodes this object instance to the raw bytes representing the entire
         message (ready to be transmitted).
         """
-        bits_length = len(self.bitfield)
-        return struct.pack(
-            ">Ib" + str(bits_length) + "s",
-            1 + bits_length,
-            PeerMessage.BitField,
-            self.bitfield,
-        )
+        data = self.bitfield.tobytes()
+        return struct.pack(">Ib", 1 + len(data), PeerMessage.BitField) + data
 
     @classmethod
     def decode(cls, data: bytes):
@@ -583,6 +1250,9 @@ class Choke(PeerMessage):
         <len=0001><id=0>
     """
 
+    def encode(self) -> bytes:
+        return struct.pack(">Ib", 1, PeerMessage.Choke)
+
     def __str__(self):
         return "Choke"
 
@@ -596,6 +1266,9 @@ class Unchoke(PeerMessage):
         <len=0001><id=1>
     """
 
+    def encode(self) -> bytes:
+        return struct.pack(">Ib", 1, PeerMessage.Unchoke)
+
     def __str__(self):
         return "Unchoke"
 
@@ -678,6 +1351,9 @@ class Piece(PeerMessage):
     # The Piece message length without the block data
     length = 9
 
+    # The length prefix, id, index and begin preceding the block data
+    header = struct.Struct(">IbII")
+
     def __init__(self, index: int, begin: int, block: bytes):
         """
         Constructs the Piece message.
@@ -704,11 +1380,10 @@ class Piece(PeerMessage):
     @classmethod
     def decode(cls, data: bytes):
         logging.debug("Decoding Piece of length: {length}".format(length=len(data)))
-        length = struct.unpack(">I", data[:4])[0]
-        parts = struct.unpack(
-            ">IbII" + str(length - Piece.length) + "s", data[: length + 4]
-        )
-        return cls(parts[2], parts[3], parts[4])
+        # Tuple with (message length, id, index, begin)
+        parts = struct.unpack_from(">IbII", data)
+        # Slicing keeps the block a view when decoding from a memoryview
+        return cls(parts[2], parts[3], data[Piece.length + 4 : parts[0] + 4])
 
     def __str__(self):
         return "Piece"
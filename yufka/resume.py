@@ -0,0 +1,117 @@
+import logging
+import os
+from collections import namedtuple
+
+from yufka import bencoding
+from yufka.storage import file_paths
+
+# The resume file is stored next to the output file, with this suffix
+RESUME_SUFFIX = ".resume"
+
+# The pieces recorded in a resume file, and whether the output files are
+# unchanged since they were recorded (else they must be verified again)
+ResumeState = namedtuple("ResumeState", ["pieces", "verified"])
+
+
+class FastResume:
+    """
+    The fast resume file records which pieces of a torrent have been
+    downloaded and verified, together with the size and modification time of
+    the output files at the time they were recorded.
+
+    When restarting a download the pieces can be trusted without hashing
+    the output files again, as long as they were not modified since.
+    """
+
+    def __init__(self, torrent, path: str = None):
+        self.torrent = torrent
+        self.path = path if path else torrent.output_file + RESUME_SUFFIX
+
+    def load(self) -> ResumeState:
+        """
+        Reads the resume file and compares it against the output files.
+
+        This must be called before the output files are opened for writing,
+        since that might update their modification time.
+
+        :return The recorded state or None if there is no usable resume file
+                for the torrent
+        """
+        try:
+            with open(self.path, "rb") as f:
+                resume = bencoding.Decoder(f.read()).decode()
+            stat_size, stat_mtime = self._stat()
+        except FileNotFoundError:
+            return None
+        except (EOFError, IndexError, RuntimeError, ValueError):
+            logging.warning("Ignoring invalid resume file {}".format(self.path))
+            return None
+
+        try:
+            info_hash = resume[b"info hash"]
+            bitfield = resume[b"pieces"]
+            size = resume[b"size"]
+            mtime = resume[b"mtime"]
+            if not (
+                isinstance(info_hash, bytes)
+                and isinstance(bitfield, bytes)
+                and isinstance(size, int)
+                and isinstance(mtime, int)
+            ):
+                raise TypeError("Invalid field of resume file")
+        except (KeyError, TypeError):
+            logging.warning("Ignoring invalid resume file {}".format(self.path))
+            return None
+        if info_hash != self.torrent.info_hash:
+            logging.warning("Ignoring resume file for another torrent")
+            return None
+
+        pieces = [
+            index
+            for index in range(min(len(self.torrent.pieces), len(bitfield) * 8))
+            if bitfield[index >> 3] & (0x80 >> (index & 7))
+        ]
+        verified = stat_size == size and stat_mtime == mtime
+        return ResumeState(pieces, verified)
+
+    def _stat(self):
+        """
+        Returns the total size and the latest modification time (in
+        nanoseconds) of the output files.
+        """
+        size = 0
+        mtime = 0
+        for path in file_paths(self.torrent):
+            stat = os.stat(path)
+            size += stat.st_size
+            mtime = max(mtime, stat.st_mtime_ns)
+        return size, mtime
+
+    def save(self, pieces):
+        """
+        Records the given verified pieces along with the current size and
+        modification time of the output files.
+
+        For the recorded time to be trusted on the next load, all data must
+        have been written to the output files before saving.
+
+        :param pieces: The indices of the verified pieces
+        """
+        bitfield = bytearray((len(self.torrent.pieces) + 7) // 8)
+        for index in pieces:
+            bitfield[index >> 3] |= 0x80 >> (index & 7)
+        stat_size, stat_mtime = self._stat()
+
+        resume = {
+            b"info hash": self.torrent.info_hash,
+            b"mtime": stat_mtime,
+            b"pieces": bitfield,
+            b"size": stat_size,
+        }
+
+        # Replace the previous resume file atomically, a partially written
+        # file would be ignored and all progress lost
+        temporary = self.path + ".tmp"
+        with open(temporary, "wb") as f:
+            bencoding.Encoder(resume).encode_to(f)
+        os.replace(temporary, self.path)
@@ -0,0 +1,180 @@
+import logging
+import mmap
+import os
+
+from yufka.torrent import FileIndex
+
+
+def file_paths(torrent, root: str = None) -> list:
+    """
+    Returns the paths of the files of a torrent.
+
+    :param torrent: The torrent
+    :param root: The path of the output file, or of the output directory of
+                 a multi-file torrent, defaults to the torrent's output file
+    """
+    root = root if root else torrent.output_file
+    if not torrent.multi_file:
+        return [root]
+    return [os.path.join(root, file.name) for file in torrent.files]
+
+
+class Storage:
+    """
+    The storage holds the content of a torrent in its output files.
+
+    The files are preallocated to their full size and memory mapped, so
+    blocks received from peers are written straight to their position in
+    the files without being buffered in memory until their piece is
+    complete.
+
+    The content of the torrent is the concatenation of its files. The
+    position of a block within the content (`piece index * piece length +
+    block offset`) is mapped to the files it is stored in through the
+    torrent's file index.
+
+    When opened read-only, e.g. to check the downloaded data, the files are
+    neither created nor modified, and missing or truncated files read as
+    short data.
+    """
+
+    def __init__(self, torrent, root: str = None, readonly: bool = False):
+        self.path = root if root else torrent.output_file
+        self.size = torrent.total_size
+        self.piece_length = torrent.piece_length
+        self.readonly = readonly
+        self.index = FileIndex(torrent.files)
+        self.paths = file_paths(torrent, self.path)
+        self.fds = []
+        self.mmaps = []
+        # The size of the mapped part of each file
+        self.sizes = []
+        for path, length in zip(self.paths, self.index.lengths):
+            if readonly:
+                self._open_readonly(path, length)
+            else:
+                self._open(path, length)
+
+    def _open(self, path: str, length: int):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        self.fds.append(fd)
+        self._preallocate(fd, path, length)
+        # A file cannot be mapped with a length of zero
+        self.mmaps.append(mmap.mmap(fd, length) if length else None)
+        self.sizes.append(length)
+
+    def _open_readonly(self, path: str, length: int):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            fd = None
+        self.fds.append(fd)
+        size = min(os.fstat(fd).st_size, length) if fd is not None else 0
+        self.mmaps.append(
+            mmap.mmap(fd, size, access=mmap.ACCESS_READ) if size else None
+        )
+        self.sizes.append(size)
+
+    @staticmethod
+    def _preallocate(fd: int, path: str, length: int):
+        """
+        Reserves the disk space for the full size of the file, keeping any
+        data already in the file.
+        """
+        if os.fstat(fd).st_size != length:
+            os.ftruncate(fd, length)
+        if length and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, length)
+            except OSError:
+                # Not supported by all file systems, the file is still sparse
+                logging.debug("Unable to preallocate {path}".format(path=path))
+
+    def write(self, piece_index: int, block_offset: int, data):
+        """
+        Writes a block of data to its position in the files.
+
+        :param piece_index: The zero based piece index
+        :param block_offset: The zero based offset within the piece
+        :param data: The block data, any object supporting the buffer protocol
+        """
+        if self.readonly:
+            raise ValueError("Storage is read-only")
+        start = piece_index * self.piece_length + block_offset
+        view = memoryview(data).cast("B")
+        if start + view.nbytes > self.size:
+            raise ValueError("Block exceeds the size of the torrent")
+        position = 0
+        for index, file_offset, length in self.index.spans(start, view.nbytes):
+            self.mmaps[index][file_offset : file_offset + length] = view[
+                position : position + length
+            ]
+            position += length
+
+    def read(self, piece_index: int, block_offset: int, length: int) -> memoryview:
+        """
+        Returns a view of the data at the given position in the files.
+
+        Data within a single file is not copied, the view must be released
+        (e.g. by using it as a context manager) before the storage is
+        closed.
+        """
+        start = piece_index * self.piece_length + block_offset
+        spans = self.index.spans(start, length)
+        if len(spans) == 1:
+            index, file_offset, length = spans[0]
+            end = min(file_offset + length, self.sizes[index])
+            if self.mmaps[index] is None:
+                return memoryview(b"")
+            return memoryview(self.mmaps[index])[file_offset:end]
+
+        parts = []
+        for index, file_offset, length in spans:
+            end = min(file_offset + length, self.sizes[index])
+            if end > file_offset:
+                parts.append(self.mmaps[index][file_offset:end])
+            if end < file_offset + length:
+                # The data after a missing part would be misplaced
+                break
+        return memoryview(b"".join(parts))
+
+    def piece(self, index: int) -> memoryview:
+        """
+        Returns a view of all data of the piece with the given index, see
+        `read`.
+        """
+        return self.read(index, 0, self.piece_length)
+
+    def advise(self, advice: int):
+        """
+        Passes the advice (e.g. `mmap.MADV_SEQUENTIAL`) on the expected
+        access pattern to the kernel, where supported.
+        """
+        for mapped in self.mmaps:
+            if mapped is not None and hasattr(mapped, "madvise"):
+                mapped.madvise(advice)
+
+    def flush(self):
+        if self.readonly:
+            return
+        for mapped in self.mmaps:
+            if mapped is not None:
+                mapped.flush()
+
+    def close(self):
+        """
+        Flushes all written data to disk and closes the files.
+        """
+        self.flush()
+        for mapped in self.mmaps:
+            if mapped is not None:
+                mapped.close()
+        for fd in self.fds:
+            if fd is not None:
+                os.close(fd)
+        self.mmaps = []
+        self.fds = []
+        self.sizes = []
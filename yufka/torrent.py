@@ -1,66 +1,270 @@
+import logging
+import os
+import sys
+from array import array
+from bisect import bisect_right
 from hashlib import sha1
 from collections import namedtuple
+from functools import cached_property
 from yufka import bencoding
 
-
+# A file of the torrent, for multi-file torrents the name is the path of
+# the file within the torrent's directory
 TorrentFile = namedtuple("TorrentFile", ["name", "length"])
 
+# The length of the SHA1 hash of each piece
+HASH_LENGTH = 20
+
+
+def _valid_path_component(component: str) -> bool:
+    """
+    Tells whether a file name of the torrent stays within its directory,
+    names with a separator (including absolute paths) are rejected.
+    """
+    return component not in ("", ".", "..") and os.sep not in component
+
+
+class PieceHashes:
+    """
+    The table of SHA1 hashes of the pieces of a torrent.
+
+    The hashes are not split up front, but kept in the `pieces` string of
+    the info dict and sliced when accessed by their piece index.
+    """
+
+    def __init__(self, data: bytes):
+        if len(data) % HASH_LENGTH:
+            raise RuntimeError("Invalid length of piece hashes")
+        self._data = data
+        # A read-only view of all hashes, in the order of their pieces
+        self.view = memoryview(data)
+
+    def __len__(self):
+        return len(self._data) // HASH_LENGTH
+
+    def __getitem__(self, index: int) -> bytes:
+        return self.hash_for(index)
+
+    def __iter__(self):
+        data = self._data
+        for offset in range(0, len(data), HASH_LENGTH):
+            yield data[offset : offset + HASH_LENGTH]
+
+    def hash_for(self, index: int) -> bytes:
+        """
+        Returns the hash of the piece with the given zero based index.
+        """
+        if not 0 <= index < len(self):
+            raise IndexError("Piece index out of range")
+        offset = index * HASH_LENGTH
+        return self._data[offset : offset + HASH_LENGTH]
+
+
+class FileIndex:
+    """
+    Maps ranges of the torrent's data to the files they are stored in.
+
+    The data of a torrent is the concatenation of its files, so a piece or
+    block may span several files. The offsets at which the files start are
+    precomputed, so the file holding a given offset is found by bisection.
+    """
+
+    def __init__(self, files):
+        self.lengths = [file.length for file in files]
+        self.offsets = []
+        offset = 0
+        for length in self.lengths:
+            self.offsets.append(offset)
+            offset += length
+        self.size = offset
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def spans(self, offset: int, length: int) -> list:
+        """
+        Splits a range of the torrent's data by the files it is stored in.
+
+        :param offset: The zero based offset within the torrent's data
+        :param length: The length of the range
+        :return A list of (file index, offset within the file, length) spans,
+                the part of the range past the end of the data is left out
+        """
+        lengths = self.lengths
+        index = bisect_right(self.offsets, offset) - 1
+        file_offset = offset - self.offsets[index] if index >= 0 else 0
+        spans = []
+        while length > 0 and 0 <= index < len(lengths):
+            span = min(length, lengths[index] - file_offset)
+            # Empty files do not hold any data
+            if span > 0:
+                spans.append((index, file_offset, span))
+                length -= span
+            index += 1
+            file_offset = 0
+        return spans
+
 
 class Torrent:
-    def __init__(self, filename):
+    """
+    The metadata of a torrent, read from a .torrent file.
+
+    When given a `MetadataCache`, the parsed metadata is stored in the cache
+    and loaded from it as long as the torrent file is unchanged, skipping
+    the decoding of the file and the hashing of its info dict. The info dict
+    of metadata restored from the cache lacks the list of files, which is
+    only available parsed as `files`.
+    """
+
+    def __init__(self, filename, cache=None):
         self.filename = filename
         self.files = []
 
+        if cache is not None and self._restore(cache.get(filename)):
+            return
+
         with open(self.filename, "rb") as f:
             meta_info = f.read()
-            self.meta_info = bencoding.Decoder(meta_info).decode()
-            info = bencoding.Encoder(self.meta_info[b"info"]).encode()
-            self.info_hash = sha1(info).digest()
+            decoder = bencoding.Decoder(meta_info)
+            self.meta_info = decoder.decode()
+            # The info hash is calculated over the info dict exactly as it is
+            # encoded in the file, which need not be canonically ordered
+            start, end = decoder.spans[b"info"]
+            self.info_hash = sha1(memoryview(meta_info)[start:end]).digest()
+            self.multi_file = b"files" in self.meta_info[b"info"]
             self._identify_files()
 
+        if cache is not None:
+            cache.put(filename, self._cache_entry())
+
+    def _cache_entry(self) -> dict:
+        """
+        Returns the parsed metadata to be cached.
+
+        The list of files in the info dict is replaced by a compact form of
+        the parsed files: their names joined by NUL characters, and their
+        lengths as an array of little endian 64-bit integers.
+        """
+        info = self.meta_info[b"info"]
+        lengths = array("Q", (file.length for file in self.files))
+        if sys.byteorder != "little":
+            lengths.byteswap()
+        return {
+            b"file lengths": lengths.tobytes(),
+            b"file names": b"\0".join(file.name.encode() for file in self.files),
+            b"info hash": self.info_hash,
+            b"meta info": {
+                **self.meta_info,
+                b"info": {key: info[key] for key in info if key != b"files"},
+            },
+            b"multi file": int(self.multi_file),
+        }
+
+    def _restore(self, entry: dict) -> bool:
+        """
+        Restores the parsed metadata from a cache entry.
+
+        :return True if restored, False if there is no usable entry
+        """
+        if entry is None:
+            return False
+        try:
+            lengths = array("Q")
+            lengths.frombytes(entry[b"file lengths"])
+            if sys.byteorder != "little":
+                lengths.byteswap()
+            names = entry[b"file names"].decode().split("\0")
+            if len(names) != len(lengths):
+                raise ValueError("Number of files does not match")
+            self.files = [TorrentFile(n, length) for n, length in zip(names, lengths)]
+            self.info_hash = entry[b"info hash"]
+            self.meta_info = entry[b"meta info"]
+            self.multi_file = bool(entry[b"multi file"])
+            if not _valid_path_component(self.output_file):
+                raise ValueError("Invalid name")
+        except (KeyError, TypeError, ValueError):
+            logging.warning("Ignoring invalid cache entry for {}".format(self.filename))
+            self.files = []
+            return False
+        return True
+
     def _identify_files(self):
-        if self.multi_file:
-            raise RuntimeError("Multi-file torrents are not supported yet.")
-        self.files.append(
-            TorrentFile(
-                self.meta_info[b"info"][b"name"].decode(),
-                self.meta_info[b"info"][b"length"],
-            )
-        )
+        info = self.meta_info[b"info"]
+        # The name is the output file or directory, within the working
+        # directory
+        if not _valid_path_component(self.output_file):
+            raise RuntimeError("Invalid name in torrent")
+        if not self.multi_file:
+            self.files.append(TorrentFile(self.output_file, info[b"length"]))
+            return
+
+        for file in info[b"files"]:
+            components = [component.decode() for component in file[b"path"]]
+            # The files must stay within the torrent's directory
+            if not components or not all(
+                _valid_path_component(component) for component in components
+            ):
+                raise RuntimeError("Invalid file path in torrent")
+            self.files.append(TorrentFile(os.path.join(*components), file[b"length"]))
 
     @property
     def announce(self) -> str:
         return self.meta_info[b"announce"].decode("utf-8")
 
-    @property
-    def multi_file(self) -> bool:
-        return b"files" in self.meta_info[b"info"]
+    @cached_property
+    def announce_list(self) -> list:
+        """
+        The tiers of tracker URLs (BEP 12), falling back to a single tier
+        with the announce URL for torrents without an announce-list.
+        """
+        tiers = [
+            [url.decode("utf-8") for url in tier]
+            for tier in self.meta_info.get(b"announce-list", [])
+        ]
+        tiers = [tier for tier in tiers if tier]
+        if not tiers and b"announce" in self.meta_info:
+            tiers = [[self.announce]]
+        return tiers
 
     @property
     def piece_length(self):
         return self.meta_info[b"info"][b"piece length"]
 
+    @cached_property
+    def file_index(self) -> FileIndex:
+        return FileIndex(self.files)
+
     @property
     def total_size(self) -> int:
-        if self.multi_file:
-            raise RuntimeError("Multi-file torrents are not supported yet.")
-        return self.files[0].length
+        return self.file_index.size
 
-    @property
-    def pieces(self):
-        data = self.meta_info[b"info"][b"pieces"]
-        pieces = []
-        offset = 0
-        length = len(data)
+    @cached_property
+    def pieces(self) -> PieceHashes:
+        return PieceHashes(self.meta_info[b"info"][b"pieces"])
+
+    @cached_property
+    def piece_count(self) -> int:
+        return len(self.pieces)
 
-        while offset < length:
-            pieces.append(data[offset : offset + 20])
-            offset += 20
+    @cached_property
+    def last_piece_length(self) -> int:
+        return self.total_size - (self.piece_count - 1) * self.piece_length
 
-        return pieces
+    def piece_size(self, index: int) -> int:
+        """
+        Returns the length of the piece with the given index, all pieces
+        but the last one are of the piece length.
+        """
+        if index == self.piece_count - 1:
+            return self.last_piece_length
+        return self.piece_length
 
     @property
     def output_file(self):
+        """
+        The name of the output file, or of the output directory holding the
+        files of a multi-file torrent.
+        """
         return self.meta_info[b"info"][b"name"].decode("utf-8")
 
     @property
@@ -1,11 +1,55 @@
 import aiohttp
+import asyncio
 import random
 import logging
 import socket
-from struct import unpack
-from urllib.parse import urlencode
+import time
+from collections import namedtuple
+from functools import cached_property
+from struct import iter_unpack, unpack
+from urllib.parse import urlencode, urlparse
 
 from yufka import bencoding
+from yufka.udp_tracker import MAX_SCRAPE_HASHES, UDPTrackerClient
+
+# The size of the chunks the tracker response is decoded in
+RESPONSE_CHUNK_SIZE = 2**14
+
+# The number of trackers of a tier announced to at the same time
+MAX_CONCURRENT_ANNOUNCES = 4
+
+# The number of seconds after which an announce is given up
+ANNOUNCE_TIMEOUT = 60
+
+# The number of seconds after which the next tier is announced to as well,
+# while no tracker of the previous tiers responded
+TIER_DELAY = 5
+
+# The number of seconds after which a scrape request is given up
+SCRAPE_TIMEOUT = 60
+
+# The number of info hashes per HTTP scrape request, keeping the URL within
+# the limits of common servers
+MAX_HTTP_SCRAPE_HASHES = 50
+
+# A failed tracker is not announced to again for BACKOFF * 2^(failures - 1)
+# seconds, up to MAX_BACKOFF seconds
+BACKOFF = 30
+MAX_BACKOFF = 30 * 60
+
+# The total and per host limits of HTTP connections to trackers
+HTTP_CONNECTION_LIMIT = 100
+HTTP_CONNECTION_LIMIT_PER_HOST = 8
+
+# The number of seconds resolved tracker host names are cached for
+DNS_CACHE_TTL = 5 * 60
+
+# The number of seconds idle HTTP connections to trackers are kept open
+KEEPALIVE_TIMEOUT = 60
+
+
+# The swarm statistics of a torrent reported by a tracker's scrape
+ScrapeResult = namedtuple("ScrapeResult", ["seeders", "completed", "leechers"])
 
 
 class TrackerResponse:
@@ -30,16 +74,24 @@ class TrackerResponse:
     def incomplete(self) -> int:
         return self.response.get(b"incomplete", 0)
 
-    @property
-    def peers(self):
-        peers = self.response[b"peers"]
+    @cached_property
+    def peers(self) -> list:
+        """
+        The (ip, port) of the peers returned by the tracker, from the
+        compact or dictionary model `peers` and the compact IPv6 `peers6`
+        (BEP 7).
+        """
+        peers = self.response.get(b"peers", b"")
         if type(peers) == list:
             logging.debug("Dictionary model peers are returned by tracker")
-            raise NotImplementedError()
+            result = decode_dict_peers(peers)
         else:
             logging.debug("Binary model peers are returned by tracker")
-            peers = [peers[i : i + 6] for i in range(0, len(peers), 6)]
-            return [(socket.inet_ntoa(p[:4]), _decode_port(p[4:])) for p in peers]
+            result = decode_compact_peers(peers)
+        peers6 = self.response.get(b"peers6")
+        if peers6:
+            result.extend(decode_compact_peers6(peers6))
+        return result
 
     def __str__(self):
         return (
@@ -55,50 +107,266 @@ class TrackerResponse:
         )
 
 
+class HTTPSessionPool:
+    """
+    The HTTP connections to trackers, shared by all `Tracker` instances.
+
+    Connections are kept alive and reused across announces of different
+    torrents to the same tracker, the number of connections is limited in
+    total and per host, and resolved host names are cached.
+
+    A session belongs to the event loop it was created in, a new session is
+    created when used from another loop.
+    """
+
+    def __init__(
+        self,
+        limit: int = HTTP_CONNECTION_LIMIT,
+        limit_per_host: int = HTTP_CONNECTION_LIMIT_PER_HOST,
+        dns_cache_ttl: int = DNS_CACHE_TTL,
+        keepalive_timeout: float = KEEPALIVE_TIMEOUT,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+        self._loop = None
+
+    def session(self) -> aiohttp.ClientSession:
+        """
+        Returns the session of the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._loop = loop
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+            self._loop = None
+
+
+_shared_pool = None
+
+
+def shared_pool() -> HTTPSessionPool:
+    """
+    Returns the HTTP session pool shared within the process.
+    """
+    global _shared_pool
+    if _shared_pool is None:
+        _shared_pool = HTTPSessionPool()
+    return _shared_pool
+
+
+class TrackerState:
+    """
+    The health of a single tracker of the announce-list, used to order the
+    trackers of a tier and to back off from failing ones.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        # The number of consecutive failed announces
+        self.failures = 0
+        # The time before which the tracker is not announced to
+        self.retry_at = 0
+        # The number of seconds the last successful announce took
+        self.latency = 0
+
+    def succeeded(self, latency: float):
+        self.failures = 0
+        self.retry_at = 0
+        self.latency = latency
+
+    def failed(self):
+        self.failures += 1
+        self.retry_at = time.monotonic() + min(
+            MAX_BACKOFF, BACKOFF * 2 ** (self.failures - 1)
+        )
+
+    def score(self, now: float):
+        """
+        The sort key of the tracker within its tier, lower is better.
+        """
+        return (self.retry_at > now, self.failures, self.latency)
+
+
 class Tracker:
-    def __init__(self, torrent):
+    """
+    Announces to the trackers of the torrent's announce-list (BEP 12).
+
+    The tiers are tried in order, as BEP 12 prefers the earlier tiers, but
+    without waiting for a stalled tier to fail: the next tier is started
+    once the previous tiers failed or after `TIER_DELAY` seconds, and the
+    first response of any started tier wins. Within a tier, the healthiest
+    trackers are announced to concurrently and the first to respond is
+    promoted to the front of its tier. Failing trackers are backed off from
+    exponentially, and skipped until their backoff expired.
+    """
+
+    def __init__(self, torrent, http_pool: HTTPSessionPool = None):
         self.torrent = torrent
         self.peer_id = _calculate_peer_id()
-        self.http_client = aiohttp.ClientSession()
+        self.http_pool = http_pool if http_pool else shared_pool()
+        self.udp_client = UDPTrackerClient()
+        self.tiers = []
+        for urls in torrent.announce_list:
+            tier = [TrackerState(url) for url in urls]
+            # Spreads the load of clients over the trackers of a tier
+            random.shuffle(tier)
+            self.tiers.append(tier)
 
     async def connect(self, first: bool = None, uploaded: int = 0, downloaded: int = 0):
+        tasks = []
+        try:
+            for tier in self.tiers:
+                tasks.append(
+                    asyncio.ensure_future(
+                        self._announce_tier(tier, first, uploaded, downloaded)
+                    )
+                )
+                response = await _first_response(tasks, TIER_DELAY)
+                if response is not None:
+                    return response
+            response = await _first_response(tasks)
+            if response is not None:
+                return response
+        finally:
+            for task in tasks:
+                task.cancel()
+        raise ConnectionError("Unable to connect to any tracker")
+
+    async def _announce_tier(self, tier: list, first, uploaded, downloaded):
+        """
+        Announces to the trackers of the tier concurrently, at most
+        `MAX_CONCURRENT_ANNOUNCES` at a time. Trackers backing off after
+        failures are skipped.
+
+        :return The first successful response, or None if all trackers of
+                the tier failed or are backing off
+        """
+        now = time.monotonic()
+        candidates = sorted(
+            (state for state in tier if state.retry_at <= now),
+            key=lambda state: state.score(now),
+        )
+        started = {}
+        try:
+            while candidates or started:
+                while candidates and len(started) < MAX_CONCURRENT_ANNOUNCES:
+                    state = candidates.pop(0)
+                    task = asyncio.ensure_future(
+                        self._announce(state.url, first, uploaded, downloaded)
+                    )
+                    started[task] = (state, time.monotonic())
+                done, _ = await asyncio.wait(
+                    started, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    state, sent = started.pop(task)
+                    try:
+                        response = task.result()
+                    except Exception as e:
+                        # Any failure of a single tracker, including a
+                        # malformed response, moves on to the other trackers
+                        logging.warning(
+                            "Announce to {url} failed: {error}".format(
+                                url=state.url, error=e
+                            )
+                        )
+                        state.failed()
+                        continue
+                    state.succeeded(time.monotonic() - sent)
+                    # Promotes the responding tracker within its tier
+                    tier.remove(state)
+                    tier.insert(0, state)
+                    return response
+        finally:
+            for task in started:
+                task.cancel()
+        return None
+
+    async def _announce(self, url: str, first: bool, uploaded: int, downloaded: int):
+        parsed = urlparse(url)
+        if parsed.scheme == "udp":
+            announce = self._announce_udp(parsed, first, uploaded, downloaded)
+        elif parsed.scheme in ("http", "https"):
+            announce = self._announce_http(url, first, uploaded, downloaded)
+        else:
+            raise ConnectionError("Unsupported tracker {}".format(url))
+        response = await asyncio.wait_for(announce, ANNOUNCE_TIMEOUT)
+        # Decodes the response here, so that a malformed response fails
+        # this tracker instead of the caller
+        response.peers
+        if not isinstance(response.interval, int):
+            raise ValueError("Invalid interval {!r}".format(response.interval))
+        return response
+
+    def _left(self, downloaded: int) -> int:
+        """
+        Returns the number of bytes left to download, the downloaded bytes
+        may exceed the torrent's size once complete.
+        """
+        return max(0, self.torrent.total_size - downloaded)
+
+    async def _announce_http(
+        self, url: str, first: bool, uploaded: int, downloaded: int
+    ):
         params = {
             "info_hash": self.torrent.info_hash,
             "peer_id": self.peer_id,
+            # Nothing listens on the port, peers are only ever dialed
             "port": 6889,
             "uploaded": uploaded,
             "downloaded": downloaded,
-            "left": self.torrent.total_size - downloaded,
+            "left": self._left(downloaded),
             "compact": 1,
         }
         if first:
             params["event"] = "started"
-        url = self.torrent.announce + "?" + urlencode(params)
+        url = url + ("&" if "?" in url else "?") + urlencode(params)
         logging.info("Connecting to tracker at: " + url)
 
-        async with self.http_client.get(url) as response:
-            if not response.status == 200:
-                raise ConnectionError(
-                    "Unable to connect to tracker: status code {}".format(
-                        response.status
-                    )
-                )
-            data = await response.read()
-            self.raise_for_error(data)
-            return TrackerResponse(bencoding.Decoder(data).decode())
+        tracker_response = TrackerResponse(await _request_http(self.http_pool, url))
+        if tracker_response.failure:
+            raise ConnectionError(
+                "Unable to connect to tracker: {}".format(tracker_response.failure)
+            )
+        return tracker_response
 
-    def close(self):
-        self.http_client.close()
+    async def _announce_udp(self, url, first: bool, uploaded: int, downloaded: int):
+        logging.info("Connecting to tracker at: " + url.geturl())
+        if url.port is None:
+            raise ConnectionError("Missing port of UDP tracker {}".format(url.geturl()))
+        response = await self.udp_client.announce(
+            url.hostname,
+            url.port,
+            self.torrent.info_hash,
+            self.peer_id.encode(),
+            uploaded=uploaded,
+            downloaded=downloaded,
+            left=self._left(downloaded),
+            event="started" if first else None,
+        )
+        return TrackerResponse(response)
 
-    def raise_for_error(self, tracker_response):
-        try:
-            message = tracker_response.decode("utf-8")
-            if "failure" in message:
-                raise ConnectionError(
-                    "Unable to connect to tracker: {}".format(message)
-                )
-        except UnicodeDecodeError:
-            pass
+    async def close(self):
+        """
+        Closes the UDP socket, the HTTP connections stay in the pool for
+        other trackers.
+        """
+        self.udp_client.close()
 
     def _construct_tracker_parameters(self):
         return {
@@ -112,9 +380,203 @@ class Tracker:
         }
 
 
+class Scraper:
+    """
+    Requests the swarm statistics (seeders, completed downloads and
+    leechers) of many torrents from trackers, without announcing to them.
+
+    The info hashes are sent in as few requests as the tracker protocol
+    allows: up to `MAX_SCRAPE_HASHES` per UDP request (BEP 15) and
+    `MAX_HTTP_SCRAPE_HASHES` per HTTP request, which are sent concurrently.
+    """
+
+    def __init__(
+        self, http_pool: HTTPSessionPool = None, udp_client: UDPTrackerClient = None
+    ):
+        self.http_pool = http_pool if http_pool else shared_pool()
+        self.udp_client = udp_client if udp_client else UDPTrackerClient()
+
+    async def scrape(self, url: str, info_hashes: list) -> dict:
+        """
+        Scrapes the tracker with the given announce URL.
+
+        :param url: The announce URL of the tracker
+        :param info_hashes: The info hashes of the torrents
+        :return A dict mapping the info hash to its ScrapeResult, torrents
+                unknown to the tracker are left out
+        """
+        parsed = urlparse(url)
+        if parsed.scheme == "udp":
+            if parsed.port is None:
+                raise ConnectionError("Missing port of UDP tracker {}".format(url))
+            batch_size = MAX_SCRAPE_HASHES
+        elif parsed.scheme in ("http", "https"):
+            url = scrape_url(url)
+            if url is None:
+                raise ConnectionError(
+                    "Tracker {} does not support scrape".format(parsed.geturl())
+                )
+            batch_size = MAX_HTTP_SCRAPE_HASHES
+        else:
+            raise ConnectionError("Unsupported tracker {}".format(url))
+
+        info_hashes = list(dict.fromkeys(info_hashes))
+        tasks = [
+            asyncio.ensure_future(
+                self._scrape(parsed, url, info_hashes[first : first + batch_size])
+            )
+            for first in range(0, len(info_hashes), batch_size)
+        ]
+        results = {}
+        try:
+            for task in tasks:
+                results.update(await task)
+        finally:
+            for task in tasks:
+                task.cancel()
+        return results
+
+    async def _scrape(self, parsed, url: str, info_hashes: list) -> dict:
+        if parsed.scheme == "udp":
+            scrape = self._scrape_udp(parsed, info_hashes)
+        else:
+            scrape = self._scrape_http(url, info_hashes)
+        return await asyncio.wait_for(scrape, SCRAPE_TIMEOUT)
+
+    async def _scrape_http(self, url: str, info_hashes: list) -> dict:
+        params = urlencode([("info_hash", info_hash) for info_hash in info_hashes])
+        url = url + ("&" if "?" in url else "?") + params
+        logging.debug("Scraping {count} torrents".format(count=len(info_hashes)))
+        response = await _request_http(self.http_pool, url)
+        if b"failure reason" in response:
+            raise ConnectionError(
+                "Unable to scrape tracker: {}".format(
+                    response[b"failure reason"].decode("utf-8", "replace")
+                )
+            )
+        files = response.get(b"files", {})
+        results = {}
+        for info_hash in info_hashes:
+            stats = files.get(info_hash)
+            if type(stats) is dict:
+                results[info_hash] = ScrapeResult(
+                    stats.get(b"complete", 0),
+                    stats.get(b"downloaded", 0),
+                    stats.get(b"incomplete", 0),
+                )
+        return results
+
+    async def _scrape_udp(self, url, info_hashes: list) -> dict:
+        stats = await self.udp_client.scrape(url.hostname, url.port, info_hashes)
+        return {
+            info_hash: ScrapeResult(*result)
+            for info_hash, result in zip(info_hashes, stats)
+        }
+
+    async def close(self):
+        """
+        Closes the UDP socket, the HTTP connections stay in the pool.
+        """
+        self.udp_client.close()
+
+
+async def _first_response(tasks: list, timeout: float = None):
+    """
+    Waits for the first of the tasks to return a response.
+
+    :return The response, or None if no task returned one before all tasks
+            completed or the timeout expired
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    while True:
+        for task in tasks:
+            if task.done() and task.result() is not None:
+                return task.result()
+        pending = [task for task in tasks if not task.done()]
+        remaining = None if deadline is None else deadline - loop.time()
+        if not pending or (remaining is not None and remaining <= 0):
+            return None
+        await asyncio.wait(
+            pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED
+        )
+
+
+def scrape_url(url: str) -> str:
+    """
+    Returns the scrape URL of an HTTP tracker, derived from its announce URL
+    by replacing the `announce` at the start of the last path segment.
+
+    :return The scrape URL, or None if the tracker does not support scrape
+    """
+    parsed = urlparse(url)
+    head, _, last = parsed.path.rpartition("/")
+    if not last.startswith("announce"):
+        return None
+    path = head + "/scrape" + last[len("announce") :]
+    return parsed._replace(path=path).geturl()
+
+
+async def _request_http(pool: HTTPSessionPool, url: str) -> dict:
+    """
+    Sends a GET request to an HTTP tracker.
+
+    :return The decoded bencoded response
+    """
+    async with pool.session().get(url) as response:
+        if not response.status == 200:
+            raise ConnectionError(
+                "Unable to connect to tracker: status code {}".format(response.status)
+            )
+        # Decoded while received, without holding the entire body
+        decoder = bencoding.StreamDecoder()
+        async for chunk in response.content.iter_chunked(RESPONSE_CHUNK_SIZE):
+            decoder.feed(chunk)
+        return decoder.close()
+
+
 def _calculate_peer_id():
     return "-PC0001-" + "".join([str(random.randint(0, 9)) for _ in range(12)])
 
 
 def _decode_port(port):
     return unpack(">H", port)[0]
+
+
+def decode_compact_peers(data: bytes) -> list:
+    """
+    Decodes the compact model of IPv4 peers, 4 bytes of address and 2
+    bytes of port per peer, in a single pass.
+    """
+    ntoa = socket.inet_ntoa
+    data = data[: len(data) - len(data) % 6]
+    return [(ntoa(ip), port) for ip, port in iter_unpack(">4sH", data)]
+
+
+def decode_compact_peers6(data: bytes) -> list:
+    """
+    Decodes the compact model of IPv6 peers, 16 bytes of address and 2
+    bytes of port per peer.
+    """
+    ntop = socket.inet_ntop
+    data = data[: len(data) - len(data) % 18]
+    return [
+        (ntop(socket.AF_INET6, ip), port) for ip, port in iter_unpack(">16sH", data)
+    ]
+
+
+def decode_dict_peers(peers: list) -> list:
+    """
+    Decodes the dictionary model of peers, skipping invalid entries.
+    """
+    result = []
+    for peer in peers:
+        try:
+            ip, port = peer[b"ip"].decode("utf-8"), peer[b"port"]
+        except (KeyError, TypeError, AttributeError, UnicodeDecodeError):
+            ip, port = None, None
+        if type(port) is not int or not 0 < port < 2**16:
+            logging.debug("Ignoring invalid peer {}".format(peer))
+            continue
+        result.append((ip, port))
+    return result
@@ -0,0 +1,247 @@
+import asyncio
+import logging
+import random
+import socket
+import struct
+import time
+
+# The magic connection id of connect requests
+PROTOCOL_ID = 0x41727101980
+
+ACTION_CONNECT = 0
+ACTION_ANNOUNCE = 1
+ACTION_SCRAPE = 2
+ACTION_ERROR = 3
+
+# The announce events, as named in HTTP announces
+EVENTS = {None: 0, "completed": 1, "started": 2, "stopped": 3}
+
+# The number of seconds a connection id may be used for
+CONNECTION_ID_LIFETIME = 60
+
+# A request is retransmitted after 15 * 2^n seconds, for n up to 8
+DEFAULT_TIMEOUT = 15
+DEFAULT_MAX_RETRIES = 8
+
+# The number of info hashes fitting into a single scrape request
+MAX_SCRAPE_HASHES = 74
+
+HEADER = struct.Struct(">QII")
+RESPONSE_HEADER = struct.Struct(">II")
+ANNOUNCE = struct.Struct(">20s20sQQQIIIiH")
+ANNOUNCE_RESPONSE = struct.Struct(">III")
+SCRAPE_RESPONSE = struct.Struct(">III")
+
+
+class UDPTrackerClient(asyncio.DatagramProtocol):
+    """
+    Talks to trackers over UDP as specified in BEP 15.
+
+    A single socket is used for all trackers, and responses are matched to
+    their requests by the transaction id. Connection ids are cached per
+    tracker and reused for their lifetime, so most announces take a single
+    round-trip. Unanswered requests are retransmitted after 15 * 2^n
+    seconds, for n up to 8.
+    """
+
+    def __init__(
+        self,
+        timeout: float = DEFAULT_TIMEOUT,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+    ):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.transport = None
+        # Maps the transaction id to the future of its response
+        self._transactions = {}
+        # Maps the tracker address to its connection id and expiry time
+        self._connections = {}
+        self._addresses = {}
+        # Held while the socket is created, by the first of concurrent
+        # requests
+        self._starting = asyncio.Lock()
+        self.key = random.getrandbits(32)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+
+    def datagram_received(self, data: bytes, address):
+        if len(data) < RESPONSE_HEADER.size:
+            return
+        action, transaction_id = RESPONSE_HEADER.unpack_from(data)
+        future = self._transactions.pop(transaction_id, None)
+        if future is None or future.done():
+            logging.debug("Ignoring unexpected tracker response")
+            return
+        future.set_result((action, data[RESPONSE_HEADER.size :]))
+
+    def error_received(self, exc):
+        logging.debug("UDP tracker error: {}".format(exc))
+
+    async def _start(self):
+        async with self._starting:
+            if self.transport is None:
+                loop = asyncio.get_running_loop()
+                await loop.create_datagram_endpoint(
+                    lambda: self, local_addr=("0.0.0.0", 0), family=socket.AF_INET
+                )
+
+    async def _resolve(self, host: str, port: int):
+        address = self._addresses.get((host, port))
+        if address is None:
+            loop = asyncio.get_running_loop()
+            infos = await loop.getaddrinfo(
+                host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM
+            )
+            if not infos:
+                raise ConnectionError("Unable to resolve tracker {}".format(host))
+            address = infos[0][4]
+            self._addresses[(host, port)] = address
+        return address
+
+    async def _exchange(
+        self, address, connection_id: int, action: int, body: bytes, timeout: float
+    ):
+        """
+        Sends a single request and waits for its response.
+
+        :return The payload of the response
+        """
+        transaction_id = random.getrandbits(32)
+        while transaction_id in self._transactions:
+            transaction_id = random.getrandbits(32)
+        future = asyncio.get_running_loop().create_future()
+        self._transactions[transaction_id] = future
+        try:
+            self.transport.sendto(
+                HEADER.pack(connection_id, action, transaction_id) + body, address
+            )
+            response_action, payload = await asyncio.wait_for(future, timeout)
+        finally:
+            self._transactions.pop(transaction_id, None)
+
+        if response_action == ACTION_ERROR:
+            raise ConnectionError(
+                "Tracker error: {}".format(payload.decode("utf-8", "replace"))
+            )
+        if response_action != action:
+            raise ConnectionError("Unexpected tracker response")
+        return payload
+
+    async def _request(self, host: str, port: int, action: int, body: bytes):
+        """
+        Sends the request to the tracker, connecting first if there is no
+        valid connection id. Unanswered requests are retransmitted with an
+        increasing timeout, also across connecting and requesting.
+
+        :return The payload of the response
+        """
+        await self._start()
+        address = await self._resolve(host, port)
+        attempt = 0
+        while attempt <= self.max_retries:
+            timeout = self.timeout * 2**attempt
+            connection = self._connections.get(address)
+            try:
+                if connection is None or connection[1] <= time.monotonic():
+                    payload = await self._exchange(
+                        address, PROTOCOL_ID, ACTION_CONNECT, b"", timeout
+                    )
+                    if len(payload) < 8:
+                        raise ConnectionError("Invalid connect response")
+                    (connection_id,) = struct.unpack_from(">Q", payload)
+                    self._connections[address] = (
+                        connection_id,
+                        time.monotonic() + CONNECTION_ID_LIFETIME,
+                    )
+                    continue
+                try:
+                    return await self._exchange(
+                        address, connection[0], action, body, timeout
+                    )
+                except ConnectionError:
+                    # The tracker might no longer accept the connection id
+                    self._connections.pop(address, None)
+                    raise
+            except asyncio.TimeoutError:
+                logging.debug(
+                    "UDP tracker {host}:{port} timed out after {timeout} s".format(
+                        host=host, port=port, timeout=timeout
+                    )
+                )
+                attempt += 1
+        raise ConnectionError("UDP tracker {}:{} did not respond".format(host, port))
+
+    async def announce(
+        self,
+        host: str,
+        port: int,
+        info_hash: bytes,
+        peer_id: bytes,
+        uploaded: int = 0,
+        downloaded: int = 0,
+        left: int = 0,
+        event: str = None,
+        listen_port: int = 6889,
+    ) -> dict:
+        """
+        Announces to the tracker.
+
+        :return The response as the dict an HTTP tracker would return, with
+                the peers in the compact model
+        """
+        body = ANNOUNCE.pack(
+            info_hash,
+            peer_id,
+            downloaded,
+            left,
+            uploaded,
+            EVENTS[event],
+            0,  # The IP address of the sender
+            self.key,
+            -1,  # The default number of peers
+            listen_port,
+        )
+        payload = await self._request(host, port, ACTION_ANNOUNCE, body)
+        if len(payload) < ANNOUNCE_RESPONSE.size:
+            raise ConnectionError("Invalid announce response")
+        interval, leechers, seeders = ANNOUNCE_RESPONSE.unpack_from(payload)
+        peers = payload[ANNOUNCE_RESPONSE.size :]
+        return {
+            b"complete": seeders,
+            b"incomplete": leechers,
+            b"interval": interval,
+            b"peers": peers[: len(peers) - len(peers) % 6],
+        }
+
+    async def scrape(self, host: str, port: int, info_hashes: list) -> list:
+        """
+        Requests the swarm statistics of the given torrents, in as few
+        requests as possible.
+
+        :return A (seeders, completed, leechers) tuple per info hash
+        """
+        results = []
+        for first in range(0, len(info_hashes), MAX_SCRAPE_HASHES):
+            batch = info_hashes[first : first + MAX_SCRAPE_HASHES]
+            payload = await self._request(host, port, ACTION_SCRAPE, b"".join(batch))
+            if len(payload) < len(batch) * SCRAPE_RESPONSE.size:
+                raise ConnectionError("Invalid scrape response")
+            results.extend(
+                SCRAPE_RESPONSE.unpack_from(payload, index * SCRAPE_RESPONSE.size)
+                for index in range(len(batch))
+            )
+        return results
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        for future in self._transactions.values():
+            future.cancel()
+        self._transactions.clear()
+        # The client may be used again, e.g. from another event loop
+        self._starting = asyncio.Lock()
@@ -0,0 +1,171 @@
+import asyncio
+import errno
+import logging
+import mmap
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from hashlib import sha1
+
+from yufka.storage import Storage
+
+# hashlib releases the GIL while hashing large buffers, so pieces are
+# verified in parallel to each other and to the event loop.
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+
+# The number of verifications in progress at which the verifier reports
+# itself saturated, and no new pieces should be started.
+MAX_PENDING_VERIFICATIONS = 32
+
+# The amount of data each worker verifies at a time when checking a file
+CHECK_CHUNK_SIZE = 16 * 2**20
+
+# The result of checking a file, with the indices of the pieces not matching
+# their hash, the number of bytes hashed and the seconds it took to check them
+CheckResult = namedtuple("CheckResult", ["pieces", "bad", "size", "elapsed"])
+
+
+def piece_hash(storage, index: int) -> bytes:
+    """
+    Calculates the SHA1 hash of the stored data of the given piece.
+    """
+    with storage.piece(index) as data:
+        return sha1(data).digest()
+
+
+class PieceVerifier:
+    """
+    Verifies the SHA1 hash of completed pieces in a pool of worker threads,
+    keeping the hashing of the piece data off the event loop.
+
+    The number of verifications in progress is exposed through `saturated`,
+    allowing the caller to stop downloading new pieces until hashing has
+    caught up.
+    """
+
+    def __init__(
+        self,
+        storage,
+        max_workers: int = DEFAULT_WORKERS,
+        max_pending: int = MAX_PENDING_VERIFICATIONS,
+    ):
+        self.storage = storage
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix="yufka-verifier"
+        )
+        self._pending = set()
+
+    def __len__(self):
+        return len(self._pending)
+
+    @property
+    def saturated(self) -> bool:
+        """
+        Checks if the number of verifications in progress reached the limit.
+        """
+        return len(self._pending) >= self.max_pending
+
+    def verify(self, index: int, expected: bytes) -> asyncio.Future:
+        """
+        Schedules the verification of the given piece against its expected
+        hash. Must be called from within the event loop.
+
+        :return A future resolving to True if the piece data matches the
+                hash, else False
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, self._verify, index, expected)
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+        return future
+
+    def _verify(self, index: int, expected: bytes) -> bool:
+        logging.debug("Verifying piece {index}".format(index=index))
+        return piece_hash(self.storage, index) == expected
+
+    async def drain(self):
+        """
+        Waits for all verifications in progress to complete.
+        """
+        if self._pending:
+            await asyncio.wait(set(self._pending))
+
+    def close(self):
+        """
+        Cancels the verifications not yet started and waits for the ones in
+        progress to complete.
+        """
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+def check_file(torrent, path: str, max_workers: int = DEFAULT_WORKERS, progress=None):
+    """
+    Verifies the downloaded data against the piece hashes of the torrent.
+
+    The files are memory-mapped read-only and split into chunks of
+    contiguous pieces, which are hashed in parallel by a pool of worker
+    threads. Pieces with data missing from the files are reported as bad.
+
+    :param torrent: The torrent the data was downloaded for
+    :param path: The path of the downloaded file, or of the directory
+                 holding the files of a multi-file torrent
+    :param max_workers: The number of threads hashing pieces
+    :param progress: An optional callback called with the number of bytes
+                     checked so far, each time a chunk is completed
+    :return The CheckResult
+    :raise FileNotFoundError: When there is no downloaded data at the path
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+    hashes = torrent.pieces
+    piece_length = torrent.piece_length
+    total_size = torrent.total_size
+    pieces_per_chunk = max(1, CHECK_CHUNK_SIZE // piece_length)
+    started = time.monotonic()
+
+    storage = Storage(torrent, path, readonly=True)
+    if hasattr(mmap, "MADV_SEQUENTIAL"):
+        storage.advise(mmap.MADV_SEQUENTIAL)
+
+    def check_chunk(first: int, last: int):
+        bad = []
+        hashed = 0
+        for index in range(first, last):
+            length = min(piece_length, total_size - index * piece_length)
+            with storage.piece(index) as data:
+                # Pieces with data missing are bad without being hashed
+                if len(data) != length:
+                    bad.append(index)
+                    continue
+                hashed += len(data)
+                if sha1(data).digest() != hashes[index]:
+                    bad.append(index)
+        size = min(last * piece_length, total_size) - first * piece_length
+        return bad, size, hashed
+
+    bad = []
+    checked = 0
+    hashed = 0
+    try:
+        with ThreadPoolExecutor(
+            max_workers, thread_name_prefix="yufka-check"
+        ) as executor:
+            futures = [
+                executor.submit(
+                    check_chunk, first, min(first + pieces_per_chunk, len(hashes))
+                )
+                for first in range(0, len(hashes), pieces_per_chunk)
+            ]
+            for future in as_completed(futures):
+                chunk_bad, chunk_size, chunk_hashed = future.result()
+                bad.extend(chunk_bad)
+                checked += chunk_size
+                hashed += chunk_hashed
+                if progress:
+                    progress(checked)
+    finally:
+        storage.close()
+
+    return CheckResult(len(hashes), sorted(bad), hashed, time.monotonic() - started)